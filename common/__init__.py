@@ -0,0 +1,20 @@
+"""
+ワークショップ共通モジュール
+"""
+
+from .llm_client import (
+    LLMClient,
+    LLMError,
+    LLMResponse,
+    LLMTimeoutError,
+    GeminiBackend,
+    OllamaBackend,
+    ResponseRecorder,
+    StubBackend,
+    TokenBucket,
+    create_llm_client,
+    create_recorder,
+    estimate_tokens,
+    get_backend_name,
+    get_llm_client,
+)
@@ -0,0 +1,687 @@
+"""
+共有LLMクライアント
+レート制限・同時実行数制御・リトライ・タイムアウト・メトリクス・応答の記録と再生を一元管理
+
+生成設定（generation_config）は Gemini の形式で指定する（temperature / max_output_tokens / stop_sequences）。
+stream() は生成されたテキストを少しずつ返し、途中で打ち切ると残りの生成をやめる。
+"""
+
+import hashlib
+import json
+import os
+import random
+import threading
+import time
+from typing import Callable, Dict, Iterator, List, Optional
+
+import requests
+
+
+class LLMError(Exception):
+    """LLM呼び出しの失敗（リトライ上限超過・待ち行列タイムアウトなど）"""
+
+
+class LLMTimeoutError(LLMError, TimeoutError):
+    """LLM呼び出しのタイムアウト"""
+
+
+class LLMResponse:
+    """LLMの応答（generate_content の戻り値と同じく .text で本文を参照できる）"""
+
+    def __init__(self, text: str, prompt_tokens: int = 0, output_tokens: int = 0):
+        self.text = text
+        self.prompt_tokens = prompt_tokens
+        self.output_tokens = output_tokens
+
+
+def estimate_tokens(text: str) -> int:
+    """トークン数の概算（APIが使用量を返さない場合のフォールバック）
+
+    英数字などのASCII文字は約4文字で1トークン、日本語などそれ以外の文字は約1文字で1トークンとして数える。
+    """
+    if not text:
+        return 0
+    ascii_chars = len(text.encode('ascii', 'ignore'))
+    return max(1, ascii_chars // 4 + (len(text) - ascii_chars))
+
+
+# リトライ対象とする例外クラス名（google.api_core / requests を import せずに判定する）
+RETRYABLE_ERROR_NAMES = {
+    "ResourceExhausted",
+    "TooManyRequests",
+    "ServiceUnavailable",
+    "DeadlineExceeded",
+    "InternalServerError",
+    "Timeout",
+    "ReadTimeout",
+    "ConnectTimeout",
+    "ConnectionError",
+}
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """リトライすべき一時的なエラーかどうかを判定"""
+    if isinstance(error, (TimeoutError, ConnectionError)):
+        return True
+
+    class_names = {cls.__name__ for cls in type(error).__mro__}
+    if class_names & RETRYABLE_ERROR_NAMES:
+        return True
+
+    # HTTPステータスコード（429・5xx）で判定
+    response = getattr(error, "response", None)
+    status_code = getattr(response, "status_code", None) or getattr(error, "code", None)
+    if isinstance(status_code, int):
+        return status_code == 429 or status_code >= 500
+
+    return False
+
+
+class TokenBucket:
+    """トークンバケット方式のレート制限"""
+
+    def __init__(self, rate_per_second: float, capacity: Optional[float] = None):
+        self.rate = rate_per_second
+        self.capacity = capacity if capacity is not None else max(1.0, rate_per_second)
+        self.tokens = self.capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+        self.last_refill = now
+
+    def acquire(self, timeout: Optional[float] = None) -> bool:
+        """トークンを1つ取得（取得できるまで待機）"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return True
+                wait = (1 - self.tokens) / self.rate
+
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                wait = min(wait, remaining)
+            time.sleep(wait)
+
+
+class LLMMetrics:
+    """レイテンシ・トークン数などの集計"""
+
+    def __init__(self, max_samples: int = 1000):
+        self.max_samples = max_samples
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = 0
+            self.successes = 0
+            self.failures = 0
+            self.retries = 0
+            self.timeouts = 0
+            self.rate_limited = 0
+            self.prompt_tokens = 0
+            self.output_tokens = 0
+            self.latencies = []
+            self.in_flight = 0
+            self.max_in_flight = 0
+            self.replay_hits = 0
+            self.replay_misses = 0
+            self.recorded = 0
+            self.streams_cancelled = 0
+
+    def record_latency(self, latency: float):
+        with self.lock:
+            self.latencies.append(latency)
+            if len(self.latencies) > self.max_samples:
+                self.latencies.pop(0)
+
+    def increment(self, name: str, value: int = 1):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + value)
+            if name == "in_flight":
+                self.max_in_flight = max(self.max_in_flight, self.in_flight)
+
+    def snapshot(self) -> Dict:
+        """現在の統計を辞書で取得"""
+        with self.lock:
+            latencies = sorted(self.latencies)
+
+            def percentile(p: float) -> float:
+                if not latencies:
+                    return 0.0
+                index = min(len(latencies) - 1, int(round(p / 100 * (len(latencies) - 1))))
+                return latencies[index]
+
+            return {
+                "requests": self.requests,
+                "successes": self.successes,
+                "failures": self.failures,
+                "retries": self.retries,
+                "timeouts": self.timeouts,
+                "rate_limited": self.rate_limited,
+                "prompt_tokens": self.prompt_tokens,
+                "output_tokens": self.output_tokens,
+                "max_in_flight": self.max_in_flight,
+                "replay_hits": self.replay_hits,
+                "replay_misses": self.replay_misses,
+                "recorded": self.recorded,
+                "streams_cancelled": self.streams_cancelled,
+                "avg_latency": sum(latencies) / len(latencies) if latencies else 0.0,
+                "p50_latency": percentile(50),
+                "p95_latency": percentile(95),
+                "p99_latency": percentile(99),
+            }
+
+
+class GeminiBackend:
+    """Google Gemini API バックエンド"""
+
+    name = "gemini"
+
+    def __init__(self, model_name: str = "gemini-pro"):
+        import google.generativeai as genai
+
+        genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
+        self.model_name = model_name
+        self.model = genai.GenerativeModel(model_name)
+
+    def generate(self, prompt: str, generation_config: Optional[Dict] = None,
+                 timeout: Optional[float] = None) -> LLMResponse:
+        request_options = {"timeout": timeout} if timeout else None
+        response = self.model.generate_content(
+            prompt,
+            generation_config=generation_config,
+            request_options=request_options
+        )
+
+        usage = getattr(response, "usage_metadata", None)
+        return LLMResponse(
+            response.text,
+            prompt_tokens=getattr(usage, "prompt_token_count", 0) or estimate_tokens(prompt),
+            output_tokens=getattr(usage, "candidates_token_count", 0) or estimate_tokens(response.text)
+        )
+
+    def stream(self, prompt: str, generation_config: Optional[Dict] = None,
+               timeout: Optional[float] = None) -> Iterator[str]:
+        request_options = {"timeout": timeout} if timeout else None
+        response = self.model.generate_content(
+            prompt,
+            generation_config=generation_config,
+            request_options=request_options,
+            stream=True
+        )
+        for chunk in response:
+            # 末尾などパートを持たないチャンクでは chunk.text が ValueError になる
+            if chunk.parts and chunk.text:
+                yield chunk.text
+
+
+class OllamaBackend:
+    """Ollama（ローカルLLM）バックエンド（local-llm/ollama_demo.py と同じ /api/generate を使用）"""
+
+    name = "ollama"
+
+    def __init__(self, model_name: str = "llama3.2", base_url: Optional[str] = None):
+        self.model_name = model_name
+        self.base_url = base_url or os.getenv('OLLAMA_BASE_URL', "http://localhost:11434")
+
+    def _payload(self, prompt: str, generation_config: Optional[Dict], stream: bool) -> Dict:
+        payload = {
+            "model": self.model_name,
+            "prompt": prompt,
+            "stream": stream
+        }
+
+        # Gemini形式の生成設定をOllamaのoptionsに変換
+        if generation_config:
+            options = {}
+            if "temperature" in generation_config:
+                options["temperature"] = generation_config["temperature"]
+            if "max_output_tokens" in generation_config:
+                options["num_predict"] = generation_config["max_output_tokens"]
+            if "stop_sequences" in generation_config:
+                options["stop"] = list(generation_config["stop_sequences"])
+            payload["options"] = options
+        return payload
+
+    def generate(self, prompt: str, generation_config: Optional[Dict] = None,
+                 timeout: Optional[float] = None) -> LLMResponse:
+        payload = self._payload(prompt, generation_config, stream=False)
+        response = requests.post(f"{self.base_url}/api/generate", json=payload, timeout=timeout)
+        response.raise_for_status()
+        result = response.json()
+
+        text = result.get('response', '')
+        return LLMResponse(
+            text,
+            prompt_tokens=result.get('prompt_eval_count') or estimate_tokens(prompt),
+            output_tokens=result.get('eval_count') or estimate_tokens(text)
+        )
+
+    def stream(self, prompt: str, generation_config: Optional[Dict] = None,
+               timeout: Optional[float] = None) -> Iterator[str]:
+        payload = self._payload(prompt, generation_config, stream=True)
+        response = requests.post(f"{self.base_url}/api/generate", json=payload, timeout=timeout, stream=True)
+        try:
+            response.raise_for_status()
+            # 1行1チャンクのJSON（NDJSON）
+            for line in response.iter_lines():
+                if not line:
+                    continue
+                chunk = json.loads(line)
+                if chunk.get('response'):
+                    yield chunk['response']
+                if chunk.get('done'):
+                    break
+        finally:
+            # 途中で打ち切られた場合は接続を閉じて生成を止める
+            response.close()
+
+
+class StubBackend:
+    """オフラインテスト用のスタブバックエンド"""
+
+    name = "stub"
+
+    def __init__(self, model_name: str = "stub", responses: Optional[List[str]] = None,
+                 responder: Optional[Callable[[str], str]] = None, latency: float = 0.0,
+                 token_latency: float = 0.0, chunk_chars: int = 4, stream_stop_sequences: bool = True):
+        self.model_name = model_name
+        self.responses = list(responses or [])
+        self.responder = responder
+        # latency: 最初の出力までの秒数、token_latency: 出力1トークン（約 chunk_chars 文字）ごとの秒数
+        self.latency = latency
+        self.token_latency = token_latency
+        self.chunk_chars = chunk_chars
+        # False にすると stream では停止シーケンスを無視して最後まで返す（呼び出し側の打ち切りを試すため）
+        self.stream_stop_sequences = stream_stop_sequences
+        self.call_count = 0
+        self.lock = threading.Lock()
+
+    def _text(self, prompt: str, generation_config: Optional[Dict], timeout: Optional[float],
+              apply_stop_sequences: bool = True) -> str:
+        with self.lock:
+            index = self.call_count
+            self.call_count += 1
+
+        if self.latency:
+            if timeout is not None and self.latency > timeout:
+                time.sleep(timeout)
+                raise TimeoutError(f"スタブ応答が {timeout}秒 を超えました")
+            time.sleep(self.latency)
+
+        if self.responder:
+            text = self.responder(prompt)
+        elif self.responses:
+            text = self.responses[index % len(self.responses)]
+        else:
+            text = f"[stub] {prompt.strip()[:100]}"
+
+        if not apply_stop_sequences:
+            return text
+        # 停止シーケンスの手前まで（停止シーケンス自体は含めない）
+        for stop in (generation_config or {}).get("stop_sequences", []):
+            position = text.find(stop)
+            if position != -1:
+                text = text[:position]
+        return text
+
+    def generate(self, prompt: str, generation_config: Optional[Dict] = None,
+                 timeout: Optional[float] = None) -> LLMResponse:
+        text = self._text(prompt, generation_config, timeout)
+        if self.token_latency:
+            time.sleep(self.token_latency * len(text) / self.chunk_chars)
+        return LLMResponse(text, estimate_tokens(prompt), estimate_tokens(text))
+
+    def stream(self, prompt: str, generation_config: Optional[Dict] = None,
+               timeout: Optional[float] = None) -> Iterator[str]:
+        text = self._text(prompt, generation_config, timeout, self.stream_stop_sequences)
+        for start in range(0, len(text), self.chunk_chars):
+            if self.token_latency:
+                time.sleep(self.token_latency)
+            yield text[start:start + self.chunk_chars]
+
+
+BACKENDS = {
+    "gemini": GeminiBackend,
+    "ollama": OllamaBackend,
+    "stub": StubBackend,
+}
+
+
+REPLAY_PASSTHROUGH = "passthrough"  # 記録も再生もしない
+REPLAY_RECORD = "record"            # 記録済みなら再生し、なければLLMを呼んで記録する
+REPLAY_ONLY = "replay"              # 記録済みの応答だけを返す（LLMを呼ばない。オフライン・再現用）
+REPLAY_MODES = (REPLAY_PASSTHROUGH, REPLAY_RECORD, REPLAY_ONLY)
+
+DEFAULT_RECORDINGS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), ".llm_recordings")
+
+
+class ResponseRecorder:
+    """LLM応答の記録と再生
+
+    モデル・プロンプト・生成設定のハッシュをキーに、1応答1ファイル（JSON）で保存する。
+    同じ条件の呼び出しは記録した応答を即座に返すため、ベンチマークやデモを高速・オフライン・再現可能に実行できる。
+    """
+
+    def __init__(self, directory: str = DEFAULT_RECORDINGS_DIR, mode: str = REPLAY_RECORD):
+        if mode not in REPLAY_MODES:
+            raise ValueError(f"未対応の再生モードです: {mode}（{', '.join(REPLAY_MODES)}）")
+        self.directory = directory
+        self.mode = mode
+
+    @staticmethod
+    def make_key(model: str, prompt: str, generation_config: Optional[Dict] = None) -> str:
+        payload = json.dumps(
+            {"model": model, "prompt": prompt, "generation_config": generation_config or {}},
+            sort_keys=True, ensure_ascii=False, default=str
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        # 1ディレクトリのファイル数が増えすぎないよう先頭2文字で分ける
+        return os.path.join(self.directory, key[:2], f"{key}.json")
+
+    def load(self, key: str) -> Optional[LLMResponse]:
+        """記録済みの応答（なければ None）"""
+        try:
+            with open(self._path(key), encoding="utf-8") as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None
+        return LLMResponse(record["text"], record.get("prompt_tokens", 0), record.get("output_tokens", 0))
+
+    def save(self, key: str, model: str, prompt: str, generation_config: Optional[Dict], response: LLMResponse):
+        """応答を記録（一時ファイルに書いてから置き換えるため、並行して書いても壊れない）"""
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        record = {
+            "model": model,
+            "prompt": prompt,
+            "generation_config": generation_config,
+            "text": response.text,
+            "prompt_tokens": response.prompt_tokens,
+            "output_tokens": response.output_tokens,
+            "recorded_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }
+        temp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(temp_path, "w", encoding="utf-8") as f:
+            json.dump(record, f, ensure_ascii=False, indent=2, default=str)
+        os.replace(temp_path, path)
+
+
+class LLMClient:
+    """レート制限・同時実行数制御・リトライ付きのLLMクライアント
+
+    recorder を指定すると、記録済みの応答はレート制限や同時実行数の待ちなしで再生する。
+    """
+
+    def __init__(self, backend, requests_per_minute: float = 60, burst: Optional[float] = None,
+                 max_concurrency: int = 4, max_retries: int = 3, base_delay: float = 1.0,
+                 max_delay: float = 30.0, timeout: Optional[float] = 60.0,
+                 queue_timeout: Optional[float] = 120.0, recorder: Optional[ResponseRecorder] = None):
+        self.backend = backend
+        self.model_name = getattr(backend, "model_name", "unknown")
+        self.rate_limiter = TokenBucket(requests_per_minute / 60.0, burst) if requests_per_minute else None
+        self.semaphore = threading.BoundedSemaphore(max_concurrency)
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.timeout = timeout
+        self.queue_timeout = queue_timeout
+        self.recorder = recorder if recorder is not None and recorder.mode != REPLAY_PASSTHROUGH else None
+        self.metrics = LLMMetrics()
+
+    def _backoff_delay(self, attempt: int) -> float:
+        """指数バックオフ（フルジッター）"""
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def generate(self, prompt: str, generation_config: Optional[Dict] = None,
+                 timeout: Optional[float] = None) -> LLMResponse:
+        """テキスト生成（失敗時は LLMError を送出）"""
+        timeout = timeout if timeout is not None else self.timeout
+        self.metrics.increment("requests")
+
+        if self.recorder is None:
+            return self._generate(prompt, generation_config, timeout)
+
+        model = f"{getattr(self.backend, 'name', type(self.backend).__name__)}:{self.model_name}"
+        key = self.recorder.make_key(model, prompt, generation_config)
+        response = self.recorder.load(key)
+        if response is not None:
+            self.metrics.increment("replay_hits")
+            self.metrics.increment("successes")
+            return response
+
+        self.metrics.increment("replay_misses")
+        if self.recorder.mode == REPLAY_ONLY:
+            self.metrics.increment("failures")
+            raise LLMError(f"記録済みの応答がありません（キー: {key[:12]}）。record モードで記録してください")
+
+        response = self._generate(prompt, generation_config, timeout)
+        self.recorder.save(key, model, prompt, generation_config, response)
+        self.metrics.increment("recorded")
+        return response
+
+    def _generate(self, prompt: str, generation_config: Optional[Dict], timeout: Optional[float]) -> LLMResponse:
+        """バックエンドを呼び出す（同時実行数・レート制限・リトライ）"""
+        # 同時実行数の上限（待ち行列が詰まった場合は諦める）
+        if not self.semaphore.acquire(timeout=self.queue_timeout):
+            self.metrics.increment("failures")
+            raise LLMError(f"LLM呼び出しの待機が {self.queue_timeout}秒 を超えました")
+
+        self.metrics.increment("in_flight")
+        try:
+            last_error = None
+            for attempt in range(self.max_retries + 1):
+                if self.rate_limiter and not self.rate_limiter.acquire(timeout=self.queue_timeout):
+                    self.metrics.increment("rate_limited")
+                    last_error = LLMError("レート制限の待機がタイムアウトしました")
+                    break
+
+                start_time = time.monotonic()
+                try:
+                    response = self.backend.generate(prompt, generation_config=generation_config, timeout=timeout)
+                except Exception as e:
+                    last_error = e
+                    if isinstance(e, TimeoutError) or "Timeout" in type(e).__name__:
+                        self.metrics.increment("timeouts")
+                    if attempt < self.max_retries and is_retryable_error(e):
+                        self.metrics.increment("retries")
+                        time.sleep(self._backoff_delay(attempt))
+                        continue
+                    break
+
+                self.metrics.record_latency(time.monotonic() - start_time)
+                self.metrics.increment("successes")
+                self.metrics.increment("prompt_tokens", response.prompt_tokens)
+                self.metrics.increment("output_tokens", response.output_tokens)
+                return response
+
+            self._raise_failure(last_error)
+        finally:
+            self.metrics.increment("in_flight", -1)
+            self.semaphore.release()
+
+    def _raise_failure(self, last_error: Exception):
+        self.metrics.increment("failures")
+        if isinstance(last_error, LLMError):
+            raise last_error
+        if isinstance(last_error, TimeoutError):
+            raise LLMTimeoutError(f"LLM呼び出しがタイムアウトしました: {last_error}") from last_error
+        raise LLMError(f"LLM呼び出しに失敗しました: {last_error}") from last_error
+
+    def stream(self, prompt: str, generation_config: Optional[Dict] = None,
+               timeout: Optional[float] = None) -> Iterator[str]:
+        """ストリーミングでテキスト生成（チャンクを順に返す。close すると残りの生成を打ち切る）
+
+        失敗時のリトライは最初のチャンクを受け取る前のみ。stream に対応していないバックエンドは
+        一括生成した結果を1チャンクで返す。記録・再生ではストリーミングの呼び出しを別のキーで保存する。
+        """
+        timeout = timeout if timeout is not None else self.timeout
+        self.metrics.increment("requests")
+
+        key = model = None
+        config = dict(generation_config or {}, stream=True)
+        if self.recorder is not None:
+            model = f"{getattr(self.backend, 'name', type(self.backend).__name__)}:{self.model_name}"
+            key = self.recorder.make_key(model, prompt, config)
+            response = self.recorder.load(key)
+            if response is not None:
+                self.metrics.increment("replay_hits")
+                self.metrics.increment("successes")
+                yield response.text
+                return
+
+            self.metrics.increment("replay_misses")
+            if self.recorder.mode == REPLAY_ONLY:
+                self.metrics.increment("failures")
+                raise LLMError(f"記録済みの応答がありません（キー: {key[:12]}）。record モードで記録してください")
+
+        chunks = []
+        finished = False
+        inner = self._stream(prompt, generation_config, timeout)
+        try:
+            for chunk in inner:
+                chunks.append(chunk)
+                yield chunk
+            finished = True
+        except GeneratorExit:
+            # 呼び出し側が打ち切った（同じ条件なら同じ位置で打ち切るため、ここまでを記録する）
+            self.metrics.increment("streams_cancelled")
+            finished = True
+            raise
+        finally:
+            inner.close()
+            if finished and key is not None and chunks:
+                text = "".join(chunks)
+                self.recorder.save(key, model, prompt, config,
+                                   LLMResponse(text, estimate_tokens(prompt), estimate_tokens(text)))
+                self.metrics.increment("recorded")
+
+    def _stream(self, prompt: str, generation_config: Optional[Dict], timeout: Optional[float]) -> Iterator[str]:
+        """バックエンドのストリームを呼び出す（同時実行数・レート制限・最初のチャンクまでのリトライ）"""
+        if not hasattr(self.backend, "stream"):
+            yield self._generate(prompt, generation_config, timeout).text
+            return
+
+        if not self.semaphore.acquire(timeout=self.queue_timeout):
+            self.metrics.increment("failures")
+            raise LLMError(f"LLM呼び出しの待機が {self.queue_timeout}秒 を超えました")
+
+        self.metrics.increment("in_flight")
+        output = []
+        start_time = time.monotonic()
+
+        def record_success():
+            self.metrics.record_latency(time.monotonic() - start_time)
+            self.metrics.increment("successes")
+            self.metrics.increment("prompt_tokens", estimate_tokens(prompt))
+            self.metrics.increment("output_tokens", estimate_tokens("".join(output)))
+
+        try:
+            last_error = None
+            for attempt in range(self.max_retries + 1):
+                if self.rate_limiter and not self.rate_limiter.acquire(timeout=self.queue_timeout):
+                    self.metrics.increment("rate_limited")
+                    last_error = LLMError("レート制限の待機がタイムアウトしました")
+                    break
+
+                start_time = time.monotonic()
+                backend_stream = self.backend.stream(prompt, generation_config=generation_config, timeout=timeout)
+                try:
+                    for chunk in backend_stream:
+                        output.append(chunk)
+                        yield chunk
+                except GeneratorExit:
+                    record_success()
+                    raise
+                except Exception as e:
+                    last_error = e
+                    if isinstance(e, TimeoutError) or "Timeout" in type(e).__name__:
+                        self.metrics.increment("timeouts")
+                    # 途中まで返したあとはやり直せない
+                    if not output and attempt < self.max_retries and is_retryable_error(e):
+                        self.metrics.increment("retries")
+                        time.sleep(self._backoff_delay(attempt))
+                        continue
+                    break
+                finally:
+                    backend_stream.close()
+
+                record_success()
+                return
+
+            self._raise_failure(last_error)
+        finally:
+            self.metrics.increment("in_flight", -1)
+            self.semaphore.release()
+
+    def get_metrics(self) -> Dict:
+        """メトリクスを取得"""
+        stats = self.metrics.snapshot()
+        stats["backend"] = getattr(self.backend, "name", type(self.backend).__name__)
+        stats["model"] = self.model_name
+        stats["replay_mode"] = self.recorder.mode if self.recorder else REPLAY_PASSTHROUGH
+        return stats
+
+
+def get_backend_name() -> str:
+    """環境変数 LLM_BACKEND からバックエンド名を取得（デフォルト: gemini）"""
+    return os.getenv('LLM_BACKEND', 'gemini').lower()
+
+
+def create_recorder(mode: Optional[str] = None, directory: Optional[str] = None) -> Optional[ResponseRecorder]:
+    """環境変数 LLM_REPLAY_MODE（passthrough / record / replay）と LLM_REPLAY_DIR から応答の記録・再生を設定"""
+    mode = (mode or os.getenv('LLM_REPLAY_MODE', REPLAY_PASSTHROUGH)).lower()
+    if mode == REPLAY_PASSTHROUGH:
+        return None
+    return ResponseRecorder(directory or os.getenv('LLM_REPLAY_DIR', DEFAULT_RECORDINGS_DIR), mode)
+
+
+def create_llm_client(model_name: Optional[str] = None, backend: Optional[str] = None,
+                      **kwargs) -> LLMClient:
+    """環境変数の設定からLLMクライアントを作成"""
+    backend = (backend or get_backend_name()).lower()
+    if backend not in BACKENDS:
+        raise ValueError(f"未対応のLLMバックエンドです: {backend}")
+
+    # 呼び出し側が指定したGeminiのモデル名はローカルバックエンドでは使わない
+    if backend == "ollama" and (not model_name or model_name.startswith("gemini")):
+        model_name = os.getenv('OLLAMA_MODEL', 'llama3.2')
+    elif backend == "stub":
+        model_name = "stub"
+
+    settings = {
+        "requests_per_minute": float(os.getenv('LLM_REQUESTS_PER_MINUTE', 60)),
+        "max_concurrency": int(os.getenv('LLM_MAX_CONCURRENCY', 4)),
+        "max_retries": int(os.getenv('LLM_MAX_RETRIES', 3)),
+        "timeout": float(os.getenv('LLM_TIMEOUT', 60)),
+        "recorder": create_recorder(),
+    }
+    settings.update(kwargs)
+
+    return LLMClient(BACKENDS[backend](model_name or "gemini-pro"), **settings)
+
+
+_shared_clients = {}
+_shared_lock = threading.Lock()
+
+
+def get_llm_client(model_name: Optional[str] = None, backend: Optional[str] = None) -> LLMClient:
+    """プロセス内で共有されるLLMクライアントを取得（レート制限と同時実行数を全モジュールで共有）"""
+    key = ((backend or get_backend_name()).lower(), model_name)
+    with _shared_lock:
+        if key not in _shared_clients:
+            _shared_clients[key] = create_llm_client(model_name, backend)
+        return _shared_clients[key]
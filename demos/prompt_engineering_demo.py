@@ -4,15 +4,23 @@ LLMの基礎デモ：プロンプトエンジニアリング
 """
 
 import os
+import sys
+from pathlib import Path
+
+# プロジェクトルートをPythonパスに追加
+project_root = Path(__file__).parent.parent
+sys.path.append(str(project_root))
+
 from dotenv import load_dotenv
-import google.generativeai as genai
+
+from common.llm_client import get_backend_name, get_llm_client
 
 # 環境変数読み込み
 load_dotenv()
 
-# Google Gemini APIの設定
-genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
-model = genai.GenerativeModel('gemini-pro')
+def get_model():
+    """共有LLMクライアントを取得（import時には接続しない）"""
+    return get_llm_client('gemini-pro')
 
 def demo_prompt_engineering():
     """プロンプトエンジニアリングのデモ"""
@@ -72,7 +80,7 @@ def demo_prompt_engineering():
         print("-" * 40)
         
         try:
-            response = model.generate_content(prompt)
+            response = get_model().generate(prompt)
             print(f"出力:\n{response.text}")
         except Exception as e:
             print(f"エラー: {e}")
@@ -92,15 +100,15 @@ def compare_temperature_settings():
         print(f"\nTemperature: {temp}")
         print("-" * 30)
         
-        # Geminiの場合、generation_configを使用
-        generation_config = genai.types.GenerationConfig(
-            temperature=temp,
-            max_output_tokens=200
-        )
+        # generation_configで生成設定を指定（バックエンド共通の辞書形式）
+        generation_config = {
+            "temperature": temp,
+            "max_output_tokens": 200
+        }
         
         for i in range(3):  # 3回生成して違いを確認
             try:
-                response = model.generate_content(
+                response = get_model().generate(
                     prompt,
                     generation_config=generation_config
                 )
@@ -154,7 +162,7 @@ def few_shot_learning_demo():
         print("-" * 40)
         
         try:
-            response = model.generate_content(prompt)
+            response = get_model().generate(prompt)
             print(f"出力: {response.text}")
         except Exception as e:
             print(f"エラー: {e}")
@@ -190,7 +198,7 @@ def chain_of_thought_demo():
         print("-" * 40)
         
         try:
-            response = model.generate_content(prompt)
+            response = get_model().generate(prompt)
             print(f"出力:\n{response.text}")
         except Exception as e:
             print(f"エラー: {e}")
@@ -200,7 +208,7 @@ def chain_of_thought_demo():
 def main():
     """メイン実行関数"""
     
-    if not os.getenv('GOOGLE_API_KEY'):
+    if get_backend_name() == "gemini" and not os.getenv('GOOGLE_API_KEY'):
         print("ERROR: GOOGLE_API_KEYが設定されていません。")
         print(".envファイルを確認してください。")
         return
@@ -214,6 +222,7 @@ def main():
     few_shot_learning_demo()
     chain_of_thought_demo()
     
+    print(f"\nLLM呼び出し統計: {get_model().get_metrics()}")
     print("\nデモ完了！")
     print("プロンプトの書き方によって出力が大きく変わることが確認できました。")
 
@@ -0,0 +1,141 @@
+"""
+文書セントロイドインデックス：2段階（粗→細）検索の1段目
+文書（source）ごとにチャンク埋め込みの平均ベクトルを保持し、質問に近い文書を絞り込む
+"""
+
+from typing import Dict, List
+
+import numpy as np
+
+
+def _normalize(vectors: np.ndarray) -> np.ndarray:
+    """L2正規化"""
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def _centroid(source: str, total: np.ndarray, count: int):
+    """チャンク埋め込みの合計から、保存するセントロイド（正規化済み）とメタデータを作る"""
+    mean = total / count
+    return _normalize(mean).tolist(), {"source": source, "chunk_count": count,
+                                       "mean_norm": float(np.linalg.norm(mean))}
+
+
+class CentroidIndex:
+    """source単位のセントロイド埋め込みを保持するインデックス
+
+    セントロイドは平均ベクトルを正規化して保存し、正規化前の平均ベクトルのノルムを mean_norm に記録する
+    （追加分との加重平均は正規化前の平均で行うため、差分更新しても rebuild と同じ結果になる）。
+    """
+
+    def __init__(self, collection):
+        self.collection = collection
+
+    def update(self, sources: List[str], embeddings) -> int:
+        """チャンクの埋め込みからセントロイドを更新（既存のセントロイドの平均とチャンク数で加重平均）"""
+        embeddings = _normalize(np.asarray(embeddings, dtype=np.float32))
+
+        groups: Dict[str, List[int]] = {}
+        for i, source in enumerate(sources):
+            groups.setdefault(source, []).append(i)
+
+        if not groups:
+            return 0
+
+        unique_sources = list(groups)
+        existing = self.collection.get(ids=unique_sources, include=["embeddings", "metadatas"])
+        previous = {}
+        if existing["ids"]:
+            for source_id, embedding, metadata in zip(
+                existing["ids"], existing["embeddings"], existing["metadatas"]
+            ):
+                # mean_norm のない古いセントロイドはノルム1の平均として扱う
+                mean = np.asarray(embedding, dtype=np.float32) * metadata.get('mean_norm', 1.0)
+                previous[source_id] = (mean, metadata.get('chunk_count', 0))
+
+        centroids, metadatas = [], []
+        for source in unique_sources:
+            indices = groups[source]
+            total = embeddings[indices].sum(axis=0)
+            count = len(indices)
+
+            if source in previous:
+                old_mean, old_count = previous[source]
+                total = total + old_mean * old_count
+                count += old_count
+
+            centroid, metadata = _centroid(source, total, count)
+            centroids.append(centroid)
+            metadatas.append(metadata)
+
+        self.collection.upsert(ids=unique_sources, embeddings=centroids, metadatas=metadatas)
+        return len(unique_sources)
+
+    def rebuild(self, chunk_collection, page_size: int = 5000) -> int:
+        """チャンクコレクション全体からセントロイドを作り直す"""
+        existing = self.collection.get(include=[])
+        if existing["ids"]:
+            self.collection.delete(ids=existing["ids"])
+
+        sums: Dict[str, np.ndarray] = {}
+        counts: Dict[str, int] = {}
+        total = chunk_collection.count()
+        for offset in range(0, total, page_size):
+            page = chunk_collection.get(include=["embeddings", "metadatas"], limit=page_size, offset=offset)
+            embeddings = _normalize(np.asarray(page["embeddings"], dtype=np.float32))
+            for embedding, metadata in zip(embeddings, page["metadatas"]):
+                source = metadata['source']
+                sums[source] = sums.get(source, 0) + embedding
+                counts[source] = counts.get(source, 0) + 1
+
+        if sums:
+            sources = list(sums)
+            entries = [_centroid(s, sums[s], counts[s]) for s in sources]
+            self.collection.upsert(
+                ids=sources,
+                embeddings=[centroid for centroid, _ in entries],
+                metadatas=[metadata for _, metadata in entries]
+            )
+        return len(sums)
+
+    def refresh(self, chunk_collection, sources: List[str]) -> int:
+        """指定した文書（source）のセントロイドだけをチャンクから作り直す（チャンクが更新・削除された文書用）"""
+        sources = list(dict.fromkeys(sources))
+        if not sources:
+            return 0
+
+        page = chunk_collection.get(where={"source": {"$in": sources}}, include=["embeddings", "metadatas"])
+        sums: Dict[str, np.ndarray] = {}
+        counts: Dict[str, int] = {}
+        if page["ids"]:
+            embeddings = _normalize(np.asarray(page["embeddings"], dtype=np.float32))
+            for embedding, metadata in zip(embeddings, page["metadatas"]):
+                source = metadata['source']
+                sums[source] = sums.get(source, 0) + embedding
+                counts[source] = counts.get(source, 0) + 1
+
+        # チャンクがなくなった文書はセントロイドも削除
+        removed = [s for s in sources if s not in sums]
+        if removed:
+            self.collection.delete(ids=removed)
+        if sums:
+            entries = [_centroid(s, sums[s], counts[s]) for s in sums]
+            self.collection.upsert(
+                ids=list(sums),
+                embeddings=[centroid for centroid, _ in entries],
+                metadatas=[metadata for _, metadata in entries]
+            )
+        return len(sources)
+
+    def select_sources(self, query_embedding: List[float], top_n: int = 3) -> List[str]:
+        """質問に近い上位top_n件の文書（source）を選択"""
+        count = self.collection.count()
+        if count == 0:
+            return []
+
+        results = self.collection.query(
+            query_embeddings=[query_embedding],
+            n_results=min(top_n, count),
+            include=["metadatas"]
+        )
+        return [metadata['source'] for metadata in results['metadatas'][0]]
@@ -0,0 +1,134 @@
+"""
+取り込み時の重複チャンク除去（MinHash + LSH）
+Webページの定型文やPDFのヘッダー・フッターなど、ほぼ同じ内容のチャンクを検出する
+"""
+
+import re
+import sys
+import zlib
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# 31ビットのメルセンヌ素数（uint64 の範囲で a * x + b がオーバーフローしない）
+MERSENNE_PRIME = (1 << 31) - 1
+
+
+def shingles(text: str, size: int = 5) -> List[str]:
+    """空白を正規化した文字n-gram（日本語は単語区切りがないため文字単位）"""
+    normalized = re.sub(r"\s+", " ", text).strip().lower()
+    if len(normalized) <= size:
+        return [normalized] if normalized else []
+    return [normalized[i:i + size] for i in range(len(normalized) - size + 1)]
+
+
+class MinHasher:
+    """MinHashシグネチャの計算"""
+
+    def __init__(self, num_perm: int = 128, shingle_size: int = 5, seed: int = 42):
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        rng = np.random.RandomState(seed)
+        self.a = rng.randint(1, MERSENNE_PRIME, size=(num_perm, 1)).astype(np.uint64)
+        self.b = rng.randint(0, MERSENNE_PRIME, size=(num_perm, 1)).astype(np.uint64)
+
+    def signature(self, text: str) -> np.ndarray:
+        """テキストのMinHashシグネチャ（num_perm 個の最小ハッシュ値）"""
+        tokens = set(shingles(text, self.shingle_size))
+        if not tokens:
+            return np.full(self.num_perm, MERSENNE_PRIME, dtype=np.uint64)
+
+        hashes = np.fromiter(
+            (zlib.crc32(token.encode('utf-8')) & MERSENNE_PRIME for token in tokens),
+            dtype=np.uint64,
+            count=len(tokens)
+        )
+        permuted = (self.a * hashes[np.newaxis, :] + self.b) % MERSENNE_PRIME
+        return permuted.min(axis=1)
+
+
+def estimate_jaccard(signature_a: np.ndarray, signature_b: np.ndarray) -> float:
+    """MinHashシグネチャからJaccard類似度を推定"""
+    return float(np.mean(signature_a == signature_b))
+
+
+class NearDuplicateIndex:
+    """LSH（バンド分割）による近似重複チャンクのインデックス"""
+
+    def __init__(self, threshold: float = 0.85, num_perm: int = 128, bands: int = 32,
+                 shingle_size: int = 5):
+        if num_perm % bands != 0:
+            raise ValueError("num_perm は bands で割り切れる必要があります")
+
+        self.threshold = threshold
+        self.bands = bands
+        self.rows = num_perm // bands
+        self.hasher = MinHasher(num_perm, shingle_size)
+        self.buckets: List[Dict[bytes, List[str]]] = [{} for _ in range(bands)]
+        self.signatures: Dict[str, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self.signatures)
+
+    def memory_bytes(self) -> int:
+        """シグネチャとバケットのおおよそのメモリ使用量（バイト）"""
+        total = sys.getsizeof(self.signatures)
+        for key, signature in self.signatures.items():
+            total += sys.getsizeof(key) + signature.nbytes
+        for buckets in self.buckets:
+            total += sys.getsizeof(buckets)
+            for band_key, keys in buckets.items():
+                total += sys.getsizeof(band_key) + sys.getsizeof(keys)
+        return total
+
+    def _band_keys(self, signature: np.ndarray) -> List[bytes]:
+        return [signature[i * self.rows:(i + 1) * self.rows].tobytes() for i in range(self.bands)]
+
+    def find_duplicate(self, text: str) -> Optional[str]:
+        """閾値以上に類似した既存チャンクのキーを返す（なければ None）"""
+        signature = self.hasher.signature(text)
+        return self._find(signature, self._band_keys(signature))
+
+    def _find(self, signature: np.ndarray, band_keys: List[bytes]) -> Optional[str]:
+        checked = set()
+        for band, band_key in enumerate(band_keys):
+            for candidate in self.buckets[band].get(band_key, []):
+                if candidate in checked:
+                    continue
+                checked.add(candidate)
+                if estimate_jaccard(signature, self.signatures[candidate]) >= self.threshold:
+                    return candidate
+        return None
+
+    def insert(self, key: str, text: str):
+        """チャンクをインデックスに登録"""
+        signature = self.hasher.signature(text)
+        self._insert(key, signature, self._band_keys(signature))
+
+    def _insert(self, key: str, signature: np.ndarray, band_keys: List[bytes]):
+        self.signatures[key] = signature
+        for band, band_key in enumerate(band_keys):
+            self.buckets[band].setdefault(band_key, []).append(key)
+
+    def remove(self, key: str) -> bool:
+        """チャンクをインデックスから削除（保存に失敗したチャンクの取り消しなど）"""
+        signature = self.signatures.pop(key, None)
+        if signature is None:
+            return False
+        for band, band_key in enumerate(self._band_keys(signature)):
+            keys = self.buckets[band].get(band_key, [])
+            if key in keys:
+                keys.remove(key)
+            if not keys:
+                self.buckets[band].pop(band_key, None)
+        return True
+
+    def add(self, key: str, text: str) -> Optional[str]:
+        """重複していれば正規（最初に登録された）チャンクのキーを返し、重複していなければ登録して None を返す"""
+        signature = self.hasher.signature(text)
+        band_keys = self._band_keys(signature)
+
+        canonical = self._find(signature, band_keys)
+        if canonical is None:
+            self._insert(key, signature, band_keys)
+        return canonical
@@ -0,0 +1,165 @@
+"""
+埋め込みベクトルの次元削減（PCA / ランダム射影）
+コーパスのサンプルで変換を学習し、チャンクと質問の両方の埋め込みに同じ変換を適用する
+（インデックスのメモリ削減と検索の高速化。削減後の次元ごとの recall@k で品質を確認する）
+"""
+
+import hashlib
+import os
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from evaluation import recall_at_k
+from hnsw_tuning import exact_top_k
+
+PROJECTION_METHODS = ("pca", "random")
+
+
+class EmbeddingProjection:
+    """埋め込みベクトルを低次元に写す線形変換（x - mean) @ components"""
+
+    def __init__(self, method: str, mean: np.ndarray, components: np.ndarray,
+                 explained_variance: Optional[float] = None):
+        self.method = method
+        self.mean = np.asarray(mean, dtype=np.float32)
+        self.components = np.asarray(components, dtype=np.float32)
+        self.explained_variance = explained_variance
+
+    @property
+    def input_dim(self) -> int:
+        return self.components.shape[0]
+
+    @property
+    def output_dim(self) -> int:
+        return self.components.shape[1]
+
+    @property
+    def label(self) -> str:
+        """コレクションのメタデータに記録する識別子（例: "pca:128"）"""
+        return f"{self.method}:{self.output_dim}"
+
+    @property
+    def fingerprint(self) -> str:
+        """変換行列のハッシュ（同じラベルでも学習したサンプルが違えば異なる。ベクトル空間の一致の確認用）"""
+        digest = hashlib.sha256(self.method.encode('utf-8'))
+        digest.update(np.ascontiguousarray(self.mean, dtype='<f4').tobytes())
+        digest.update(np.ascontiguousarray(self.components, dtype='<f4').tobytes())
+        return digest.hexdigest()[:32]
+
+    @classmethod
+    def fit(cls, embeddings, dim: int, method: str = "pca", seed: int = 0) -> "EmbeddingProjection":
+        """サンプルの埋め込みから変換を学習
+
+        pca: 中心化したサンプルの特異値分解で分散の大きい dim 方向を選ぶ
+        random: ガウス乱数の射影行列（学習不要、Johnson-Lindenstrauss の補題により距離をおおよそ保つ）
+        """
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        input_dim = embeddings.shape[1]
+        if method not in PROJECTION_METHODS:
+            raise ValueError(f"未対応の次元削減方法です: {method}（{', '.join(PROJECTION_METHODS)} のいずれか）")
+        if not 0 < dim < input_dim:
+            raise ValueError(f"削減後の次元数は 1 〜 {input_dim - 1} で指定してください: {dim}")
+
+        if method == "random":
+            rng = np.random.default_rng(seed)
+            components = rng.standard_normal((input_dim, dim)).astype(np.float32) / np.sqrt(dim)
+            return cls(method, np.zeros(input_dim, dtype=np.float32), components)
+
+        if len(embeddings) < dim:
+            raise ValueError(f"PCAには削減後の次元数（{dim}）以上のサンプルが必要です（{len(embeddings)}件）")
+        mean = embeddings.mean(axis=0)
+        _, singular_values, vt = np.linalg.svd(embeddings - mean, full_matrices=False)
+        variance = singular_values ** 2
+        explained = float(variance[:dim].sum() / max(variance.sum(), 1e-12))
+        return cls(method, mean, vt[:dim].T, explained)
+
+    def transform(self, embeddings) -> np.ndarray:
+        """埋め込みを変換（1件のベクトルでも複数件の行列でも可）"""
+        return (np.asarray(embeddings, dtype=np.float32) - self.mean) @ self.components
+
+    def save(self, path: str):
+        """変換を .npz ファイルに保存（一時ファイルに書いてから置き換え）"""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        temp_path = f"{path}.tmp.npz"
+        np.savez(
+            temp_path,
+            method=np.array(self.method),
+            mean=self.mean,
+            components=self.components,
+            explained_variance=np.array(np.nan if self.explained_variance is None else self.explained_variance)
+        )
+        os.replace(temp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "EmbeddingProjection":
+        with np.load(path) as data:
+            explained = float(data["explained_variance"])
+            return cls(str(data["method"]), data["mean"], data["components"],
+                       None if np.isnan(explained) else explained)
+
+
+class ProjectedEmbeddingModel:
+    """埋め込みモデルの出力に次元削減を適用するラッパー（SentenceTransformer と同じ encode インターフェース）"""
+
+    def __init__(self, model, projection: EmbeddingProjection):
+        self.model = model
+        self.projection = projection
+
+    def encode(self, sentences, **kwargs) -> np.ndarray:
+        return self.projection.transform(self.model.encode(sentences, **kwargs))
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.projection.output_dim
+
+
+def evaluate_dimensions(corpus, queries, dims: List[int], k: int = 5, method: str = "pca",
+                        verbose: bool = True) -> Dict:
+    """削減後の次元ごとに、元の次元での厳密検索に対する recall@k を測定
+
+    変換はコーパスで学習し、質問には同じ変換を適用する（本番と同じ条件）。
+    """
+    corpus = np.asarray(corpus, dtype=np.float32)
+    queries = np.asarray(queries, dtype=np.float32)
+    k = min(k, len(corpus))
+    truth = exact_top_k(corpus, queries, k)
+    full_dim = corpus.shape[1]
+
+    results = []
+    for dim in sorted(dims):
+        if dim >= full_dim:
+            continue
+        projection = EmbeddingProjection.fit(corpus, dim, method)
+        projected_corpus = projection.transform(corpus)
+        projected_queries = projection.transform(queries)
+
+        start_time = time.perf_counter()
+        found = exact_top_k(projected_corpus, projected_queries, k)
+        search_time = time.perf_counter() - start_time
+
+        recall = sum(recall_at_k(f, t) for f, t in zip(found, truth)) / len(truth)
+        result = {
+            "dim": dim,
+            "recall": recall,
+            "bytes_per_vector": dim * 4,
+            "memory_ratio": dim / full_dim,
+            "search_ms": search_time / len(queries) * 1000,
+            "explained_variance": projection.explained_variance,
+        }
+        results.append(result)
+
+        if verbose:
+            explained = (f" 分散説明率={result['explained_variance']:.3f}"
+                         if result["explained_variance"] is not None else "")
+            print(f"{method} {dim:>4}次元: recall@{k}={recall:.3f} "
+                  f"メモリ {result['memory_ratio']:.0%}{explained}")
+
+    return {
+        "method": method,
+        "k": k,
+        "full_dim": full_dim,
+        "corpus_size": len(corpus),
+        "num_queries": len(queries),
+        "results": results,
+    }
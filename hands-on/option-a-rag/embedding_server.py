@@ -0,0 +1,283 @@
+"""
+共有埋め込みサーバー
+埋め込みモデルを1プロセスで1回だけ読み込み、Unixドメインソケット経由で encode を提供する
+（複数ワーカーでモデルのメモリと起動時間を共有するため。Unixドメインソケットが使えるOS向け）
+
+使い方:
+    python embedding_server.py --socket /tmp/rag_embedding.sock --model all-MiniLM-L6-v2
+
+通信形式（すべて little endian）:
+    リクエスト: MAGIC(4) | op(1) | 件数 uint32 | ペイロード長 uint32 | ペイロード
+        op "E": ペイロード = (uint32 の長さ + UTF-8 テキスト) の繰り返し
+        op "I": モデル情報の問い合わせ（ペイロードなし）
+    レスポンス: MAGIC(4) | status(1) | 行数 uint32 | 次元数 uint32 | ペイロード長 uint32 | ペイロード
+        status 0: ペイロード = float32 の (行数, 次元数) 連続配列（op "I" の場合は JSON）
+        status 1: ペイロード = UTF-8 のエラーメッセージ
+"""
+
+import argparse
+import json
+import os
+import queue
+import socket
+import socketserver
+import struct
+import threading
+from concurrent.futures import Future
+from typing import List, Optional
+
+import numpy as np
+
+MAGIC = b"EMB1"
+REQUEST_HEADER = struct.Struct('<4scII')
+RESPONSE_HEADER = struct.Struct('<4sBIII')
+LENGTH = struct.Struct('<I')
+
+OP_ENCODE = b"E"
+OP_INFO = b"I"
+STATUS_OK = 0
+STATUS_ERROR = 1
+
+DEFAULT_SOCKET_PATH = "/tmp/rag_embedding.sock"
+
+
+def _recv_exact(sock: socket.socket, size: int) -> bytes:
+    """指定バイト数を受信"""
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:], size - received)
+        if n == 0:
+            raise ConnectionError("接続が切断されました")
+        received += n
+    return bytes(buffer)
+
+
+def encode_texts(texts: List[str]) -> bytes:
+    """テキストリストを長さ付きバイト列に変換"""
+    parts = []
+    for text in texts:
+        data = text.encode('utf-8')
+        parts.append(LENGTH.pack(len(data)))
+        parts.append(data)
+    return b"".join(parts)
+
+
+def decode_texts(payload: bytes, count: int) -> List[str]:
+    """長さ付きバイト列からテキストリストを復元"""
+    texts = []
+    position = 0
+    for _ in range(count):
+        (length,) = LENGTH.unpack_from(payload, position)
+        position += LENGTH.size
+        texts.append(payload[position:position + length].decode('utf-8'))
+        position += length
+    return texts
+
+
+class EmbeddingBatcher:
+    """同時に届いたリクエストをまとめて1回の encode で処理する"""
+
+    def __init__(self, model, max_batch_size: int = 64, max_wait: float = 0.005):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.requests = queue.Queue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def submit(self, texts: List[str]) -> Future:
+        future = Future()
+        self.requests.put((texts, future))
+        return future
+
+    def _run(self):
+        while True:
+            batch = [self.requests.get()]
+            size = len(batch[0][0])
+
+            # 最大 max_wait 秒だけ後続のリクエストを待って結合
+            while size < self.max_batch_size:
+                try:
+                    item = self.requests.get(timeout=self.max_wait)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                size += len(item[0])
+
+            texts = [text for item_texts, _ in batch for text in item_texts]
+            try:
+                embeddings = np.asarray(self.model.encode(texts), dtype='<f4')
+            except Exception as e:
+                for _, future in batch:
+                    future.set_exception(e)
+                continue
+
+            position = 0
+            for item_texts, future in batch:
+                future.set_result(embeddings[position:position + len(item_texts)])
+                position += len(item_texts)
+
+
+class EmbeddingRequestHandler(socketserver.BaseRequestHandler):
+    """1接続で複数リクエストを順に処理"""
+
+    def handle(self):
+        while True:
+            try:
+                header = _recv_exact(self.request, REQUEST_HEADER.size)
+            except ConnectionError:
+                return
+
+            magic, op, count, payload_length = REQUEST_HEADER.unpack(header)
+            if magic != MAGIC:
+                return
+            payload = _recv_exact(self.request, payload_length)
+
+            try:
+                if op == OP_ENCODE:
+                    embeddings = self.server.batcher.submit(decode_texts(payload, count)).result()
+                    rows, dim = embeddings.shape if embeddings.ndim == 2 else (0, 0)
+                    body = np.ascontiguousarray(embeddings, dtype='<f4').tobytes()
+                elif op == OP_INFO:
+                    rows, dim = 0, self.server.dimension
+                    body = json.dumps({"model": self.server.model_name, "dim": self.server.dimension}).encode('utf-8')
+                else:
+                    raise ValueError(f"未対応の操作です: {op!r}")
+                status = STATUS_OK
+            except Exception as e:
+                rows, dim, status = 0, 0, STATUS_ERROR
+                body = str(e).encode('utf-8')
+
+            try:
+                self.request.sendall(RESPONSE_HEADER.pack(MAGIC, status, rows, dim, len(body)) + body)
+            except ConnectionError:
+                # クライアントがタイムアウトなどで先に接続を閉じた
+                return
+
+
+class EmbeddingServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    """埋め込みモデルを共有するUnixドメインソケットサーバー"""
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, socket_path: str = DEFAULT_SOCKET_PATH, model_name: str = 'all-MiniLM-L6-v2',
+                 model=None, max_batch_size: int = 64, max_wait: float = 0.005):
+        if model is None:
+            from sentence_transformers import SentenceTransformer
+
+            print(f"埋め込みモデル {model_name} を読み込み中...")
+            model = SentenceTransformer(model_name)
+
+        self.model_name = model_name
+        self.dimension = model.get_sentence_embedding_dimension()
+        self.batcher = EmbeddingBatcher(model, max_batch_size, max_wait)
+
+        if os.path.exists(socket_path):
+            os.unlink(socket_path)
+        super().__init__(socket_path, EmbeddingRequestHandler)
+        self.socket_path = socket_path
+
+    def server_close(self):
+        super().server_close()
+        if os.path.exists(self.socket_path):
+            os.unlink(self.socket_path)
+
+
+class RemoteEmbeddingModel:
+    """埋め込みサーバーのクライアント（SentenceTransformer と同じ encode インターフェース）"""
+
+    def __init__(self, socket_path: str = DEFAULT_SOCKET_PATH, timeout: Optional[float] = 60.0):
+        self.socket_path = socket_path
+        self.timeout = timeout
+        self.local = threading.local()
+
+        info = json.loads(self._request(OP_INFO, 0, b"").decode('utf-8'))
+        self.model_name = info["model"]
+        self.dimension = info["dim"]
+
+    def _connection(self) -> socket.socket:
+        """スレッドごとに接続を保持"""
+        sock = getattr(self.local, "sock", None)
+        if sock is None:
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(self.timeout)
+            sock.connect(self.socket_path)
+            self.local.sock = sock
+        return sock
+
+    def _request(self, op: bytes, count: int, payload: bytes, retry: bool = True):
+        sock = self._connection()
+        reconnect = retry
+        try:
+            sock.sendall(REQUEST_HEADER.pack(MAGIC, op, count, len(payload)) + payload)
+            magic, status, rows, dim, length = RESPONSE_HEADER.unpack(_recv_exact(sock, RESPONSE_HEADER.size))
+            if magic != MAGIC:
+                reconnect = False
+                raise ConnectionError("埋め込みサーバーの応答形式が不正です")
+            body = _recv_exact(sock, length)
+        except BaseException as e:
+            # タイムアウトや受信途中のエラーでは応答が読み残されている可能性があるため、接続は再利用しない
+            sock.close()
+            self.local.sock = None
+            # サーバー再起動などで切断された場合は1回だけ再接続
+            if reconnect and isinstance(e, ConnectionError):
+                return self._request(op, count, payload, retry=False)
+            raise
+
+        if status != STATUS_OK:
+            raise RuntimeError(f"埋め込みサーバーエラー: {body.decode('utf-8')}")
+        if op == OP_ENCODE:
+            return np.frombuffer(body, dtype='<f4').reshape(rows, dim)
+        return body
+
+    def encode(self, sentences, batch_size: Optional[int] = None, normalize_embeddings: bool = False,
+               convert_to_numpy: bool = True, show_progress_bar: bool = False) -> np.ndarray:
+        """テキストを埋め込みベクトルに変換
+
+        SentenceTransformer.encode の引数のうち batch_size（1リクエストの件数）と
+        normalize_embeddings（クライアント側でL2正規化）に対応する。結果は常に numpy 配列。
+        """
+        if not convert_to_numpy:
+            raise ValueError("RemoteEmbeddingModel は numpy 配列のみ返します（convert_to_numpy=False は未対応）")
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        if not texts:
+            return np.zeros((0, self.dimension), dtype=np.float32)
+
+        step = batch_size or len(texts)
+        embeddings = np.concatenate([
+            self._request(OP_ENCODE, len(texts[i:i + step]), encode_texts(texts[i:i + step]))
+            for i in range(0, len(texts), step)
+        ])
+        if normalize_embeddings:
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            embeddings = embeddings / np.where(norms == 0, 1.0, norms)
+        return embeddings[0] if single else embeddings
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.dimension
+
+
+def main():
+    """埋め込みサーバーの起動"""
+    parser = argparse.ArgumentParser(description="共有埋め込みサーバー")
+    parser.add_argument("--socket", default=os.getenv('EMBEDDING_SERVER_SOCKET', DEFAULT_SOCKET_PATH))
+    parser.add_argument("--model", default='all-MiniLM-L6-v2')
+    parser.add_argument("--max-batch-size", type=int, default=64)
+    args = parser.parse_args()
+
+    server = EmbeddingServer(args.socket, args.model, max_batch_size=args.max_batch_size)
+    print(f"🚀 埋め込みサーバー起動: {args.socket} (モデル: {args.model}, 次元: {server.dimension})")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\n埋め込みサーバーを終了します")
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
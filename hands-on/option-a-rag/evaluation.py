@@ -0,0 +1,30 @@
+"""
+検索評価のユーティリティ（recall@k とレイテンシ集計）
+"""
+
+from typing import Dict, List, Sequence
+
+
+def recall_at_k(retrieved_ids: Sequence[str], reference_ids: Sequence[str]) -> float:
+    """基準となる検索結果（正解）のうち、何割を取得できたか"""
+    if not reference_ids:
+        return 1.0
+    return len(set(retrieved_ids) & set(reference_ids)) / len(reference_ids)
+
+
+def percentile(values: List[float], p: float) -> float:
+    """パーセンタイル値（最近傍法）"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize_latencies(latencies: List[float]) -> Dict:
+    """レイテンシ（秒）の統計をミリ秒で集計"""
+    return {
+        "avg_ms": sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+    }
@@ -0,0 +1,201 @@
+"""
+HNSWパラメータの設定と自動チューニング
+サンプルの埋め込みで各設定のインデックスを作り、厳密検索に対する recall@k と検索レイテンシを測定して
+目標recallを満たす最も軽い設定を選ぶ
+
+使い方:
+    python hnsw_tuning.py --collection demo_collection --target-recall 0.95          # 推奨設定を表示
+    python hnsw_tuning.py --collection demo_collection --target-recall 0.95 --apply  # 推奨設定で作り直す
+"""
+
+import argparse
+import itertools
+import json
+import time
+from typing import Callable, Dict, List, Optional
+
+import chromadb
+import numpy as np
+
+from evaluation import percentile
+
+# ChromaDBのデフォルト値
+HNSW_DEFAULTS = {"M": 16, "construction_ef": 100, "search_ef": 10}
+
+DEFAULT_GRID = {
+    "M": [8, 16, 32],
+    "construction_ef": [100, 200],
+    "search_ef": [10, 20, 50, 100, 200],
+}
+
+
+def hnsw_metadata(space: str = "cosine", params: Optional[Dict] = None) -> Dict:
+    """HNSWパラメータをコレクションのメタデータ形式に変換"""
+    metadata = {"hnsw:space": space}
+    for key, value in (params or {}).items():
+        if key not in HNSW_DEFAULTS:
+            raise ValueError(f"未対応のHNSWパラメータです: {key}（{', '.join(HNSW_DEFAULTS)} のいずれか）")
+        metadata[f"hnsw:{key}"] = int(value)
+    return metadata
+
+
+def hnsw_params_from_metadata(metadata: Optional[Dict]) -> Dict:
+    """コレクションのメタデータから現在のHNSWパラメータを取得（未設定はデフォルト値）"""
+    metadata = metadata or {}
+    return {key: metadata.get(f"hnsw:{key}", default) for key, default in HNSW_DEFAULTS.items()}
+
+
+def exact_top_k(corpus: np.ndarray, queries: np.ndarray, k: int) -> List[List[int]]:
+    """コサイン類似度による厳密な上位k件（正解データ）"""
+    corpus = corpus / np.maximum(np.linalg.norm(corpus, axis=1, keepdims=True), 1e-12)
+    queries = queries / np.maximum(np.linalg.norm(queries, axis=1, keepdims=True), 1e-12)
+    scores = queries @ corpus.T
+    top = np.argpartition(-scores, min(k, len(corpus) - 1), axis=1)[:, :k]
+    order = np.take_along_axis(scores, top, axis=1).argsort(axis=1)[:, ::-1]
+    return np.take_along_axis(top, order, axis=1).tolist()
+
+
+def evaluate_hnsw_setting(client, corpus: np.ndarray, queries: np.ndarray, truth: List[List[int]],
+                          params: Dict, k: int, batch_size: int = 5000) -> Dict:
+    """1つのHNSW設定でインデックスを作り、recall@k と検索レイテンシを測定"""
+    name = "hnsw_tuning_{M}_{construction_ef}_{search_ef}".format(**params)
+    collection = client.create_collection(name=name, metadata=hnsw_metadata("cosine", params))
+
+    try:
+        start_time = time.perf_counter()
+        for start in range(0, len(corpus), batch_size):
+            end = min(start + batch_size, len(corpus))
+            collection.add(
+                ids=[str(i) for i in range(start, end)],
+                embeddings=corpus[start:end].tolist()
+            )
+        build_time = time.perf_counter() - start_time
+
+        latencies, recalls = [], []
+        for query, expected in zip(queries, truth):
+            start_time = time.perf_counter()
+            result = collection.query(query_embeddings=[query.tolist()], n_results=k, include=[])
+            latencies.append(time.perf_counter() - start_time)
+
+            found = {int(i) for i in result["ids"][0]}
+            recalls.append(len(found & set(expected)) / len(expected))
+    finally:
+        client.delete_collection(name)
+
+    return {
+        "params": params,
+        "recall": sum(recalls) / len(recalls),
+        "avg_ms": sum(latencies) / len(latencies) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "build_s": build_time,
+    }
+
+
+def auto_tune_hnsw(corpus: np.ndarray, queries: np.ndarray, k: int = 5, target_recall: float = 0.95,
+                   grid: Optional[Dict[str, List[int]]] = None, verbose: bool = True) -> Dict:
+    """パラメータの組み合わせを評価し、目標recallを満たす最も低レイテンシな設定を推奨"""
+    grid = grid or DEFAULT_GRID
+    corpus = np.asarray(corpus, dtype=np.float32)
+    queries = np.asarray(queries, dtype=np.float32)
+    k = min(k, len(corpus))
+    truth = exact_top_k(corpus, queries, k)
+
+    client = chromadb.EphemeralClient()
+    results = []
+    for m, construction_ef, search_ef in itertools.product(
+        grid.get("M", [HNSW_DEFAULTS["M"]]),
+        grid.get("construction_ef", [HNSW_DEFAULTS["construction_ef"]]),
+        grid.get("search_ef", [HNSW_DEFAULTS["search_ef"]])
+    ):
+        params = {"M": m, "construction_ef": construction_ef, "search_ef": search_ef}
+        result = evaluate_hnsw_setting(client, corpus, queries, truth, params, k)
+        results.append(result)
+
+        if verbose:
+            print(f"M={m:<3} ef_construction={construction_ef:<4} ef_search={search_ef:<4} "
+                  f"recall@{k}={result['recall']:.3f} 平均={result['avg_ms']:.2f}ms "
+                  f"p95={result['p95_ms']:.2f}ms 構築={result['build_s']:.2f}秒")
+
+    # 目標を満たす設定の中で、レイテンシ → M（メモリ）→ 構築コストの順に軽いものを選ぶ
+    candidates = [r for r in results if r["recall"] >= target_recall]
+    cost = lambda r: (r["avg_ms"], r["params"]["M"], r["params"]["construction_ef"])
+    recommended = min(candidates, key=cost) if candidates else max(results, key=lambda r: r["recall"])
+
+    return {
+        "k": k,
+        "target_recall": target_recall,
+        "corpus_size": len(corpus),
+        "num_queries": len(queries),
+        "met_target": bool(candidates),
+        "recommended": recommended,
+        "results": results,
+    }
+
+
+def copy_collection(source, target, page_size: int = 5000,
+                    transform: Optional[Callable[[np.ndarray], np.ndarray]] = None) -> int:
+    """コレクションのデータを別のコレクション（新しいHNSW設定で作成したものなど）にコピー
+
+    transform を指定すると、コピーする埋め込みに適用する（次元削減など）
+    """
+    total = source.count()
+    for offset in range(0, total, page_size):
+        page = source.get(
+            include=["embeddings", "documents", "metadatas"],
+            limit=page_size,
+            offset=offset
+        )
+        embeddings = np.asarray(page["embeddings"])
+        if transform is not None:
+            embeddings = transform(embeddings)
+        target.add(
+            ids=page["ids"],
+            embeddings=embeddings.tolist(),
+            documents=page["documents"],
+            metadatas=page["metadatas"]
+        )
+    return total
+
+
+def main():
+    """HNSW自動チューニングのコマンドライン"""
+    parser = argparse.ArgumentParser(description="コレクションのHNSWパラメータを自動チューニング")
+    parser.add_argument("--collection", default="workshop_docs")
+    parser.add_argument("--target-recall", type=float, default=0.95)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--sample-size", type=int, default=5000)
+    parser.add_argument("--num-queries", type=int, default=100)
+    parser.add_argument("--questions", help="評価に使う質問のJSON（文字列のリスト。省略時はサンプルの埋め込み）")
+    parser.add_argument("--grid", help="探索する設定のJSON（例: {\"M\": [8, 16], \"search_ef\": [10, 50]}）")
+    parser.add_argument("--apply", action="store_true", help="目標を満たした推奨設定でコレクションを作り直す")
+    parser.add_argument("--output", help="レポートの保存先（JSON）")
+    args = parser.parse_args()
+
+    from rag_system import RAGSystem
+
+    questions = None
+    if args.questions:
+        with open(args.questions, 'r', encoding='utf-8') as f:
+            questions = json.load(f)
+
+    rag = RAGSystem(args.collection)
+    report = rag.auto_tune_hnsw(
+        target_recall=args.target_recall,
+        top_k=args.top_k,
+        sample_size=args.sample_size,
+        num_queries=args.num_queries,
+        questions=questions,
+        grid=json.loads(args.grid) if args.grid else None,
+        apply=args.apply
+    )
+    if args.apply and report and not report["met_target"]:
+        print("目標recallを満たす設定がないため、コレクションは変更していません")
+
+    if args.output and report:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"レポートを保存しました: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,380 @@
+"""
+クラッシュしても再開できる取り込みジョブキュー（SQLite）
+作業単位（文書・ファイル・PDFのページ範囲）をキューに登録し、チャンクのバッチを保存するたびに
+チェックポイントを記録する。再起動時は最後にコミットしたバッチの続きから処理する。
+複数のワーカープロセスが同じキューから作業を取り出せる。
+
+ChromaDBのローカル保存先（PersistentClient）は複数プロセスからの同時書き込みに対応していないため、
+ローカル保存先に書き込むワーカーは保存先ごとに1プロセスに制限する（ロックファイルで確認）。
+複数プロセスで並行して取り込む場合は、全ワーカーの --chroma に同じChromaサーバーを指定する。
+
+使い方:
+    python ingest_queue.py enqueue --job docs ./sample_data/*.txt ./manual.pdf
+    python ingest_queue.py worker --collection batch_collection   # ローカル保存先（1プロセスのみ）
+    python ingest_queue.py worker --collection batch_collection --chroma http://localhost:8000   # 複数プロセスで起動可能
+    python ingest_queue.py status --job docs
+"""
+
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+from typing import Dict, List, Optional
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    name TEXT NOT NULL UNIQUE,
+    created_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS work_items (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id INTEGER NOT NULL REFERENCES jobs(id),
+    kind TEXT NOT NULL,
+    payload TEXT NOT NULL,
+    status TEXT NOT NULL DEFAULT 'pending',
+    checkpoint INTEGER NOT NULL DEFAULT 0,
+    total_chunks INTEGER,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    lease_expires REAL,
+    error TEXT,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_work_items_claim ON work_items(job_id, status, lease_expires);
+"""
+
+
+class IngestionQueue:
+    """SQLiteベースの取り込み作業キュー（WALモードで複数プロセスから利用可能）"""
+
+    def __init__(self, db_path: str = "./ingest_queue.db", lease_seconds: float = 300,
+                 max_attempts: int = 3):
+        self.db_path = db_path
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.lock = threading.Lock()
+
+        self.conn = sqlite3.connect(db_path, timeout=30, isolation_level=None, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def get_or_create_job(self, name: str) -> int:
+        """ジョブIDを取得（なければ作成）"""
+        with self.lock:
+            self.conn.execute(
+                "INSERT OR IGNORE INTO jobs (name, created_at) VALUES (?, ?)", (name, time.time())
+            )
+            row = self.conn.execute("SELECT id FROM jobs WHERE name = ?", (name,)).fetchone()
+            return row["id"]
+
+    def _enqueue(self, job_id: int, items: List[Dict]) -> int:
+        now = time.time()
+        with self.lock:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT INTO work_items (job_id, kind, payload, updated_at) VALUES (?, ?, ?, ?)",
+                [(job_id, item["kind"], json.dumps(item["payload"], ensure_ascii=False), now) for item in items]
+            )
+            self.conn.execute("COMMIT")
+        return len(items)
+
+    def enqueue_documents(self, job_id: int, documents: List[Dict[str, str]]) -> int:
+        """文書（content, source, type）を作業として登録"""
+        items = []
+        for i, doc in enumerate(documents):
+            items.append({"kind": "text", "payload": {
+                "content": doc['content'],
+                "source": doc.get('source', f'document_{i}'),
+                "type": doc.get('type', 'unknown')
+            }})
+        return self._enqueue(job_id, items)
+
+    def enqueue_files(self, job_id: int, paths: List[str], pages_per_item: int = 20) -> int:
+        """ファイルを作業として登録（PDFは pages_per_item ページごとに分割）"""
+        items = []
+        for path in paths:
+            source = os.path.basename(path)
+            if path.lower().endswith('.pdf'):
+                import PyPDF2
+
+                with open(path, 'rb') as file:
+                    num_pages = len(PyPDF2.PdfReader(file).pages)
+                for start in range(0, num_pages, pages_per_item):
+                    items.append({"kind": "pdf", "payload": {
+                        "path": path, "source": source, "type": "PDF",
+                        "start_page": start, "end_page": min(start + pages_per_item, num_pages)
+                    }})
+            else:
+                items.append({"kind": "text_file", "payload": {
+                    "path": path, "source": source, "type": "テキストファイル"
+                }})
+        return self._enqueue(job_id, items)
+
+    def claim(self, worker_id: str, job_id: Optional[int] = None) -> Optional[Dict]:
+        """未処理（またはリース切れ）の作業を1件取得"""
+        now = time.time()
+        with self.lock:
+            # BEGIN IMMEDIATE で書き込みロックを取り、複数ワーカーの取り合いを防ぐ
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                # 最後の試行でリースが切れた作業（ワーカーの異常終了など）は再試行せず失敗にする
+                self.conn.execute(
+                    """UPDATE work_items
+                       SET status = 'failed', error = COALESCE(error, 'リースが切れました（試行回数の上限に達しました）'),
+                           lease_expires = NULL, updated_at = ?
+                       WHERE (? IS NULL OR job_id = ?)
+                         AND status = 'in_progress' AND lease_expires < ? AND attempts >= ?""",
+                    (now, job_id, job_id, now, self.max_attempts)
+                )
+                row = self.conn.execute(
+                    """SELECT * FROM work_items
+                       WHERE (? IS NULL OR job_id = ?)
+                         AND (status = 'pending' OR (status = 'in_progress' AND lease_expires < ?))
+                         AND attempts < ?
+                       ORDER BY id LIMIT 1""",
+                    (job_id, job_id, now, self.max_attempts)
+                ).fetchone()
+                if row is None:
+                    self.conn.execute("COMMIT")
+                    return None
+
+                self.conn.execute(
+                    """UPDATE work_items
+                       SET status = 'in_progress', worker = ?, lease_expires = ?,
+                           attempts = attempts + 1, updated_at = ?
+                       WHERE id = ?""",
+                    (worker_id, now + self.lease_seconds, now, row["id"])
+                )
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+        item = dict(row)
+        item["payload"] = json.loads(item["payload"])
+        return item
+
+    def checkpoint(self, item_id: int, worker_id: str, next_chunk: int,
+                   total_chunks: Optional[int] = None) -> bool:
+        """保存済みチャンク数を記録してリースを延長（リースを失っていれば False）"""
+        now = time.time()
+        with self.lock:
+            cursor = self.conn.execute(
+                """UPDATE work_items
+                   SET checkpoint = ?, total_chunks = COALESCE(?, total_chunks),
+                       lease_expires = ?, updated_at = ?
+                   WHERE id = ? AND worker = ? AND status = 'in_progress'""",
+                (next_chunk, total_chunks, now + self.lease_seconds, now, item_id, worker_id)
+            )
+        return cursor.rowcount == 1
+
+    def complete(self, item_id: int, worker_id: str) -> bool:
+        """作業を完了にする"""
+        with self.lock:
+            cursor = self.conn.execute(
+                """UPDATE work_items SET status = 'done', lease_expires = NULL, updated_at = ?
+                   WHERE id = ? AND worker = ?""",
+                (time.time(), item_id, worker_id)
+            )
+        return cursor.rowcount == 1
+
+    def fail(self, item_id: int, worker_id: str, error: str):
+        """作業の失敗を記録（試行回数が上限未満なら再試行待ちに戻す）"""
+        with self.lock:
+            self.conn.execute(
+                """UPDATE work_items
+                   SET status = CASE WHEN attempts < ? THEN 'pending' ELSE 'failed' END,
+                       error = ?, lease_expires = NULL, updated_at = ?
+                   WHERE id = ? AND worker = ?""",
+                (self.max_attempts, error, time.time(), item_id, worker_id)
+            )
+
+    def job_status(self, job_id: Optional[int] = None) -> Dict:
+        """ステータスごとの作業数とチャンクの進捗"""
+        with self.lock:
+            rows = self.conn.execute(
+                """SELECT status, COUNT(*) AS items, SUM(checkpoint) AS chunks_done,
+                          SUM(total_chunks) AS chunks_total
+                   FROM work_items WHERE (? IS NULL OR job_id = ?) GROUP BY status""",
+                (job_id, job_id)
+            ).fetchall()
+
+        status = {"pending": 0, "in_progress": 0, "done": 0, "failed": 0, "chunks_done": 0, "chunks_total": 0}
+        for row in rows:
+            status[row["status"]] = row["items"]
+            status["chunks_done"] += row["chunks_done"] or 0
+            status["chunks_total"] += row["chunks_total"] or 0
+        return status
+
+
+def load_item_text(rag, item: Dict) -> str:
+    """作業単位のテキストを取得"""
+    payload = item["payload"]
+    if item["kind"] == "text":
+        return payload["content"]
+    if item["kind"] == "pdf":
+        # 読めないページは完了扱いにせず、再試行・失敗の扱いに回す
+        text = rag.extract_text_from_pdf(payload["path"], payload["start_page"], payload["end_page"], strict=True)
+        if payload["end_page"] > payload["start_page"] and not text.strip():
+            raise ValueError(f"{payload['path']} のページ {payload['start_page'] + 1}〜{payload['end_page']} "
+                             f"からテキストを抽出できませんでした")
+        return text
+    with open(payload["path"], 'r', encoding='utf-8') as f:
+        return f.read()
+
+
+def process_item(rag, queue: IngestionQueue, item: Dict, worker_id: str, batch_size: int = 64) -> int:
+    """作業1件をチェックポイントから再開して処理（保存したチャンク数を返す）"""
+    payload = item["payload"]
+    chunks = rag.chunk_text(load_item_text(rag, item))
+
+    # PDFのページ範囲ごとにIDが重ならないようにする
+    prefix = payload["source"]
+    if item["kind"] == "pdf":
+        prefix = f"{prefix}_p{payload['start_page']}"
+
+    stored = 0
+    for start in range(item["checkpoint"], len(chunks), batch_size):
+        batch = chunks[start:start + batch_size]
+        metadatas, ids = [], []
+        for j, chunk in enumerate(batch, start):
+            metadata = {
+                "source": payload["source"],
+                "type": payload["type"],
+                "chunk_index": j,
+                "char_count": len(chunk)
+            }
+            if item["kind"] == "pdf":
+                metadata["page_start"] = payload["start_page"]
+            metadatas.append(metadata)
+            ids.append(f"{prefix}_chunk_{j}")
+
+        # upsert なので、チェックポイント前に落ちたバッチを再実行しても重複しない
+        # （保存済みのチャンクはセントロイドや重複数にも再加算されない）
+        rag._index_chunks(batch, metadatas, ids, upsert=True)
+        stored += len(batch)
+
+        if not queue.checkpoint(item["id"], worker_id, start + len(batch), len(chunks)):
+            raise RuntimeError("リースを失ったため処理を中断します（別のワーカーが引き継ぎます）")
+
+    queue.checkpoint(item["id"], worker_id, len(chunks), len(chunks))
+    queue.complete(item["id"], worker_id)
+    return stored
+
+
+def lock_local_store(directory: str):
+    """ローカルのChroma保存先を1つのワーカーだけが使えるようにロック（プロセスが終了すると解放される）"""
+    os.makedirs(directory, exist_ok=True)
+    handle = open(os.path.join(directory, "ingest_worker.lock"), 'a+')
+    try:
+        if os.name == "nt":
+            import msvcrt
+
+            handle.seek(0)
+            msvcrt.locking(handle.fileno(), msvcrt.LK_NBLCK, 1)
+        else:
+            import fcntl
+
+            fcntl.flock(handle.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        handle.close()
+        raise RuntimeError(
+            f"{directory} には別のワーカーが書き込み中です。ローカル保存先は複数プロセスからの同時書き込みに"
+            f"対応していないため、並行して取り込む場合は --chroma http://host:port でChromaサーバーを指定してください"
+        )
+    return handle
+
+
+def run_worker(rag, queue: IngestionQueue, job_id: Optional[int] = None, batch_size: int = 64,
+               worker_id: Optional[str] = None) -> Dict:
+    """キューが空になるまで作業を処理"""
+    worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+    stats = {"items": 0, "chunks": 0, "failed": 0}
+
+    while True:
+        item = queue.claim(worker_id, job_id)
+        if item is None:
+            break
+
+        source = item["payload"]["source"]
+        if item["checkpoint"]:
+            print(f"▶️ {source}: チャンク {item['checkpoint']} から再開")
+        try:
+            stats["chunks"] += process_item(rag, queue, item, worker_id, batch_size)
+            stats["items"] += 1
+        except Exception as e:
+            print(f"❌ {source} の処理に失敗: {e}")
+            queue.fail(item["id"], worker_id, str(e))
+            stats["failed"] += 1
+
+    print(f"ワーカー {worker_id}: {stats['items']}件の作業, {stats['chunks']}チャンクを処理")
+    return stats
+
+
+def main():
+    """取り込みジョブのコマンドライン"""
+    parser = argparse.ArgumentParser(description="再開可能な取り込みジョブキュー")
+    parser.add_argument("--db", default="./ingest_queue.db")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    enqueue_parser = subparsers.add_parser("enqueue", help="ファイルを登録")
+    enqueue_parser.add_argument("--job", required=True)
+    enqueue_parser.add_argument("--pages-per-item", type=int, default=20)
+    enqueue_parser.add_argument("paths", nargs="+")
+
+    worker_parser = subparsers.add_parser("worker", help="ワーカーを起動")
+    worker_parser.add_argument("--collection", default="workshop_docs")
+    worker_parser.add_argument("--job")
+    worker_parser.add_argument("--batch-size", type=int, default=64)
+    worker_parser.add_argument("--chroma", action="append",
+                               help="保存先（ディレクトリまたは http://host:port、複数指定でシャード）。"
+                                    "省略時は ./chroma_db")
+
+    status_parser = subparsers.add_parser("status", help="進捗を表示")
+    status_parser.add_argument("--job")
+
+    args = parser.parse_args()
+    queue = IngestionQueue(args.db)
+
+    if args.command == "enqueue":
+        job_id = queue.get_or_create_job(args.job)
+        count = queue.enqueue_files(job_id, args.paths, args.pages_per_item)
+        print(f"ジョブ '{args.job}' に {count}件の作業を登録しました")
+
+    elif args.command == "worker":
+        from rag_system import RAGSystem
+
+        # ローカル保存先は1プロセスだけが書き込む（ロックは終了まで保持する）
+        locations = args.chroma or ["./chroma_db"]
+        try:
+            locks = [lock_local_store(location) for location in locations if "://" not in location]
+        except RuntimeError as e:
+            print(f"❌ {e}")
+            sys.exit(1)
+
+        job_id = queue.get_or_create_job(args.job) if args.job else None
+        rag = RAGSystem(args.collection, shard_locations=args.chroma)
+        run_worker(rag, queue, job_id, args.batch_size)
+        for lock in locks:
+            lock.close()
+
+    elif args.command == "status":
+        job_id = queue.get_or_create_job(args.job) if args.job else None
+        status = queue.job_status(job_id)
+        print(f"待機中: {status['pending']}, 処理中: {status['in_progress']}, "
+              f"完了: {status['done']}, 失敗: {status['failed']}")
+        print(f"チャンク: {status['chunks_done']} / {status['chunks_total']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,267 @@
+"""
+RAGSystem.query の負荷試験（クローズドループ）
+N人の仮想ユーザーがそれぞれ「質問 → 回答を待つ → 次の質問」を繰り返し、
+同時実行数ごとのスループット・レイテンシ（p50/p95/p99）・エラー率を測定する
+
+使い方:
+    # プロセス内のRAGSystemに対して（LLMは指定レイテンシのスタブ）
+    python load_test.py run --collection demo_collection --concurrency 1,2,4,8 --duration 10 --llm-latency 0.5
+
+    # HTTP経由（別ターミナルで serve を起動しておく）
+    python load_test.py serve --collection demo_collection --port 8080
+    python load_test.py run --url http://localhost:8080/query --concurrency 1,4,16
+"""
+
+import argparse
+import json
+import random
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from typing import Callable, Dict, List, Optional
+
+import requests
+
+# プロジェクトルートをPythonパスに追加
+project_root = Path(__file__).parent.parent.parent
+sys.path.append(str(project_root))
+
+from common.llm_client import LLMClient, StubBackend
+from evaluation import percentile
+
+DEFAULT_QUESTIONS = [
+    {"question": "AIの主要な応用分野は何ですか？", "weight": 3},
+    {"question": "教師あり学習とは何ですか？", "weight": 2},
+    {"question": "Transformerとは何ですか？", "weight": 2},
+    {"question": "機械学習の種類を教えてください", "weight": 1},
+    {"question": "自然言語処理の最近の発展について教えてください", "weight": 1},
+]
+
+
+def use_stub_llm(rag, latency: float, max_concurrency: int = 1024):
+    """RAGSystemのLLMを指定レイテンシのスタブに差し替え（レート制限なし）"""
+    rag.llm = LLMClient(
+        StubBackend(latency=latency),
+        requests_per_minute=0,
+        max_concurrency=max_concurrency,
+        max_retries=0
+    )
+
+
+def check_answer(result: Dict) -> Dict:
+    """回答生成に失敗した応答をエラーとして扱う（どのターゲットでもエラー率を同じ基準で数える）"""
+    if result["answer"].startswith("回答生成エラー"):
+        raise RuntimeError(result["answer"])
+    return result
+
+
+def in_process_target(rag, top_k: int = 5) -> Callable[[str], Dict]:
+    """プロセス内のRAGSystemを呼び出すターゲット"""
+    def call(question: str) -> Dict:
+        return check_answer(rag.query(question, top_k=top_k, show_sources=False, verbose=False))
+    return call
+
+
+def http_target(url: str, timeout: float = 60.0) -> Callable[[str], Dict]:
+    """HTTP経由でRAGSystemを呼び出すターゲット"""
+    session_local = threading.local()
+
+    def call(question: str) -> Dict:
+        # ユーザー（スレッド）ごとにコネクションを再利用
+        session = getattr(session_local, "session", None)
+        if session is None:
+            session = session_local.session = requests.Session()
+        response = session.post(url, json={"question": question}, timeout=timeout)
+        response.raise_for_status()
+        return check_answer(response.json())
+    return call
+
+
+def run_level(target: Callable[[str], Dict], questions: List[Dict], concurrency: int,
+              duration: float, think_time: float = 0.0, warmup: float = 1.0, seed: int = 0) -> Dict:
+    """1つの同時実行数でクローズドループ負荷をかける"""
+    weights = [q.get("weight", 1) for q in questions]
+    texts = [q["question"] for q in questions]
+    latencies, errors = [], []
+    lock = threading.Lock()
+
+    start_time = time.perf_counter()
+    measure_from = start_time + warmup
+    stop_at = measure_from + duration
+
+    def user(user_id: int):
+        rng = random.Random(seed + user_id)
+        while True:
+            now = time.perf_counter()
+            if now >= stop_at:
+                return
+            question = rng.choices(texts, weights=weights)[0]
+            request_start = time.perf_counter()
+            try:
+                target(question)
+                error = None
+            except Exception as e:
+                error = f"{type(e).__name__}: {e}"
+            elapsed = time.perf_counter() - request_start
+
+            # ウォームアップ中の結果は集計しない
+            if request_start >= measure_from:
+                with lock:
+                    latencies.append(elapsed)
+                    if error:
+                        errors.append(error)
+            if think_time:
+                time.sleep(think_time)
+
+    threads = [threading.Thread(target=user, args=(i,), daemon=True) for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    measured = max(time.perf_counter() - measure_from, 1e-9)
+    total = len(latencies)
+    error_types = {}
+    for error in errors:
+        error_types[error.split(":")[0]] = error_types.get(error.split(":")[0], 0) + 1
+
+    return {
+        "concurrency": concurrency,
+        "requests": total,
+        "errors": len(errors),
+        "error_rate": len(errors) / total if total else 0.0,
+        "error_types": error_types,
+        "throughput_rps": (total - len(errors)) / measured,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": max(latencies) * 1000 if latencies else 0.0,
+    }
+
+
+def run_load_test(target: Callable[[str], Dict], concurrency_levels: List[int], duration: float,
+                  questions: Optional[List[Dict]] = None, think_time: float = 0.0,
+                  config: Optional[Dict] = None, output: Optional[str] = None) -> Dict:
+    """同時実行数を段階的に上げて測定し、結果をJSONに保存"""
+    questions = questions or DEFAULT_QUESTIONS
+    levels = []
+
+    print(f"{'同時実行':>8} {'件数':>6} {'エラー率':>8} {'req/s':>8} {'p50(ms)':>9} {'p95(ms)':>9} {'p99(ms)':>9}")
+    for concurrency in concurrency_levels:
+        result = run_level(target, questions, concurrency, duration, think_time)
+        levels.append(result)
+        print(f"{result['concurrency']:>8} {result['requests']:>6} {result['error_rate']:>8.1%} "
+              f"{result['throughput_rps']:>8.2f} {result['p50_ms']:>9.1f} {result['p95_ms']:>9.1f} "
+              f"{result['p99_ms']:>9.1f}")
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": dict(config or {}, duration=duration, think_time=think_time,
+                       questions=[q["question"] for q in questions]),
+        "levels": levels,
+    }
+
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n結果を保存しました: {output}")
+    return report
+
+
+def serve(rag, port: int = 8080, top_k: int = 5, host: str = "127.0.0.1"):
+    """RAGSystem.query を HTTP（POST /query）で公開する簡易サーバー
+
+    認証がないため、既定ではローカルホストからの接続のみ受け付ける（他のマシンから負荷をかける場合は host を指定）
+    """
+    class QueryHandler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            if self.path != "/query":
+                self.send_error(404)
+                return
+            try:
+                body = json.loads(self.rfile.read(int(self.headers.get('Content-Length', 0))))
+                result = rag.query(body["question"], top_k=body.get("top_k", top_k),
+                                   show_sources=False, verbose=False)
+                payload = {"answer": result["answer"],
+                           "sources": [c["metadata"]["source"] for c in result.get("relevant_chunks", [])]}
+                status = 200
+            except Exception as e:
+                payload, status = {"error": str(e)}, 500
+
+            data = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), QueryHandler)
+    print(f"🚀 RAGサーバー起動: http://{host}:{port}/query")
+    if host not in ("127.0.0.1", "localhost", "::1"):
+        print(f"⚠️ {host} で公開しています（認証なし）。信頼できるネットワークでのみ使用してください")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        print("\nサーバーを終了します")
+    finally:
+        server.server_close()
+
+
+def main():
+    """負荷試験のコマンドライン"""
+    parser = argparse.ArgumentParser(description="RAGSystem.query の負荷試験")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="負荷試験を実行")
+    run_parser.add_argument("--collection", default="demo_collection")
+    run_parser.add_argument("--url", help="HTTPターゲット（省略時はプロセス内のRAGSystem）")
+    run_parser.add_argument("--concurrency", default="1,2,4,8,16")
+    run_parser.add_argument("--duration", type=float, default=10.0, help="各段階の測定秒数")
+    run_parser.add_argument("--think-time", type=float, default=0.0)
+    run_parser.add_argument("--llm-latency", type=float, default=0.5, help="スタブLLMの応答秒数")
+    run_parser.add_argument("--real-llm", action="store_true", help="スタブではなく設定済みのLLMを使う")
+    run_parser.add_argument("--questions", help="質問ミックスのJSON（[{\"question\": ..., \"weight\": ...}]）")
+    run_parser.add_argument("--output", default="load_test_results.json")
+
+    serve_parser = subparsers.add_parser("serve", help="HTTPサーバーを起動")
+    serve_parser.add_argument("--collection", default="demo_collection")
+    serve_parser.add_argument("--host", default="127.0.0.1",
+                              help="待ち受けるアドレス（認証がないため既定はローカルのみ。全インターフェースは 0.0.0.0）")
+    serve_parser.add_argument("--port", type=int, default=8080)
+    serve_parser.add_argument("--llm-latency", type=float, default=0.5)
+    serve_parser.add_argument("--real-llm", action="store_true")
+
+    args = parser.parse_args()
+
+    if args.command == "serve" or not args.url:
+        from rag_system import RAGSystem
+
+        rag = RAGSystem(args.collection)
+        if not args.real_llm:
+            use_stub_llm(rag, args.llm_latency)
+
+    if args.command == "serve":
+        serve(rag, args.port, host=args.host)
+        return
+
+    questions = None
+    if args.questions:
+        with open(args.questions, 'r', encoding='utf-8') as f:
+            questions = json.load(f)
+
+    target = http_target(args.url) if args.url else in_process_target(rag)
+    config = {
+        "target": args.url or f"in-process:{args.collection}",
+        "llm": "real" if args.real_llm else f"stub({args.llm_latency}s)",
+    }
+    levels = [int(level) for level in args.concurrency.split(",")]
+    run_load_test(target, levels, args.duration, questions, args.think_time, config, args.output)
+
+
+if __name__ == "__main__":
+    main()
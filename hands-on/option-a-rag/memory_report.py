@@ -0,0 +1,118 @@
+"""
+メモリ使用量の計測
+埋め込みモデル・ベクトルインデックス・キャッシュの常駐サイズと、取り込み中のピークメモリ（tracemalloc）を測る
+（ノードのサイズ見積もりと、メモリ使用量の退行の検出用）
+"""
+
+import math
+import os
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from typing import Optional
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+
+def current_rss() -> Optional[int]:
+    """プロセスの現在の常駐メモリ（バイト、取得できないOSでは None）"""
+    try:
+        with open("/proc/self/status", 'r') as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    return None
+
+
+def peak_rss() -> Optional[int]:
+    """プロセス開始からの最大常駐メモリ（バイト、取得できないOSでは None）"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS はバイト、Linux はキロバイト単位
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def model_memory_bytes(model) -> Optional[int]:
+    """埋め込みモデルのパラメータとバッファのサイズ（PyTorchモデル以外は None）"""
+    if not hasattr(model, "parameters"):
+        return None
+    total = sum(p.numel() * p.element_size() for p in model.parameters())
+    if hasattr(model, "buffers"):
+        total += sum(b.numel() * b.element_size() for b in model.buffers())
+    return total
+
+
+def estimate_hnsw_bytes(count: int, dim: int, m: int = 16) -> int:
+    """HNSWインデックスのメモリ見積もり（hnswlib の要素サイズに基づく）
+
+    1要素あたり: float32ベクトル + 第0層のリンク（2M個）+ ラベル、上位層のリンクは平均 1/ln(M) 層分
+    """
+    level0 = dim * 4 + (2 * m + 1) * 4 + 8
+    upper_levels = (m + 1) * 4 / max(1.0, math.log(m))
+    return int(count * (level0 + upper_levels))
+
+
+def directory_bytes(path: str) -> int:
+    """ディレクトリ以下のファイルサイズの合計"""
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def format_bytes(size: Optional[float]) -> str:
+    """バイト数を読みやすい単位に変換"""
+    if size is None:
+        return "不明"
+    for unit in ("B", "KB", "MB", "GB"):
+        if abs(size) < 1024 or unit == "GB":
+            return f"{size:.1f}{unit}" if unit != "B" else f"{int(size)}B"
+        size /= 1024
+
+
+@contextmanager
+def track_peak_memory(top: int = 5):
+    """ブロック内のピークメモリを tracemalloc で計測し、結果を辞書に書き込む
+
+    すでに tracemalloc が動いている場合（入れ子の呼び出し）は外側の計測に任せ、何も記録しない。
+    tracemalloc はPythonとnumpyの割り当てのみを追跡する（PyTorchの内部メモリは含まない）ため、
+    常駐メモリ（RSS）の増分も合わせて記録する。
+    """
+    result = {}
+    if tracemalloc.is_tracing():
+        yield result
+        return
+
+    rss_before = current_rss()
+    start_time = time.perf_counter()
+    tracemalloc.start()
+    try:
+        yield result
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+        rss_after = current_rss()
+        result.update({
+            "peak_traced_bytes": peak,
+            "retained_traced_bytes": current,
+            "rss_delta_bytes": rss_after - rss_before if rss_before is not None and rss_after is not None else None,
+            "elapsed": time.perf_counter() - start_time,
+            # 終了時点で残っている割り当ての多いファイル
+            "top_allocations": [
+                {"location": str(stat.traceback), "bytes": stat.size, "count": stat.count}
+                for stat in snapshot.statistics("filename")[:top]
+            ],
+        })
@@ -0,0 +1,44 @@
+"""
+MMR（Maximal Marginal Relevance）による多様性を考慮したチャンク選択
+類似度はNumPyの行列演算でまとめて計算する
+"""
+
+from typing import List
+
+import numpy as np
+
+
+def mmr_select(query_embedding, candidate_embeddings, k: int, lambda_mult: float = 0.5) -> List[int]:
+    """MMRで候補からk件を選び、選択順のインデックスを返す
+
+    lambda_mult=1.0 で関連度のみ（通常の検索と同じ）、0.0 で多様性のみを重視する
+    """
+    candidates = np.asarray(candidate_embeddings, dtype=np.float32)
+    if len(candidates) == 0 or k <= 0:
+        return []
+
+    query = np.asarray(query_embedding, dtype=np.float32)
+    candidates = candidates / np.maximum(np.linalg.norm(candidates, axis=1, keepdims=True), 1e-12)
+    query = query / max(float(np.linalg.norm(query)), 1e-12)
+
+    # 質問との類似度と候補同士の類似度行列
+    relevance = candidates @ query
+    similarity = candidates @ candidates.T
+
+    k = min(k, len(candidates))
+    selected = [int(np.argmax(relevance))]
+    # 各候補について、選択済みチャンクとの最大類似度
+    max_similarity = similarity[selected[0]].copy()
+    available = np.ones(len(candidates), dtype=bool)
+    available[selected[0]] = False
+
+    while len(selected) < k:
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+
+        selected.append(best)
+        available[best] = False
+        np.maximum(max_similarity, similarity[best], out=max_similarity)
+
+    return selected
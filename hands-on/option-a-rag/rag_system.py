@@ -8,54 +8,290 @@ import sys
 from pathlib import Path
 
 # プロジェクトルートをPythonパスに追加
-project_root = Path(__file__).parent.parent
+project_root = Path(__file__).parent.parent.parent
 sys.path.append(str(project_root))
 
-import chromadb
-import google.generativeai as genai
 from dotenv import load_dotenv
 from sentence_transformers import SentenceTransformer
 import PyPDF2
 import requests
 from bs4 import BeautifulSoup
 import json
-from typing import List, Dict
+from typing import List, Dict, Optional
 import time
 
+import numpy as np
+
+from common.llm_client import get_backend_name, get_llm_client
+from centroid_index import CentroidIndex
+from dedup import NearDuplicateIndex
+from dim_reduction import EmbeddingProjection, ProjectedEmbeddingModel, evaluate_dimensions
+from embedding_server import RemoteEmbeddingModel
+from evaluation import recall_at_k, summarize_latencies
+from hnsw_tuning import auto_tune_hnsw, copy_collection, hnsw_metadata, hnsw_params_from_metadata
+from memory_report import (current_rss, directory_bytes, estimate_hnsw_bytes, format_bytes,
+                           model_memory_bytes, peak_rss, track_peak_memory)
+from mmr import mmr_select
+from reembedding import CollectionAliases, ReadWriteLock, ReembeddingJob
+from sharding import ShardedCollection, create_chroma_client, open_collection
+from snapshot import export_collection, import_snapshot, load_snapshot
+
 # 環境変数読み込み
 load_dotenv()
 
+def _merge_duplicate_ids(metadata: Dict, duplicate_ids: List[str]):
+    """正規チャンクのメタデータに重複チャンクのIDを追加し、duplicate_count を重複の件数にする
+
+    IDの集合で数えるため、同じ重複チャンクを何度取り込んでも数は変わらない
+    （IDを記録していない古いメタデータの duplicate_count はそのまま加算する）
+    """
+    recorded = json.loads(metadata.get("duplicate_ids", "[]"))
+    legacy_count = metadata.get("duplicate_count", 0) - len(recorded)
+    merged = sorted(set(recorded) | set(duplicate_ids))
+    metadata["duplicate_ids"] = json.dumps(merged, ensure_ascii=False)
+    metadata["duplicate_count"] = legacy_count + len(merged)
+
 class RAGSystem:
-    def __init__(self, collection_name="workshop_docs"):
-        """RAGシステムの初期化"""
+    def __init__(self, collection_name="workshop_docs", num_shards: int = 1,
+                 shard_locations: Optional[List[str]] = None,
+                 dedup_threshold: Optional[float] = None, dedup_mode: str = "skip",
+                 embedding_server: Optional[str] = None, hnsw_params: Optional[Dict] = None,
+                 embedding_model_name: str = 'all-MiniLM-L6-v2', track_ingest_memory: bool = False):
+        """RAGシステムの初期化
+
+        num_shards > 1 の場合、コレクションをsourceのハッシュでシャードに分割する。
+        shard_locations で各シャードの保存先（ディレクトリまたは http://host:port）を指定できる
+        （1件だけの場合はシャードに分けずにその保存先を使う。複数プロセスから書き込む場合はChromaサーバーを指定する）。
+        dedup_threshold を指定すると、推定Jaccard類似度がそれ以上のチャンクを取り込み時に除外する。
+        dedup_mode="link" の場合は除外したチャンク数を正規チャンクの duplicate_count に記録する。
+        embedding_server（または環境変数 EMBEDDING_SERVER_SOCKET）に埋め込みサーバーのソケットを
+        指定すると、モデルをプロセス内に読み込まずにサーバーの encode を使う。
+        hnsw_params で新規コレクションのHNSWパラメータ（M, construction_ef, search_ef）を指定できる。
+        コレクションには作成時の埋め込みモデル名を記録し、異なるモデルでは開けないようにする
+        （モデルの変更は start_reembedding で行う）。
+        reduce_dimensions で次元削減したコレクションは、保存済みの変換を質問・チャンクの埋め込みにも適用する。
+        track_ingest_memory=True の場合、取り込みごとのピークメモリを tracemalloc で計測する
+        （取り込みが遅くなるため調査時のみ使う。結果は memory_report で確認できる）。
+        """
         
-        # Google Gemini API設定
-        genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
-        self.llm = genai.GenerativeModel('gemini-pro')
+        # LLMクライアント（レート制限・リトライ付きの共有クライアント）
+        self.llm = get_llm_client('gemini-pro')
         
-        # 埋め込みモデル
-        print("埋め込みモデルを読み込み中...")
-        self.embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+        # 埋め込みモデル（読み込み前後の常駐メモリの差も記録）
+        rss_before_model = current_rss()
+        embedding_server = embedding_server or os.getenv('EMBEDDING_SERVER_SOCKET')
+        if embedding_server:
+            print(f"埋め込みサーバーに接続中: {embedding_server}")
+            self.embedding_model = RemoteEmbeddingModel(embedding_server)
+            self.embedding_model_name = self.embedding_model.model_name
+        else:
+            print("埋め込みモデルを読み込み中...")
+            self.embedding_model_name = embedding_model_name
+            self.embedding_model = SentenceTransformer(self.embedding_model_name)
+        rss_after_model = current_rss()
+        self.model_load_rss_bytes = (
+            rss_after_model - rss_before_model if rss_before_model is not None and rss_after_model is not None else None
+        )
         
         # ChromaDBクライアント
-        self.chroma_client = chromadb.PersistentClient(path="./chroma_db")
-        self.collection = self.chroma_client.get_or_create_collection(
-            name=collection_name,
-            metadata={"hnsw:space": "cosine"}
-        )
+        self.hnsw_params = hnsw_params
+        if shard_locations:
+            num_shards = len(shard_locations)
+        
+        if num_shards > 1:
+            self.shard_locations = shard_locations or [f"./chroma_db_shard_{i}" for i in range(num_shards)]
+            self.chroma_location = self.shard_locations[0]
+            print(f"シャード数: {num_shards}")
+        else:
+            self.shard_locations = None
+            self.chroma_location = shard_locations[0] if shard_locations else "./chroma_db"
+        self.chroma_client = create_chroma_client(self.chroma_location)
+        alias_dir = self.chroma_location if "://" not in self.chroma_location else "./chroma_db"
+        
+        # 論理コレクション名から現在の実体（再埋め込みで切り替わる）を解決
+        self.collection_name = collection_name
+        self.aliases = CollectionAliases(os.path.join(alias_dir, "collection_aliases.json"))
+        physical_name = self.aliases.resolve(collection_name)
+        self.collection = self._open_collection(physical_name, self.embedding_model_name)
+        self._check_embedding_model(self.collection)
+        
+        # 次元削減済みのコレクションなら保存済みの変換を埋め込みモデルに適用
+        self.projection_dir = os.path.join(alias_dir, "projections")
+        self._load_projection(self.collection)
+        
+        # 文書セントロイドインデックス（2段階検索用）
+        self.centroid_index = CentroidIndex(self._open_centroid_collection(physical_name))
+        
+        # 検索・取り込みとコレクション切り替えの排他制御
+        self.rw_lock = ReadWriteLock()
+        
+        # 実行中の再埋め込み（ジョブ中の書き込みを記録して切り替え前に反映する）
+        self.reembedding_job = None
+        
+        # 重複チャンク検出（既存チャンクは初回の取り込み時に読み込む）
+        if dedup_mode not in ("skip", "link"):
+            raise ValueError(f"未対応の重複除去モードです: {dedup_mode}")
+        self.dedup_mode = dedup_mode
+        self.dedup_index = NearDuplicateIndex(dedup_threshold) if dedup_threshold else None
+        self._dedup_seeded = False
+        
+        # 取り込み時のメモリ計測
+        self.track_ingest_memory = track_ingest_memory
+        self.last_ingest_memory = None
         
         print("RAGシステムの初期化完了")
     
-    def extract_text_from_pdf(self, pdf_path: str) -> str:
-        """PDFからテキストを抽出"""
+    def _open_collection(self, name: str, embedding_model_name: str):
+        """コレクション（またはシャード）を開く。新規作成時は埋め込みモデル名を記録する"""
+        metadata = hnsw_metadata("cosine", self.hnsw_params)
+        metadata["embedding_model"] = embedding_model_name
+        if self.shard_locations:
+            return ShardedCollection(name, self.shard_locations, metadata=metadata)
+        return open_collection(self.chroma_client, name, metadata)
+    
+    def _open_centroid_collection(self, name: str):
+        return open_collection(self.chroma_client, f"{name}_centroids", {"hnsw:space": "cosine"})
+    
+    def _create_collection(self, name: str, metadata: Dict, sharded: bool = True):
+        """空のコレクション（sharded=True ならシャード）を作成（中断した前回の作成途中のものは削除する）"""
+        if sharded and self.shard_locations:
+            ShardedCollection(name, self.shard_locations).drop()
+            return ShardedCollection(name, self.shard_locations, metadata=metadata)
+        if name in [c if isinstance(c, str) else c.name for c in self.chroma_client.list_collections()]:
+            self.chroma_client.delete_collection(name)
+        return self.chroma_client.create_collection(name=name, metadata=metadata)
+    
+    def _check_no_reembedding(self):
+        """再埋め込みの実行中はコレクションを作り直さない（ジョブが旧コレクションを読み続けるため）"""
+        if self.reembedding_job is not None and self.reembedding_job.running:
+            raise ValueError("再埋め込みを実行中です。完了してからコレクションを作り直してください")
+    
+    def _rebuild_collection(self, metadata: Dict, transform=None, projection: Optional[EmbeddingProjection] = None):
+        """新しい実体のコレクションにデータをコピーし、エイリアスを切り替えてから旧コレクションを削除
+
+        切り替えより前に失敗しても、論理名は旧コレクションを指したまま（呼び出し元で書き込みロックを取る）。
+        transform を指定するとコピーする埋め込みに適用し、セントロイドは作り直す。
+        """
+        self._check_no_reembedding()
+        old_collection = self.collection
+        old_centroid_collection = self.centroid_index.collection
+        generation = self.aliases.generation(self.collection_name) + 1
+        physical = f"{self.collection_name}__v{generation}"
+        
+        collection = self._create_collection(physical, metadata)
+        if isinstance(old_collection, ShardedCollection):
+            for source, target in zip(old_collection.shards, collection.shards):
+                copy_collection(source, target, transform=transform)
+        else:
+            copy_collection(old_collection, collection, transform=transform)
+        
+        centroid_index = CentroidIndex(
+            self._create_collection(f"{physical}_centroids", {"hnsw:space": "cosine"}, sharded=False)
+        )
+        if transform is None:
+            copy_collection(old_centroid_collection, centroid_index.collection)
+        else:
+            centroid_index.rebuild(collection)
+        if projection is not None:
+            projection.save(self._projection_path(collection))
+        
+        self.aliases.set(self.collection_name, physical, generation)
+        self.collection = collection
+        self.centroid_index = centroid_index
+        
+        old_projection_path = self._projection_path(old_collection)
+        self._drop_collection(old_collection)
+        self._drop_collection(old_centroid_collection)
+        if os.path.exists(old_projection_path):
+            os.remove(old_projection_path)
+    
+    def _drop_collection(self, collection):
+        """コレクションを削除"""
+        if isinstance(collection, ShardedCollection):
+            collection.drop()
+        else:
+            self.chroma_client.delete_collection(collection.name)
+    
+    def _check_embedding_model(self, collection):
+        """コレクションに記録された埋め込みモデルと現在のモデルが一致するか確認"""
+        recorded = (collection.metadata or {}).get("embedding_model")
+        if recorded and recorded != self.embedding_model_name:
+            raise ValueError(
+                f"コレクション '{self.collection_name}' は埋め込みモデル {recorded} で作成されています"
+                f"（現在: {self.embedding_model_name}）。start_reembedding でモデルを切り替えてください"
+            )
+    
+    def _projection_path(self, collection) -> str:
+        return os.path.join(self.projection_dir, f"{collection.name}.npz")
+    
+    def _load_projection(self, collection):
+        """コレクションに記録された次元削減の変換を読み込み、埋め込みモデルに適用"""
+        label = (collection.metadata or {}).get("projection")
+        if not label:
+            return
+        path = self._projection_path(collection)
+        if not os.path.exists(path):
+            raise ValueError(f"コレクション '{self.collection_name}' の次元削減（{label}）の変換ファイルがありません: {path}")
+        self.embedding_model = ProjectedEmbeddingModel(self.embedding_model, EmbeddingProjection.load(path))
+        print(f"次元削減を適用: {label}")
+    
+    @property
+    def projection(self) -> Optional[EmbeddingProjection]:
+        """現在の次元削減の変換（なければ None）"""
+        if isinstance(self.embedding_model, ProjectedEmbeddingModel):
+            return self.embedding_model.projection
+        return None
+    
+    def start_reembedding(self, model_name: str, batch_size: int = 64, throttle_seconds: float = 0.1,
+                          delete_old: bool = False, model=None,
+                          embedding_server: Optional[str] = None) -> ReembeddingJob:
+        """新しい埋め込みモデルでバックグラウンド再埋め込みを開始
+
+        旧コレクションで検索を続けながらシャドウコレクションを作成し、完了後に切り替える。
+        model（または embedding_server のソケットに接続したクライアント）を渡すと、再埋め込みと
+        切り替え後の埋め込みにそれを使う（省略時は model_name の SentenceTransformer を読み込む）。
+        埋め込みサーバーを使用中の場合は、新しいモデルのサーバーを embedding_server に指定する。
+        次元削減は新しいモデルには引き継がれない（必要なら切り替え後に reduce_dimensions を実行する）。
+        """
+        if model_name == self.embedding_model_name:
+            raise ValueError(f"すでに埋め込みモデル {model_name} を使用しています")
+        if self.reembedding_job is not None and self.reembedding_job.running:
+            raise ValueError("再埋め込みを実行中です")
+        
+        if embedding_server:
+            model = RemoteEmbeddingModel(embedding_server)
+            if model.model_name != model_name:
+                raise ValueError(f"埋め込みサーバーのモデルが一致しません: {model.model_name}（指定: {model_name}）")
+        base_model = self.embedding_model.model if self.projection is not None else self.embedding_model
+        if model is None and isinstance(base_model, RemoteEmbeddingModel):
+            raise ValueError("埋め込みサーバーを使用中です。新しいモデルの埋め込みサーバーを embedding_server に指定してください")
+        
+        self.reembedding_job = ReembeddingJob(self, model_name, model=model, batch_size=batch_size,
+                                              throttle_seconds=throttle_seconds, delete_old=delete_old)
+        return self.reembedding_job.start()
+    
+    def _record_changes(self, ids: List[str]):
+        """再埋め込み中に書き込んだチャンクを記録（切り替え前にシャドウコレクションへ反映される）"""
+        job = self.reembedding_job
+        if job is not None and job.running:
+            job.mark_changed(ids)
+    
+    def extract_text_from_pdf(self, pdf_path: str, start_page: int = 0,
+                              end_page: Optional[int] = None, strict: bool = False) -> str:
+        """PDFからテキストを抽出（start_page 〜 end_page-1 ページ、省略時は全ページ）
+
+        strict=True の場合、読み込みエラーを空文字にせず例外のまま送出する（取り込みキューの再試行用）
+        """
         try:
             with open(pdf_path, 'rb') as file:
                 pdf_reader = PyPDF2.PdfReader(file)
                 text = ""
-                for page in pdf_reader.pages:
+                for page in pdf_reader.pages[start_page:end_page]:
                     text += page.extract_text() + "\n"
                 return text
         except Exception as e:
+            if strict:
+                raise
             print(f"PDF読み込みエラー: {e}")
             return ""
     
@@ -115,14 +351,30 @@ class RAGSystem:
             if chunk:
                 chunks.append(chunk)
             
-            start = end - overlap
-            if start <= 0:
-                start = end
+            # 境界が start 付近にあると重なり分だけ戻って進まなくなるため、必ず前に進める
+            next_start = end - overlap
+            start = next_start if next_start > start else end
         
         return chunks
     
-    def add_documents(self, documents: List[Dict[str, str]]):
-        """文書をベクトルDBに追加"""
+    def add_documents(self, documents: List[Dict[str, str]]) -> Dict:
+        """文書をベクトルDBに追加（追加・重複除外したチャンク数を返す）"""
+        if self.track_ingest_memory:
+            return self._track_ingest(self._add_documents, documents)
+        return self._add_documents(documents)
+    
+    def _track_ingest(self, func, *args) -> Dict:
+        """取り込み処理のピークメモリを計測して last_ingest_memory に記録"""
+        with track_peak_memory() as memory:
+            report = func(*args)
+        if memory:
+            memory["chunks"] = report["chunks"]
+            self.last_ingest_memory = memory
+            print(f"取り込み時のピークメモリ: {format_bytes(memory['peak_traced_bytes'])} "
+                  f"(RSS増分 {format_bytes(memory['rss_delta_bytes'])})")
+        return report
+    
+    def _add_documents(self, documents: List[Dict[str, str]]) -> Dict:
         print(f"{len(documents)}個の文書を処理中...")
         
         all_chunks = []
@@ -149,39 +401,169 @@ class RAGSystem:
                 })
                 all_ids.append(chunk_id)
         
+        return self._index_chunks(all_chunks, all_metadatas, all_ids)
+    
+    def _index_chunks(self, all_chunks: List[str], all_metadatas: List[Dict], all_ids: List[str],
+                      upsert: bool = False) -> Dict:
+        """チャンクの重複除去・埋め込み生成・ベクトルDBへの保存
+
+        upsert=True の場合は同じIDのチャンクを上書きする（ジョブの再実行でも結果が変わらない）
+        """
+        # コレクション切り替え中は待機
+        with self.rw_lock.read():
+            if self.track_ingest_memory:
+                # add_documents から呼ばれた場合は外側の計測に含まれる
+                return self._track_ingest(self._index_chunks_locked, all_chunks, all_metadatas, all_ids, upsert)
+            return self._index_chunks_locked(all_chunks, all_metadatas, all_ids, upsert)
+    
+    def _index_chunks_locked(self, all_chunks: List[str], all_metadatas: List[Dict], all_ids: List[str],
+                             upsert: bool) -> Dict:
+        report = {"chunks": len(all_chunks), "added": 0, "duplicates": 0}
+        
+        # 重複チャンクの除去
+        links = {}
+        if self.dedup_index is not None and all_chunks:
+            all_chunks, all_metadatas, all_ids, links = self._deduplicate_chunks(
+                all_chunks, all_metadatas, all_ids
+            )
+            report["duplicates"] = report["chunks"] - len(all_chunks)
+            print(f"重複チャンク: {report['duplicates']}個を除外")
+        
         if not all_chunks:
+            # 既存チャンクの重複だけのバッチでも重複リンクは記録する
+            self._link_duplicates(links)
             print("追加する文書がありません")
-            return
+            return report
         
-        # 埋め込み生成
-        print("埋め込みベクトルを生成中...")
-        embeddings = self.embedding_model.encode(all_chunks).tolist()
+        # 保存済みのチャンク（ジョブの再実行で同じバッチを再投入した場合など）はセントロイドに加算しない
+        stored_ids = set(self.collection.get(ids=all_ids, include=[])["ids"])
         
-        # ChromaDBに追加
-        self.collection.add(
-            documents=all_chunks,
-            metadatas=all_metadatas,
-            ids=all_ids,
-            embeddings=embeddings
-        )
+        # 新規チャンク同士の重複はメタデータに直接記録
+        if links:
+            for chunk_id, metadata in zip(all_ids, all_metadatas):
+                if chunk_id in links:
+                    _merge_duplicate_ids(metadata, links.pop(chunk_id))
+        
+        try:
+            # 埋め込み生成
+            print("埋め込みベクトルを生成中...")
+            embeddings = self.embedding_model.encode(all_chunks).tolist()
+            
+            # ChromaDBに追加
+            write = self.collection.upsert if upsert else self.collection.add
+            write(
+                documents=all_chunks,
+                metadatas=all_metadatas,
+                ids=all_ids,
+                embeddings=embeddings
+            )
+            self._record_changes(all_ids)
+        except Exception:
+            # 保存できなかったチャンクを重複検出から外す（後から同じ内容のチャンクが来ても除外されないように）
+            if self.dedup_index is not None:
+                for chunk_id in all_ids:
+                    if chunk_id not in stored_ids:
+                        self.dedup_index.remove(chunk_id)
+            raise
+        
+        # 既存チャンクへの重複リンクを更新
+        self._link_duplicates(links)
+        
+        # 文書ごとのセントロイドを更新
+        new_chunks = [i for i, chunk_id in enumerate(all_ids) if chunk_id not in stored_ids]
+        if new_chunks:
+            self.centroid_index.update([all_metadatas[i]['source'] for i in new_chunks],
+                                       [embeddings[i] for i in new_chunks])
         
+        report["added"] = len(all_chunks)
         print(f"✅ {len(all_chunks)}個のチャンクをベクトルDBに追加完了")
+        return report
     
-    def search_relevant_chunks(self, query: str, top_k: int = 5) -> List[Dict]:
-        """関連するチャンクを検索"""
-        # クエリの埋め込み生成
-        query_embedding = self.embedding_model.encode([query]).tolist()
+    def _link_duplicates(self, links: Dict[str, List[str]]):
+        """保存済みの正規チャンクに重複チャンクのIDを記録（IDで記録するため、再実行しても数は増えない）"""
+        if not links:
+            return
+        existing = self.collection.get(ids=list(links), include=["metadatas"])
+        for metadata, chunk_id in zip(existing["metadatas"], existing["ids"]):
+            _merge_duplicate_ids(metadata, links[chunk_id])
+        self.collection.update(ids=existing["ids"], metadatas=existing["metadatas"])
+        self._record_changes(existing["ids"])
+    
+    def _deduplicate_chunks(self, chunks: List[str], metadatas: List[Dict], ids: List[str]):
+        """近似重複チャンクを除外（link モードでは正規チャンクごとの重複チャンクのIDも返す）"""
+        if not self._dedup_seeded:
+            # 既存コレクションのチャンクを重複検出インデックスに登録
+            total = self.collection.count()
+            for offset in range(0, total, 5000):
+                page = self.collection.get(include=["documents"], limit=5000, offset=offset)
+                for chunk_id, document in zip(page["ids"], page["documents"]):
+                    self.dedup_index.insert(chunk_id, document)
+            self._dedup_seeded = True
         
-        # 検索実行
-        results = self.collection.query(
-            query_embeddings=query_embedding,
-            n_results=top_k
-        )
+        kept_chunks, kept_metadatas, kept_ids = [], [], []
+        links = {}
+        for chunk, metadata, chunk_id in zip(chunks, metadatas, ids):
+            canonical = self.dedup_index.add(chunk_id, chunk)
+            if canonical is None:
+                kept_chunks.append(chunk)
+                kept_metadatas.append(metadata)
+                kept_ids.append(chunk_id)
+            elif canonical == chunk_id:
+                # 保存済みのチャンク（ジョブの再実行など）
+                continue
+            elif self.dedup_mode == "link":
+                links.setdefault(canonical, []).append(chunk_id)
+        
+        return kept_chunks, kept_metadatas, kept_ids, links
+    
+    def search_relevant_chunks(self, query: str, top_k: int = 5, two_stage: bool = False,
+                               top_documents: int = 3, mmr: bool = False,
+                               mmr_lambda: float = 0.5) -> List[Dict]:
+        """関連するチャンクを検索
+
+        two_stage=True の場合、セントロイドインデックスで上位top_documents件の文書を選び、
+        その文書内のチャンクだけを検索する。
+        mmr=True の場合、多めに候補を取得してからMMRで重複の少ないtop_k件を選ぶ
+        （mmr_lambda: 1.0で関連度重視、0.0で多様性重視）。
+        """
+        # コレクション切り替え中は待機（埋め込みモデルとコレクションの組み合わせを揃える）
+        with self.rw_lock.read():
+            # クエリの埋め込み生成
+            query_embedding = self.embedding_model.encode([query]).tolist()[0]
+            
+            return self._search_by_embedding(query_embedding, top_k, two_stage, top_documents,
+                                             mmr, mmr_lambda)
+    
+    def _search_by_embedding(self, query_embedding: List[float], top_k: int = 5,
+                             two_stage: bool = False, top_documents: int = 3,
+                             mmr: bool = False, mmr_lambda: float = 0.5) -> List[Dict]:
+        """埋め込みベクトルで検索を実行"""
+        where = None
+        if two_stage:
+            sources = self.centroid_index.select_sources(query_embedding, top_documents)
+            if sources:
+                where = {"source": {"$in": sources}}
+        
+        # 検索実行（MMRの場合は候補を多めに取得）
+        query_args = {
+            "query_embeddings": [query_embedding],
+            "n_results": max(top_k * 4, 20) if mmr else top_k
+        }
+        if mmr:
+            query_args["include"] = ["documents", "metadatas", "distances", "embeddings"]
+        if where:
+            query_args["where"] = where
+        results = self.collection.query(**query_args)
+        
+        indices = range(len(results['documents'][0]))
+        if mmr and len(results['documents'][0]) > top_k:
+            indices = mmr_select(query_embedding, results['embeddings'][0], top_k, mmr_lambda)
         
         # 結果を整理
         relevant_chunks = []
-        for i in range(len(results['documents'][0])):
+        for i in indices:
             relevant_chunks.append({
+                'id': results['ids'][0][i],
                 'content': results['documents'][0][i],
                 'metadata': results['metadatas'][0][i],
                 'distance': results['distances'][0][i]
@@ -189,6 +571,42 @@ class RAGSystem:
         
         return relevant_chunks
     
+    def compare_retrieval_modes(self, questions: List[str], top_k: int = 5,
+                                top_documents: int = 3) -> Dict:
+        """1段階検索と2段階検索のレイテンシ・recall@kを比較（1段階検索の結果を正解とする）"""
+        single_latencies, two_stage_latencies, recalls = [], [], []
+        
+        with self.rw_lock.read():
+            query_embeddings = self.embedding_model.encode(questions).tolist()
+            for query_embedding in query_embeddings:
+                start_time = time.perf_counter()
+                reference = self._search_by_embedding(query_embedding, top_k)
+                single_latencies.append(time.perf_counter() - start_time)
+                
+                start_time = time.perf_counter()
+                candidates = self._search_by_embedding(query_embedding, top_k, True, top_documents)
+                two_stage_latencies.append(time.perf_counter() - start_time)
+                
+                recalls.append(recall_at_k(
+                    [chunk['id'] for chunk in candidates],
+                    [chunk['id'] for chunk in reference]
+                ))
+        
+        report = {
+            "questions": len(questions),
+            "top_k": top_k,
+            "top_documents": top_documents,
+            "single_stage": summarize_latencies(single_latencies),
+            "two_stage": summarize_latencies(two_stage_latencies),
+            "recall_at_k": sum(recalls) / len(recalls) if recalls else 0.0
+        }
+        
+        print(f"\n📊 検索モード比較 (top_k={top_k}, 文書数={top_documents})")
+        print(f"1段階: 平均 {report['single_stage']['avg_ms']:.1f}ms / p95 {report['single_stage']['p95_ms']:.1f}ms")
+        print(f"2段階: 平均 {report['two_stage']['avg_ms']:.1f}ms / p95 {report['two_stage']['p95_ms']:.1f}ms")
+        print(f"recall@{top_k}: {report['recall_at_k']:.3f}")
+        return report
+    
     def generate_answer(self, query: str, context_chunks: List[Dict]) -> str:
         """コンテキストを基に回答を生成"""
         
@@ -217,18 +635,22 @@ class RAGSystem:
 """
         
         try:
-            response = self.llm.generate_content(prompt)
+            response = self.llm.generate(prompt)
             return response.text
         except Exception as e:
             return f"回答生成エラー: {e}"
     
-    def query(self, question: str, top_k: int = 5, show_sources: bool = True) -> Dict:
-        """質問応答の実行"""
-        print(f"\n質問: {question}")
-        print("関連情報を検索中...")
+    def query(self, question: str, top_k: int = 5, show_sources: bool = True,
+              two_stage: bool = False, mmr: bool = False, mmr_lambda: float = 0.5,
+              verbose: bool = True) -> Dict:
+        """質問応答の実行（verbose=False で進捗表示を省略。mmr_lambda は search_relevant_chunks と同じ）"""
+        if verbose:
+            print(f"\n質問: {question}")
+            print("関連情報を検索中...")
         
         # 関連チャンク検索
-        relevant_chunks = self.search_relevant_chunks(question, top_k)
+        relevant_chunks = self.search_relevant_chunks(question, top_k, two_stage=two_stage, mmr=mmr,
+                                                      mmr_lambda=mmr_lambda)
         
         if not relevant_chunks:
             return {
@@ -237,16 +659,19 @@ class RAGSystem:
             }
         
         # 回答生成
-        print("回答を生成中...")
+        if verbose:
+            print("回答を生成中...")
         answer = self.generate_answer(question, relevant_chunks)
         
         # ソース情報
         sources = []
         if show_sources:
-            print("\n参照した情報源:")
+            if verbose:
+                print("\n参照した情報源:")
             for i, chunk in enumerate(relevant_chunks, 1):
                 source_info = f"[{i}] {chunk['metadata']['source']} (類似度: {1-chunk['distance']:.3f})"
-                print(source_info)
+                if verbose:
+                    print(source_info)
                 sources.append({
                     "source": chunk['metadata']['source'],
                     "content": chunk['content'][:200] + "...",
@@ -264,24 +689,286 @@ class RAGSystem:
         count = self.collection.count()
         
         if count > 0:
-            # メタデータから統計を取得
-            all_data = self.collection.get()
+            # メタデータから統計を取得（本文は読まず、ページ単位で読んでメモリを抑える）
             sources = set()
             doc_types = {}
             
-            for metadata in all_data['metadatas']:
-                sources.add(metadata['source'])
-                doc_type = metadata.get('type', 'unknown')
-                doc_types[doc_type] = doc_types.get(doc_type, 0) + 1
+            for offset in range(0, count, 5000):
+                page = self.collection.get(include=["metadatas"], limit=5000, offset=offset)
+                for metadata in page['metadatas']:
+                    sources.add(metadata['source'])
+                    doc_type = metadata.get('type', 'unknown')
+                    doc_types[doc_type] = doc_types.get(doc_type, 0) + 1
             
-            return {
+            stats = {
                 "total_chunks": count,
                 "unique_sources": len(sources),
                 "document_types": doc_types,
                 "sources": list(sources)
             }
+            if isinstance(self.collection, ShardedCollection):
+                stats["shard_counts"] = self.collection.shard_counts()
+            return stats
         
         return {"total_chunks": 0, "unique_sources": 0, "document_types": {}, "sources": []}
+    
+    def memory_report(self, verbose: bool = True) -> Dict:
+        """メモリ使用量のレポート
+
+        埋め込みモデル・コレクションごとのベクトルインデックス（HNSWの見積もりとディスク上のサイズ）・
+        キャッシュ・直近の取り込みのピークメモリ・プロセス全体の常駐メモリを返す。
+        """
+        dimension = self.embedding_model.get_sentence_embedding_dimension()
+        base_model = self.embedding_model.model if self.projection is not None else self.embedding_model
+        
+        # 埋め込みモデル（埋め込みサーバー利用時はサーバー側のメモリ）
+        report = {
+            "process": {"rss_bytes": current_rss(), "peak_rss_bytes": peak_rss()},
+            "embedding_model": {
+                "name": self.embedding_model_name,
+                "remote": isinstance(base_model, RemoteEmbeddingModel),
+                "parameter_bytes": model_memory_bytes(base_model),
+                "load_rss_delta_bytes": self.model_load_rss_bytes,
+            },
+            "collections": [],
+            "caches": {},
+            "last_ingest": self.last_ingest_memory,
+        }
+        
+        # ベクトルインデックス（シャードごと、セントロイドを含む）
+        if isinstance(self.collection, ShardedCollection):
+            collections = [(f"{self.collection.name}[shard {i}]", shard)
+                           for i, shard in enumerate(self.collection.shards)]
+        else:
+            collections = [(self.collection.name, self.collection)]
+        collections.append((self.centroid_index.collection.name, self.centroid_index.collection))
+        
+        for name, collection in collections:
+            count = collection.count()
+            m = hnsw_params_from_metadata(collection.metadata)["M"]
+            report["collections"].append({
+                "name": name,
+                "count": count,
+                "dimension": dimension,
+                "hnsw_M": m,
+                "index_bytes_estimate": estimate_hnsw_bytes(count, dimension, m),
+            })
+        
+        locations = self.shard_locations or [self.chroma_location]
+        report["disk"] = {
+            location: directory_bytes(location)
+            for location in dict.fromkeys(locations) if "://" not in location
+        }
+        
+        # キャッシュ
+        if self.dedup_index is not None:
+            report["caches"]["dedup_index"] = {
+                "entries": len(self.dedup_index),
+                "bytes": self.dedup_index.memory_bytes(),
+            }
+        
+        if verbose:
+            print("\n🧠 メモリ使用量")
+            print(f"  プロセス: 常駐 {format_bytes(report['process']['rss_bytes'])}, "
+                  f"最大 {format_bytes(report['process']['peak_rss_bytes'])}")
+            model = report["embedding_model"]
+            location = "埋め込みサーバー" if model["remote"] else "プロセス内"
+            print(f"  埋め込みモデル {model['name']} ({location}): パラメータ {format_bytes(model['parameter_bytes'])}, "
+                  f"読み込み時のRSS増分 {format_bytes(model['load_rss_delta_bytes'])}")
+            for info in report["collections"]:
+                print(f"  インデックス {info['name']}: {info['count']}件 x {info['dimension']}次元, "
+                      f"見積もり {format_bytes(info['index_bytes_estimate'])}")
+            for location, size in report["disk"].items():
+                print(f"  ディスク {location}: {format_bytes(size)}")
+            for name, info in report["caches"].items():
+                print(f"  キャッシュ {name}: {info['entries']}件, {format_bytes(info['bytes'])}")
+            if self.last_ingest_memory:
+                print(f"  直近の取り込み: ピーク {format_bytes(self.last_ingest_memory['peak_traced_bytes'])} "
+                      f"({self.last_ingest_memory['chunks']}チャンク)")
+        
+        return report
+    
+    def auto_tune_hnsw(self, target_recall: float = 0.95, top_k: int = 5, sample_size: int = 5000,
+                       num_queries: int = 100, questions: Optional[List[str]] = None,
+                       grid: Optional[Dict[str, List[int]]] = None, apply: bool = False) -> Dict:
+        """HNSWパラメータを自動チューニング
+
+        コレクションからサンプルした埋め込みで各設定を評価し、厳密検索に対する recall@top_k が
+        target_recall 以上で最も低レイテンシな設定を推奨する。apply=True の場合はその設定で
+        コレクションを作り直す（再埋め込みはしない）。
+        """
+        if apply:
+            self._check_no_reembedding()
+        sample = self.collection.get(include=["embeddings"], limit=sample_size)
+        corpus = np.asarray(sample["embeddings"], dtype=np.float32)
+        if len(corpus) == 0:
+            print("チューニングするデータがありません")
+            return {}
+        
+        if questions:
+            queries = np.asarray(self.embedding_model.encode(questions), dtype=np.float32)
+        else:
+            rng = np.random.default_rng(0)
+            queries = corpus[rng.choice(len(corpus), size=min(num_queries, len(corpus)), replace=False)]
+        
+        print(f"HNSWチューニング: コーパス {len(corpus)}件, クエリ {len(queries)}件, 目標 recall@{top_k} >= {target_recall}")
+        report = auto_tune_hnsw(corpus, queries, k=top_k, target_recall=target_recall, grid=grid)
+        report["current"] = hnsw_params_from_metadata(self.collection.metadata)
+        
+        recommended = report["recommended"]
+        status = "✅" if report["met_target"] else "⚠️ 目標未達（最もrecallの高い設定）"
+        print(f"\n{status} 推奨設定: {recommended['params']} "
+              f"(recall@{top_k}={recommended['recall']:.3f}, 平均 {recommended['avg_ms']:.2f}ms)")
+        print(f"現在の設定: {report['current']}")
+        
+        if apply and report["met_target"]:
+            self.apply_hnsw_params(recommended["params"])
+        return report
+    
+    def apply_hnsw_params(self, params: Dict):
+        """HNSWパラメータを変更してコレクションを作り直す"""
+        self._check_no_reembedding()
+        metadata = hnsw_metadata("cosine", params)
+        metadata["embedding_model"] = self.embedding_model_name
+        if self.projection is not None:
+            metadata["projection"] = self.projection.label
+        print(f"HNSW設定 {params} でコレクションを再構築中...")
+        
+        with self.rw_lock.write():
+            self._rebuild_collection(metadata, projection=self.projection)
+            self.hnsw_params = params
+        print("✅ 再構築完了")
+    
+    def _sample_raw_embeddings(self, sample_size: int) -> np.ndarray:
+        """次元削減前のチャンク埋め込みをサンプリング"""
+        if self.projection is not None:
+            raise ValueError(f"コレクションはすでに次元削減されています（{self.projection.label}）")
+        sample = self.collection.get(include=["embeddings"], limit=sample_size)
+        return np.asarray(sample["embeddings"], dtype=np.float32)
+    
+    def evaluate_dimensions(self, dims: Optional[List[int]] = None, method: str = "pca", top_k: int = 5,
+                            sample_size: int = 5000, num_queries: int = 100,
+                            questions: Optional[List[str]] = None) -> Dict:
+        """削減後の次元ごとの recall@top_k を測定（次元数を選ぶためのレポート）
+
+        questions を省略した場合は、サンプルの一部をコーパスから除いて質問として使う。
+        """
+        corpus = self._sample_raw_embeddings(sample_size)
+        if len(corpus) < 2:
+            print("評価するデータがありません")
+            return {}
+        
+        if questions:
+            queries = np.asarray(self.embedding_model.encode(questions), dtype=np.float32)
+        else:
+            rng = np.random.default_rng(0)
+            order = rng.permutation(len(corpus))
+            held_out = min(num_queries, len(corpus) // 2)
+            queries, corpus = corpus[order[:held_out]], corpus[order[held_out:]]
+        
+        full_dim = corpus.shape[1]
+        dims = dims or [d for d in (32, 64, 96, 128, 192, 256) if d < full_dim]
+        print(f"次元削減の評価 ({method}): コーパス {len(corpus)}件, クエリ {len(queries)}件, 元の次元 {full_dim}")
+        return evaluate_dimensions(corpus, queries, dims, k=top_k, method=method)
+    
+    def reduce_dimensions(self, dim: int, method: str = "pca", sample_size: int = 5000) -> EmbeddingProjection:
+        """保存済みの埋め込みで変換を学習し、コレクションを削減後の次元で作り直す
+
+        変換はコレクションごとに保存され、以降の取り込み・検索の埋め込みにも適用される（再埋め込みはしない）。
+        """
+        self._check_no_reembedding()
+        projection = EmbeddingProjection.fit(self._sample_raw_embeddings(sample_size), dim, method)
+        print(f"次元削減 {projection.label} でコレクションを再構築中...")
+        self._apply_projection(projection)
+        
+        explained = (f", 分散説明率 {projection.explained_variance:.3f}"
+                     if projection.explained_variance is not None else "")
+        print(f"✅ {projection.input_dim}次元 → {projection.output_dim}次元に削減しました{explained}")
+        return projection
+    
+    def _apply_projection(self, projection: EmbeddingProjection):
+        """変換を保存し、コレクションを変換後の埋め込みで作り直して以降の埋め込みにも適用する"""
+        self._check_no_reembedding()
+        metadata = dict(self.collection.metadata or {})
+        metadata["projection"] = projection.label
+        
+        with self.rw_lock.write():
+            # セントロイドは次元が変わるため新しい埋め込みで作り直される
+            self._rebuild_collection(metadata, transform=projection.transform, projection=projection)
+            self.embedding_model = ProjectedEmbeddingModel(self.embedding_model, projection)
+    
+    def export_snapshot(self, path: str) -> Dict:
+        """コレクションをスナップショットファイルに書き出す"""
+        print(f"スナップショットを書き出し中: {path}")
+        result = export_collection(
+            self.collection,
+            path,
+            extra_header={
+                "embedding_model": self.embedding_model_name,
+                "projection": self.projection.label if self.projection is not None else None,
+                "projection_fingerprint": self.projection.fingerprint if self.projection is not None else None
+            },
+            # 次元削減の変換も含める（変換ファイルのない新しいノードでも復元できるように）
+            arrays={
+                "projection.mean": self.projection.mean,
+                "projection.components": self.projection.components
+            } if self.projection is not None else None
+        )
+        print(f"✅ {result['count']}チャンク ({result['bytes'] / 1024 / 1024:.1f}MB) を書き出しました")
+        return result
+    
+    @staticmethod
+    def _snapshot_projection(snapshot) -> Optional[EmbeddingProjection]:
+        """スナップショットに含まれる次元削減の変換（次元削減していなければ None）"""
+        label = snapshot.header.get('projection')
+        if not label:
+            return None
+        if "projection.components" not in snapshot.arrays:
+            raise ValueError(f"スナップショットに次元削減（{label}）の変換が含まれていません。書き出し直してください")
+        return EmbeddingProjection(label.split(":")[0], snapshot.arrays["projection.mean"],
+                                   snapshot.arrays["projection.components"])
+    
+    def import_snapshot(self, path: str) -> Dict:
+        """スナップショットファイルからコレクションを復元（再埋め込みなし）
+
+        次元削減したスナップショットは、空のコレクションならその変換を適用してから取り込む
+        """
+        print(f"スナップショットを読み込み中: {path}")
+        start_time = time.time()
+        snapshot = load_snapshot(path)
+        read_time = time.time() - start_time
+        
+        # 埋め込みモデルが一致しないスナップショットは取り込まない
+        model_name = snapshot.header.get('embedding_model')
+        if model_name and model_name != self.embedding_model_name:
+            raise ValueError(
+                f"埋め込みモデルが一致しません: スナップショット={model_name}, 現在={self.embedding_model_name}"
+            )
+        
+        # 次元削減は変換行列まで一致する場合のみ取り込む（ラベルが同じでも学習したサンプルが違えば別の空間）
+        snapshot_projection = self._snapshot_projection(snapshot)
+        if snapshot_projection is not None and self.projection is None and self.collection.count() == 0:
+            print(f"スナップショットの次元削減を適用: {snapshot_projection.label}")
+            self._apply_projection(snapshot_projection)
+        
+        current = self.projection
+        if (snapshot_projection is None) != (current is None):
+            raise ValueError(
+                f"次元削減が一致しません: スナップショット={snapshot.header.get('projection')}, "
+                f"現在={current.label if current is not None else None}"
+            )
+        if current is not None and snapshot_projection.fingerprint != current.fingerprint:
+            raise ValueError(
+                f"次元削減の変換行列が一致しません（{current.label}。別のサンプルで学習された変換です）"
+            )
+        
+        with self.rw_lock.read():
+            result = import_snapshot(self.collection, snapshot)
+            self._record_changes(snapshot.ids)
+        result["read_time"] = read_time
+        self.centroid_index.rebuild(self.collection)
+        print(f"✅ {result['count']}チャンクを読み込みました (読み込み {read_time:.2f}秒, 投入 {result['elapsed']:.2f}秒)")
+        return result
 
 def demo_with_sample_data():
     """サンプルデータでのデモ"""
@@ -398,6 +1085,9 @@ NLPの主要タスク：
         print(f"\n💬 {question}")
         print(f"🤖 {result['answer']}")
         print("-" * 50)
+    
+    # 1段階検索と2段階検索の比較
+    rag.compare_retrieval_modes(sample_questions, top_k=3, top_documents=2)
 
 def interactive_demo():
     """インタラクティブなデモ"""
@@ -489,6 +1179,7 @@ def interactive_demo():
                 print("文書一覧:")
                 for source in stats['sources']:
                     print(f"  - {source}")
+            rag.memory_report()
         
         elif choice == "6":
             print("デモを終了します")
@@ -620,7 +1311,7 @@ k近傍法（k-NN）：
 def main():
     """メイン実行関数"""
     
-    if not os.getenv('GOOGLE_API_KEY'):
+    if get_backend_name() == "gemini" and not os.getenv('GOOGLE_API_KEY'):
         print("ERROR: GOOGLE_API_KEYが設定されていません")
         print(".envファイルでAPIキーを設定してください")
         return
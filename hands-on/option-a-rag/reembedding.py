@@ -0,0 +1,233 @@
+"""
+埋め込みモデル変更時のバックグラウンド再埋め込み
+保存済みのチャンク本文からシャドウコレクションを少しずつ作り、旧コレクションで検索を続けながら
+完成後にエイリアスを切り替える（検索を止めずにモデルを変更する）
+"""
+
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+
+class ReadWriteLock:
+    """読み取りは並行、書き込みは排他のロック（書き込み待ちがあれば新しい読み取りを待たせる）"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.readers = 0
+        self.writer = False
+        self.writers_waiting = 0
+
+    @contextmanager
+    def read(self):
+        with self.condition:
+            while self.writer or self.writers_waiting:
+                self.condition.wait()
+            self.readers += 1
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.readers -= 1
+                self.condition.notify_all()
+
+    @contextmanager
+    def write(self):
+        with self.condition:
+            self.writers_waiting += 1
+            while self.writer or self.readers:
+                self.condition.wait()
+            self.writers_waiting -= 1
+            self.writer = True
+        try:
+            yield
+        finally:
+            with self.condition:
+                self.writer = False
+                self.condition.notify_all()
+
+
+class CollectionAliases:
+    """論理コレクション名 → 実体のコレクション名 の対応表（JSONファイル、置き換えはアトミック）"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+
+    def _load(self) -> Dict:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+
+    def resolve(self, name: str) -> str:
+        """実体のコレクション名（未登録なら論理名そのもの）"""
+        return self._load().get(name, {}).get("physical", name)
+
+    def generation(self, name: str) -> int:
+        return self._load().get(name, {}).get("generation", 0)
+
+    def set(self, name: str, physical: str, generation: int):
+        """対応を更新（一時ファイルに書いてから os.replace で置き換え）"""
+        with self.lock:
+            aliases = self._load()
+            aliases[name] = {"physical": physical, "generation": generation}
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            temp_path = f"{self.path}.tmp"
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(aliases, f, ensure_ascii=False, indent=2)
+            os.replace(temp_path, self.path)
+
+
+class ReembeddingJob:
+    """シャドウコレクションへの再埋め込みと切り替えを行うバックグラウンドジョブ
+
+    ジョブ中に旧コレクションへ書き込まれたチャンクのIDは mark_changed で記録し、切り替え前に
+    シャドウへ再埋め込みする（旧コレクションから消えたチャンクはシャドウからも削除する）。
+    """
+
+    def __init__(self, rag, model_name: str, model=None, batch_size: int = 64,
+                 throttle_seconds: float = 0.1, delete_old: bool = False):
+        self.rag = rag
+        self.model_name = model_name
+        self.model = model
+        self.batch_size = batch_size
+        self.throttle_seconds = throttle_seconds
+        self.delete_old = delete_old
+
+        self.changed_ids = set()
+        self.changes_lock = threading.Lock()
+
+        self.thread = None
+        self.error = None
+        self.progress = {"status": "pending", "total": 0, "embedded": 0, "caught_up": 0, "elapsed": 0.0}
+
+    def start(self) -> "ReembeddingJob":
+        self.thread = threading.Thread(target=self._run_safely, daemon=True)
+        self.thread.start()
+        return self
+
+    def join(self, timeout: Optional[float] = None) -> Dict:
+        if self.thread:
+            self.thread.join(timeout)
+        return self.progress
+
+    @property
+    def running(self) -> bool:
+        return self.progress["status"] in ("pending", "running")
+
+    def mark_changed(self, ids):
+        """旧コレクションで追加・更新されたチャンク（切り替え前にシャドウへ反映する）"""
+        with self.changes_lock:
+            self.changed_ids.update(ids)
+
+    def _run_safely(self):
+        try:
+            self.run()
+        except Exception as e:
+            self.error = e
+            self.progress["status"] = "failed"
+            print(f"❌ 再埋め込みに失敗しました（旧コレクションで検索を継続）: {e}")
+
+    def _copy_chunks(self, source, target, ids) -> int:
+        """source のチャンクを新しいモデルで埋め込んで target に追加・上書き"""
+        added = 0
+        for start in range(0, len(ids), self.batch_size):
+            batch_ids = ids[start:start + self.batch_size]
+            page = source.get(ids=batch_ids, include=["documents", "metadatas"])
+            if not page["ids"]:
+                continue
+            embeddings = self.model.encode(page["documents"]).tolist()
+            target.upsert(
+                ids=page["ids"],
+                documents=page["documents"],
+                metadatas=page["metadatas"],
+                embeddings=embeddings
+            )
+            added += len(page["ids"])
+        return added
+
+    def run(self):
+        rag = self.rag
+        start_time = time.time()
+        self.progress["status"] = "running"
+
+        if self.model is None:
+            from sentence_transformers import SentenceTransformer
+
+            print(f"新しい埋め込みモデル {self.model_name} を読み込み中...")
+            self.model = SentenceTransformer(self.model_name)
+
+        old_collection = rag.collection
+        old_centroid_collection = rag.centroid_index.collection
+        generation = rag.aliases.generation(rag.collection_name) + 1
+        physical = f"{rag.collection_name}__v{generation}"
+        shadow = rag._open_collection(physical, self.model_name)
+        shadow_centroids = rag._open_centroid_collection(physical)
+
+        # 1. 保存済みチャンクを少しずつ再埋め込み（中断後の再実行では作成済みのチャンクを飛ばす）
+        total = old_collection.count()
+        self.progress["total"] = total
+        print(f"🔄 再埋め込み開始: {rag.collection_name} → {physical} ({total}チャンク)")
+
+        for offset in range(0, total, self.batch_size):
+            page = old_collection.get(include=["documents", "metadatas"], limit=self.batch_size, offset=offset)
+            done = set(shadow.get(ids=page["ids"], include=[])["ids"]) if page["ids"] else set()
+            todo = [i for i, chunk_id in enumerate(page["ids"]) if chunk_id not in done]
+
+            if todo:
+                embeddings = self.model.encode([page["documents"][i] for i in todo]).tolist()
+                shadow.upsert(
+                    ids=[page["ids"][i] for i in todo],
+                    documents=[page["documents"][i] for i in todo],
+                    metadatas=[page["metadatas"][i] for i in todo],
+                    embeddings=embeddings
+                )
+
+            self.progress["embedded"] = min(offset + self.batch_size, total)
+            if self.throttle_seconds:
+                time.sleep(self.throttle_seconds)
+
+        # 2. セントロイドを新しい埋め込みで作成
+        centroid_index = type(rag.centroid_index)(shadow_centroids)
+        centroid_index.rebuild(shadow)
+
+        # 3. ジョブ中に追加・更新・削除されたチャンクを反映してから切り替え（検索・取り込みを一時的に止める）
+        with rag.rw_lock.write():
+            old_ids = set(old_collection.get(include=[])["ids"])
+            shadow_ids = set(shadow.get(include=[])["ids"])
+            with self.changes_lock:
+                changed = set(self.changed_ids)
+            recopy = sorted((old_ids - shadow_ids) | (changed & old_ids))
+            removed = sorted(shadow_ids - old_ids)
+
+            # セントロイドは変更前後どちらかのチャンクを含む文書だけ作り直す
+            stale = [chunk_id for chunk_id in recopy if chunk_id in shadow_ids] + removed
+            sources = [m['source'] for m in shadow.get(ids=stale, include=["metadatas"])["metadatas"]] if stale else []
+            if removed:
+                shadow.delete(ids=removed)
+            if recopy:
+                self._copy_chunks(old_collection, shadow, recopy)
+                sources.extend(m['source'] for m in shadow.get(ids=recopy, include=["metadatas"])["metadatas"])
+            centroid_index.refresh(shadow, sources)
+            caught_up = len(recopy) + len(removed)
+            self.progress["caught_up"] = caught_up
+
+            # 渡されたクライアント（埋め込みサーバーなど）をそのまま使う
+            rag.embedding_model = self.model
+            rag.embedding_model_name = self.model_name
+            rag.collection = shadow
+            rag.centroid_index = centroid_index
+            rag.aliases.set(rag.collection_name, physical, generation)
+
+        if self.delete_old:
+            rag._drop_collection(old_collection)
+            rag._drop_collection(old_centroid_collection)
+
+        self.progress["status"] = "done"
+        self.progress["elapsed"] = time.time() - start_time
+        print(f"✅ 埋め込みモデルを {self.model_name} に切り替えました "
+              f"({total}チャンク, 追いつき {caught_up}チャンク, {self.progress['elapsed']:.1f}秒)")
@@ -0,0 +1,242 @@
+"""
+シャーディング：1つの論理コレクションを複数のChromaDBコレクションに分割
+検索は全シャードに並列で投げ、各シャードの上位k件を統合して全体の上位k件を返す
+"""
+
+import hashlib
+import heapq
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional
+
+import chromadb
+
+
+def shard_for_key(key: str, num_shards: int) -> int:
+    """キー（文書のsource）からシャード番号を決定（プロセス間で安定したハッシュ）"""
+    digest = hashlib.md5(key.encode('utf-8')).hexdigest()
+    return int(digest[:8], 16) % num_shards
+
+
+def create_chroma_client(location: str):
+    """保存先からChromaDBクライアントを作成
+
+    "http://host:port" 形式なら別プロセスのChromaサーバー、それ以外はローカルディレクトリ
+    """
+    if location.startswith("http://") or location.startswith("https://"):
+        address = location.split("://", 1)[1].rstrip("/")
+        host, _, port = address.partition(":")
+        return chromadb.HttpClient(
+            host=host,
+            port=int(port or 8000),
+            ssl=location.startswith("https://")
+        )
+    return chromadb.PersistentClient(path=location)
+
+
+def open_collection(client, name: str, metadata: Optional[Dict] = None):
+    """既存のコレクションはメタデータを変更せずに開き、なければ作成"""
+    try:
+        return client.get_collection(name=name)
+    except Exception:
+        return client.create_collection(name=name, metadata=metadata)
+
+
+class ShardedCollection:
+    """複数シャードをまとめてChromaDBのコレクションと同じように扱うクラス"""
+
+    def __init__(self, name: str, shard_locations: List[str], metadata: Optional[Dict] = None,
+                 max_workers: Optional[int] = None):
+        self.name = name
+        self.num_shards = len(shard_locations)
+        self.shard_locations = shard_locations
+
+        # 同じ保存先のシャードはクライアントを共有
+        clients = {}
+        self.clients = []
+        self.shards = []
+        for i, location in enumerate(shard_locations):
+            if location not in clients:
+                clients[location] = create_chroma_client(location)
+            self.clients.append(clients[location])
+            self.shards.append(open_collection(clients[location], f"{name}_shard_{i}", metadata))
+
+        self.metadata = self.shards[0].metadata
+        self.executor = ThreadPoolExecutor(max_workers=max_workers or self.num_shards)
+
+    def _map(self, func, items) -> List:
+        """各シャードへの処理を並列実行"""
+        return list(self.executor.map(func, items))
+
+    def shard_index(self, source: str) -> int:
+        """sourceが格納されるシャード番号"""
+        return shard_for_key(source, self.num_shards)
+
+    def _route(self, ids: List[str], documents: List[str], metadatas: List[Dict],
+               embeddings: List[List[float]]) -> List[Dict]:
+        """チャンクをsourceのハッシュでシャードごとのバッチに振り分け"""
+        batches = [{"ids": [], "documents": [], "metadatas": [], "embeddings": []}
+                   for _ in range(self.num_shards)]
+
+        for chunk_id, document, metadata, embedding in zip(ids, documents, metadatas, embeddings):
+            batch = batches[self.shard_index(metadata.get('source', chunk_id))]
+            batch["ids"].append(chunk_id)
+            batch["documents"].append(document)
+            batch["metadatas"].append(metadata)
+            batch["embeddings"].append(embedding)
+
+        return batches
+
+    def add(self, ids: List[str], documents: List[str], metadatas: List[Dict],
+            embeddings: List[List[float]]):
+        """チャンクをシャードに振り分けて並列追加"""
+        batches = self._route(ids, documents, metadatas, embeddings)
+
+        def add_to_shard(i):
+            if batches[i]["ids"]:
+                self.shards[i].add(**batches[i])
+
+        self._map(add_to_shard, range(self.num_shards))
+
+    def upsert(self, ids: List[str], documents: List[str], metadatas: List[Dict],
+               embeddings: List[List[float]]):
+        """チャンクをシャードに振り分けて並列upsert"""
+        batches = self._route(ids, documents, metadatas, embeddings)
+
+        def upsert_to_shard(i):
+            if batches[i]["ids"]:
+                self.shards[i].upsert(**batches[i])
+
+        self._map(upsert_to_shard, range(self.num_shards))
+
+    def update(self, ids: List[str], metadatas: List[Dict]):
+        """メタデータを更新（sourceからシャードを特定）"""
+        batches = [{"ids": [], "metadatas": []} for _ in range(self.num_shards)]
+        for chunk_id, metadata in zip(ids, metadatas):
+            batch = batches[self.shard_index(metadata.get('source', chunk_id))]
+            batch["ids"].append(chunk_id)
+            batch["metadatas"].append(metadata)
+
+        def update_shard(i):
+            if batches[i]["ids"]:
+                self.shards[i].update(**batches[i])
+
+        self._map(update_shard, range(self.num_shards))
+
+    def query(self, query_embeddings: List[List[float]], n_results: int = 10,
+              where: Optional[Dict] = None, include: Optional[List[str]] = None) -> Dict:
+        """全シャードに並列検索し、距離の小さい順に上位n_results件を統合"""
+        include = include or ["documents", "metadatas", "distances"]
+        fields = [field for field in include if field != "distances"]
+
+        def query_shard(shard):
+            if shard.count() == 0:
+                return None
+            kwargs = {"query_embeddings": query_embeddings, "n_results": n_results,
+                      "include": list(set(include) | {"distances"})}
+            if where:
+                kwargs["where"] = where
+            return shard.query(**kwargs)
+
+        shard_results = [r for r in self._map(query_shard, self.shards) if r]
+
+        merged = {"ids": [], "distances": []}
+        for field in fields:
+            merged[field] = []
+
+        for q in range(len(query_embeddings)):
+            candidates = []
+            for result in shard_results:
+                for i, distance in enumerate(result["distances"][q]):
+                    candidates.append((distance, result, i))
+
+            top = heapq.nsmallest(n_results, candidates, key=lambda c: c[0])
+            merged["ids"].append([result["ids"][q][i] for _, result, i in top])
+            merged["distances"].append([distance for distance, _, _ in top])
+            for field in fields:
+                merged[field].append([result[field][q][i] for _, result, i in top])
+
+        return merged
+
+    def get(self, ids: Optional[List[str]] = None, where: Optional[Dict] = None,
+            include: Optional[List[str]] = None, limit: Optional[int] = None,
+            offset: Optional[int] = None) -> Dict:
+        """全シャードから取得して結合
+
+        limit / offset はシャードを順に連結した全体に対する位置として扱う
+        """
+        include = include or ["documents", "metadatas"]
+
+        merged = {"ids": []}
+        for field in include:
+            merged[field] = []
+
+        def extend(result):
+            merged["ids"].extend(result["ids"])
+            for field in include:
+                values = result.get(field)
+                merged[field].extend(list(values) if values is not None else [])
+
+        if ids is not None or where or (limit is None and not offset):
+            # 絞り込みありの場合は全シャードから取得してから切り出す
+            def get_shard(shard):
+                kwargs = {"include": include}
+                if ids is not None:
+                    kwargs["ids"] = ids
+                if where:
+                    kwargs["where"] = where
+                return shard.get(**kwargs)
+
+            for result in self._map(get_shard, self.shards):
+                extend(result)
+
+            if limit is not None or offset:
+                start = offset or 0
+                end = start + limit if limit is not None else None
+                for key in merged:
+                    merged[key] = merged[key][start:end]
+            return merged
+
+        # ページング: 各シャードの件数から読み出す範囲を決める
+        skip = offset or 0
+        remaining = limit
+        for shard, shard_count in zip(self.shards, self.shard_counts()):
+            if remaining is not None and remaining <= 0:
+                break
+            if skip >= shard_count:
+                skip -= shard_count
+                continue
+
+            kwargs = {"include": include, "offset": skip}
+            if remaining is not None:
+                kwargs["limit"] = remaining
+            result = shard.get(**kwargs)
+            extend(result)
+
+            skip = 0
+            if remaining is not None:
+                remaining -= len(result["ids"])
+
+        return merged
+
+    def delete(self, ids: Optional[List[str]] = None, where: Optional[Dict] = None):
+        """全シャードから削除"""
+        def delete_shard(shard):
+            if ids is not None:
+                shard.delete(ids=ids)
+            elif where:
+                shard.delete(where=where)
+
+        self._map(delete_shard, self.shards)
+
+    def drop(self):
+        """全シャードのコレクションを削除"""
+        for client, shard in zip(self.clients, self.shards):
+            client.delete_collection(shard.name)
+
+    def count(self) -> int:
+        """全シャードの合計チャンク数"""
+        return sum(self._map(lambda shard: shard.count(), self.shards))
+
+    def shard_counts(self) -> List[int]:
+        """シャードごとのチャンク数"""
+        return self._map(lambda shard: shard.count(), self.shards)
@@ -0,0 +1,200 @@
+"""
+インデックスのスナップショット（単一バイナリファイル）の書き出し・読み込み
+新しいノードで再抽出・再埋め込みをせずにコレクションを復元するために使う
+
+ファイル形式:
+    MAGIC (8バイト) | ヘッダー長 (uint64, little endian) | ヘッダー(JSON) | データ部
+データ部の各セクションは64バイト境界に配置する:
+    embeddings        float16 の (count, dim) 連続配列
+    ids.offsets       uint64 の (count + 1) 配列
+    ids.data          UTF-8 文字列を連結したバイト列
+    documents.offsets / documents.data  （ids と同じ形式）
+    metadatas         列指向のJSON {"キー": [値, ...]}
+    array.<名前>      任意の float32 配列（形状はヘッダーの arrays。次元削減の変換など）
+"""
+
+import json
+import struct
+import time
+from typing import Dict, List, Optional
+
+import numpy as np
+
+MAGIC = b"RAGSNAP1"
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+
+
+def _encode_strings(values: List[str]):
+    """文字列リストをオフセット配列と連結バイト列に変換"""
+    encoded = [value.encode('utf-8') for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype='<u8')
+    if encoded:
+        offsets[1:] = np.cumsum([len(data) for data in encoded])
+    return offsets.tobytes(), b"".join(encoded)
+
+
+def _decode_strings(offsets: np.ndarray, data: bytes) -> List[str]:
+    """オフセット配列と連結バイト列から文字列リストを復元"""
+    return [data[offsets[i]:offsets[i + 1]].decode('utf-8') for i in range(len(offsets) - 1)]
+
+
+def _to_columns(metadatas: List[Dict]) -> Dict[str, List]:
+    """メタデータを列指向に変換（存在しない値は None）"""
+    keys = []
+    for metadata in metadatas:
+        for key in metadata or {}:
+            if key not in keys:
+                keys.append(key)
+    return {key: [(metadata or {}).get(key) for metadata in metadatas] for key in keys}
+
+
+def _from_columns(columns: Dict[str, List], count: int) -> List[Dict]:
+    """列指向のメタデータを行ごとの辞書に戻す"""
+    rows = [{} for _ in range(count)]
+    for key, values in columns.items():
+        for row, value in zip(rows, values):
+            if value is not None:
+                row[key] = value
+    return rows
+
+
+def export_collection(collection, path: str, page_size: int = 5000,
+                      extra_header: Optional[Dict] = None,
+                      arrays: Optional[Dict[str, np.ndarray]] = None) -> Dict:
+    """コレクションをスナップショットファイルに書き出す（arrays の配列も一緒に保存する）"""
+    start_time = time.time()
+    total = collection.count()
+
+    ids, documents, metadatas, embedding_pages = [], [], [], []
+    for offset in range(0, total, page_size):
+        page = collection.get(
+            include=["embeddings", "documents", "metadatas"],
+            limit=page_size,
+            offset=offset
+        )
+        ids.extend(page["ids"])
+        documents.extend(page["documents"])
+        metadatas.extend(page["metadatas"])
+        embedding_pages.append(np.asarray(page["embeddings"], dtype=np.float16))
+
+    embeddings = np.concatenate(embedding_pages) if embedding_pages else np.zeros((0, 0), dtype=np.float16)
+    embeddings = np.ascontiguousarray(embeddings, dtype='<f2')
+
+    sections = {}
+    sections["embeddings"] = embeddings.tobytes()
+    sections["ids.offsets"], sections["ids.data"] = _encode_strings(ids)
+    sections["documents.offsets"], sections["documents.data"] = _encode_strings(documents)
+    sections["metadatas"] = json.dumps(_to_columns(metadatas), ensure_ascii=False).encode('utf-8')
+    array_shapes = {}
+    for name, array in (arrays or {}).items():
+        array = np.ascontiguousarray(array, dtype='<f4')
+        sections[f"array.{name}"] = array.tobytes()
+        array_shapes[name] = list(array.shape)
+
+    layout = {}
+    position = 0
+    for name, data in sections.items():
+        position = (position + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+        layout[name] = {"offset": position, "length": len(data)}
+        position += len(data)
+
+    header = {
+        "version": FORMAT_VERSION,
+        "collection_name": collection.name,
+        "collection_metadata": collection.metadata,
+        "count": len(ids),
+        "dim": int(embeddings.shape[1]) if embeddings.ndim == 2 and len(ids) else 0,
+        "dtype": "float16",
+        "sections": layout,
+        "arrays": array_shapes,
+        "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+    }
+    header.update(extra_header or {})
+    header_bytes = json.dumps(header, ensure_ascii=False).encode('utf-8')
+
+    with open(path, 'wb') as f:
+        f.write(MAGIC)
+        f.write(struct.pack('<Q', len(header_bytes)))
+        f.write(header_bytes)
+        data_start = f.tell()
+        for name, data in sections.items():
+            f.seek(data_start + layout[name]["offset"])
+            f.write(data)
+
+    return {
+        "path": path,
+        "count": header["count"],
+        "dim": header["dim"],
+        "bytes": data_start + position,
+        "elapsed": time.time() - start_time,
+    }
+
+
+class Snapshot:
+    """読み込んだスナップショット（埋め込みは読み込んだバッファを直接参照する）"""
+
+    def __init__(self, header: Dict, embeddings: np.ndarray, ids: List[str],
+                 documents: List[str], metadatas: List[Dict], arrays: Optional[Dict[str, np.ndarray]] = None):
+        self.header = header
+        self.embeddings = embeddings
+        self.ids = ids
+        self.documents = documents
+        self.metadatas = metadatas
+        self.arrays = arrays or {}
+
+    @property
+    def count(self) -> int:
+        return len(self.ids)
+
+
+def load_snapshot(path: str) -> Snapshot:
+    """スナップショットファイルを読み込む（ファイルを一括で読み、コピーせずに配列化）"""
+    with open(path, 'rb') as f:
+        buffer = f.read()
+
+    if buffer[:len(MAGIC)] != MAGIC:
+        raise ValueError(f"スナップショット形式ではありません: {path}")
+
+    header_length = struct.unpack_from('<Q', buffer, len(MAGIC))[0]
+    header_start = len(MAGIC) + 8
+    header = json.loads(buffer[header_start:header_start + header_length].decode('utf-8'))
+    if header.get("version") != FORMAT_VERSION:
+        raise ValueError(f"未対応のスナップショットバージョンです: {header.get('version')}")
+
+    data_start = header_start + header_length
+    view = memoryview(buffer)
+
+    def section(name: str) -> memoryview:
+        info = header["sections"][name]
+        start = data_start + info["offset"]
+        return view[start:start + info["length"]]
+
+    count, dim = header["count"], header["dim"]
+    embeddings = np.frombuffer(section("embeddings"), dtype='<f2').reshape(count, dim)
+    ids = _decode_strings(np.frombuffer(section("ids.offsets"), dtype='<u8'), bytes(section("ids.data")))
+    documents = _decode_strings(np.frombuffer(section("documents.offsets"), dtype='<u8'),
+                                bytes(section("documents.data")))
+    metadatas = _from_columns(json.loads(bytes(section("metadatas")).decode('utf-8')), count)
+    arrays = {
+        name: np.frombuffer(section(f"array.{name}"), dtype='<f4').reshape(shape)
+        for name, shape in header.get("arrays", {}).items()
+    }
+
+    return Snapshot(header, embeddings, ids, documents, metadatas, arrays)
+
+
+def import_snapshot(collection, snapshot: Snapshot, batch_size: int = 5000) -> Dict:
+    """スナップショットをコレクションへ一括投入（再埋め込みはしない）"""
+    start_time = time.time()
+
+    for start in range(0, snapshot.count, batch_size):
+        end = min(start + batch_size, snapshot.count)
+        collection.upsert(
+            ids=snapshot.ids[start:end],
+            documents=snapshot.documents[start:end],
+            metadatas=snapshot.metadatas[start:end],
+            embeddings=snapshot.embeddings[start:end].astype(np.float32).tolist()
+        )
+
+    return {"count": snapshot.count, "elapsed": time.time() - start_time}
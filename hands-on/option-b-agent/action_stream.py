@@ -0,0 +1,77 @@
+"""
+LLMのストリーミング出力から Action 行を検出する
+行が完成するたびに解析し、完成した Action はすぐに返す（呼び出し側は生成の終了を待たずにツールを実行できる）。
+Action のあとにモデルが自分で Observation や次の手順を書き始めたら、そこで完了とする
+（ツールの結果を見ずに書かれた内容は使わないため、生成を打ち切ってよい）。
+
+完了までに受け取った行（text()）を parse_actions で解析すると、返した Action と同じものが得られる。
+"""
+
+from typing import Callable, Dict, List, Optional, Tuple
+
+Action = Tuple[str, Dict]
+
+# LLMに渡す停止シーケンス（自分で Observation を書き始めたら生成を止める）
+STOP_SEQUENCES = ["\nObservation"]
+
+
+class StreamingActionParser:
+    """ストリーミングされたテキストを行単位で解析
+
+    parse_line: "Action:" より後ろの文字列を (ツール名, パラメータ) に変換する関数（解析できなければ (None, None)）
+    """
+
+    def __init__(self, parse_line: Callable[[str], Tuple[Optional[str], Optional[Dict]]]):
+        self.parse_line = parse_line
+        self.buffer = ""
+        self.lines: List[str] = []
+        self.actions: List[Action] = []
+        self.done = False
+        self.final = False
+
+    def feed(self, chunk: str) -> List[Action]:
+        """チャンクを追加し、新しく完成した Action を返す"""
+        if self.done:
+            return []
+        self.buffer += chunk
+        completed = []
+        while "\n" in self.buffer and not self.done:
+            line, self.buffer = self.buffer.split("\n", 1)
+            completed.extend(self._line(line))
+        return completed
+
+    def finish(self) -> List[Action]:
+        """ストリームの終了時に、改行で終わっていない最後の行を解析"""
+        if self.done or not self.buffer:
+            return []
+        line, self.buffer = self.buffer, ""
+        return self._line(line)
+
+    def _line(self, line: str) -> List[Action]:
+        if self.final:
+            # Final Answer は複数行になることがあるため最後まで読む
+            self.lines.append(line)
+            return []
+        if line.startswith("Observation"):
+            self.done = True
+            return []
+        if self.actions and line.strip() and not line.startswith("Action:"):
+            # Action のあとに次の手順を書き始めた
+            self.done = True
+            return []
+
+        self.lines.append(line)
+        if "Final Answer:" in line:
+            self.final = True
+            return []
+        if line.startswith("Action:"):
+            tool_name, parameters = self.parse_line(line[7:].strip())
+            if tool_name:
+                action = (tool_name, parameters)
+                self.actions.append(action)
+                return [action]
+        return []
+
+    def text(self) -> str:
+        """これまでに受け取った（打ち切った位置より前の）テキスト"""
+        return "\n".join(self.lines)
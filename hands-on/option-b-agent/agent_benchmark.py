@@ -0,0 +1,437 @@
+"""
+ReActAgent のベンチマーク
+タスクスイートを複数セッションで同時に実行し、タスクごとの反復回数・LLM呼び出し回数とレイテンシ・
+ツールのレイテンシ・反復ごとの送信トークン数・成否を集計してJSONに保存する
+（保存したJSONを compare で比較すると、エージェントの変更前後の差を確認できる）
+
+スタブLLMはタスクごとの台本（script）を順に返すため、オフラインで毎回同じ結果になる。
+
+使い方:
+    python agent_benchmark.py run --repeat 50 --concurrency 16 --llm-latency 0.2 --output bench.json
+    python agent_benchmark.py run --tasks my_tasks.json --real-llm
+    python agent_benchmark.py compare before.json after.json
+"""
+
+import argparse
+import asyncio
+import json
+import subprocess
+import sys
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# プロジェクトルートをPythonパスに追加
+project_root = Path(__file__).parent.parent.parent
+sys.path.append(str(project_root))
+
+from common.llm_client import LLMClient, StubBackend
+from agent_session import current_session
+from agent_system import ReActAgent
+
+# 各タスクの script はスタブLLMが反復ごとに返す応答（台本がない場合は最後の応答を繰り返す）
+DEFAULT_TASKS = [
+    {
+        "id": "calc",
+        "category": "計算",
+        "task": "2+2を計算してください",
+        "expected": ["4"],
+        "expected_tools": ["calculate"],
+        "script": [
+            "Thought: 計算ツールを使います\nAction: calculate(expression=2+2)",
+            "Thought: 結果が得られました\nFinal Answer: 2+2の答えは4です",
+        ],
+    },
+    {
+        "id": "calc_multi_step",
+        "category": "計算",
+        "task": "25 * 4 + 100 を計算し、その結果を4で割ってください",
+        "expected": ["50"],
+        "expected_tools": ["calculate"],
+        "script": [
+            "Thought: まず最初の式を計算します\nAction: calculate(expression=25 * 4 + 100)",
+            "Thought: 結果を4で割ります\nAction: calculate(expression=200 / 4)",
+            "Thought: 答えが出ました\nFinal Answer: 答えは50です",
+        ],
+    },
+    {
+        "id": "weather",
+        "category": "情報取得",
+        "task": "東京の天気を教えてください",
+        "expected": ["晴れ"],
+        "expected_tools": ["get_weather"],
+        "script": [
+            # モデルが結果を待たずに Observation と回答を書き続けるケース（Action 行で止める必要がある）
+            "Thought: 天気を調べます\nAction: get_weather(location=東京)\n"
+            "Observation: 東京の天気: 雨\nThought: 雨のようです\nFinal Answer: 東京は雨です",
+            "Thought: 分かりました\nFinal Answer: 東京の天気は晴れです",
+        ],
+    },
+    {
+        "id": "weather_parallel",
+        "category": "情報取得",
+        "task": "東京と大阪の天気を比べてください",
+        "expected": ["東京", "大阪"],
+        "expected_tools": ["get_weather"],
+        "script": [
+            "Thought: 2都市の天気を同時に調べます\n"
+            "Action: get_weather(location=東京)\nAction: get_weather(location=大阪)",
+            "Thought: 比較できます\nFinal Answer: 東京は晴れ、大阪は曇りです",
+        ],
+    },
+    {
+        "id": "memo",
+        "category": "メモリ操作",
+        "task": "テストメモを保存して確認してください",
+        "expected": ["テストメモ"],
+        "expected_tools": ["save_memo", "get_memo"],
+        "script": [
+            "Thought: メモを保存します\nAction: save_memo(key=test, content=テストメモ)",
+            "Thought: 確認します\nAction: get_memo(key=test)",
+            "Thought: 保存されていました\nFinal Answer: テストメモを保存して確認しました",
+        ],
+    },
+    {
+        "id": "memo_search",
+        "category": "メモリ操作",
+        "task": "出張の予定をメモして、あとで検索してください",
+        "expected": ["出張"],
+        "expected_tools": ["save_memo", "search_memo"],
+        "script": [
+            "Thought: 予定を保存します\nAction: save_memo(key=trip/osaka, content=来週の大阪出張は月曜日)",
+            "Thought: 検索します\nAction: search_memo(query=出張)",
+            "Thought: 見つかりました\nFinal Answer: 大阪出張は月曜日です",
+        ],
+    },
+]
+
+
+class ScriptedResponder:
+    """タスクの台本を返すスタブLLMの応答関数
+
+    実行中のセッション（current_session）ごとに何回目の呼び出しかを数えるため、
+    同じタスクを同時に複数実行しても台本が混ざらない。
+    """
+
+    def __init__(self, default_response: str = "Final Answer: （台本がありません）"):
+        self.default_response = default_response
+        self.scripts: Dict[str, List[str]] = {}
+        self.steps: Dict[str, int] = {}
+        self.lock = threading.Lock()
+
+    def assign(self, session_id: str, script: Optional[List[str]]):
+        with self.lock:
+            self.scripts[session_id] = list(script or [self.default_response])
+            self.steps[session_id] = 0
+
+    def __call__(self, prompt: str) -> str:
+        session = current_session.get()
+        session_id = session.session_id if session else "default"
+        with self.lock:
+            script = self.scripts.get(session_id, [self.default_response])
+            step = self.steps.get(session_id, 0)
+            self.steps[session_id] = step + 1
+        return script[min(step, len(script) - 1)]
+
+
+def percentile(values: List[float], p: float) -> float:
+    """パーセンタイル値（最近傍法）"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize_latencies(latencies: List[float]) -> Dict:
+    """レイテンシ（秒）の統計をミリ秒で集計"""
+    return {
+        "count": len(latencies),
+        "avg_ms": sum(latencies) / len(latencies) * 1000 if latencies else 0.0,
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p95_ms": percentile(latencies, 95) * 1000,
+        "max_ms": max(latencies) * 1000 if latencies else 0.0,
+    }
+
+
+def instrument(agent: ReActAgent) -> Dict[str, Dict]:
+    """LLM呼び出しとツール実行の時間をセッションごとに記録するようにエージェントを包む"""
+    records: Dict[str, Dict] = {}
+    lock = threading.Lock()
+
+    def record(kind: str, name: str, elapsed: float):
+        session = current_session.get()
+        session_id = session.session_id if session else "default"
+        with lock:
+            entry = records.setdefault(session_id, {"llm": [], "tools": []})
+            entry[kind].append((name, elapsed))
+
+    generate_step = agent.generate_step
+    # すべての実行方式で実際にツールを呼ぶのは _execute（thread のツールは I/O 用スレッド上で呼ばれる）
+    execute = agent.tool_registry._execute
+
+    def timed_generate_step(prompt: str):
+        start_time = time.perf_counter()
+        try:
+            return generate_step(prompt)
+        finally:
+            record("llm", "llm", time.perf_counter() - start_time)
+
+    def timed_execute(tool_name: str, parameters: Dict, cancel_event=None) -> str:
+        start_time = time.perf_counter()
+        try:
+            return execute(tool_name, parameters, cancel_event)
+        finally:
+            record("tools", tool_name, time.perf_counter() - start_time)
+
+    agent.generate_step = timed_generate_step
+    agent.tool_registry._execute = timed_execute
+    return records
+
+
+def judge(task: Dict, answer: str, tools_used: List[str]) -> Dict:
+    """期待するキーワードがすべて回答に含まれ、期待するツールがすべて使われたか"""
+    missing_keywords = [k for k in task.get("expected", []) if k.lower() not in answer.lower()]
+    missing_tools = [t for t in task.get("expected_tools", []) if t not in tools_used]
+    return {
+        "success": not missing_keywords and not missing_tools,
+        "missing_keywords": missing_keywords,
+        "missing_tools": missing_tools,
+    }
+
+
+async def _run_task(agent: ReActAgent, task: Dict, run_id: str, semaphore: asyncio.Semaphore,
+                    records: Dict[str, Dict], responder: Optional[ScriptedResponder]) -> Dict:
+    session = agent.create_session(run_id)
+    if responder is not None:
+        responder.assign(session.session_id, task.get("script"))
+
+    async with semaphore:
+        start_time = time.perf_counter()
+        try:
+            answer, error = await agent.arun(task["task"], task.get("max_iterations", 10), session=session), None
+        except Exception as e:
+            answer, error = "", f"{type(e).__name__}: {e}"
+        elapsed = time.perf_counter() - start_time
+
+    record = records.pop(session.session_id, {"llm": [], "tools": []})
+    tools_used = [name for name, _ in record["tools"]]
+    stats = session.last_run_stats or {"iterations": 0, "tokens_per_iteration": [], "total_tokens": 0}
+    result = {
+        "run_id": run_id,
+        "task_id": task["id"],
+        "category": task.get("category", ""),
+        "answer": answer,
+        "error": error,
+        "wall_time_ms": elapsed * 1000,
+        "iterations": stats["iterations"],
+        "llm_calls": len(record["llm"]),
+        "llm_latency_ms": [latency * 1000 for _, latency in record["llm"]],
+        "tool_calls": tools_used,
+        "tool_latency_ms": [latency * 1000 for _, latency in record["tools"]],
+        "prompt_tokens_per_step": stats["tokens_per_iteration"],
+        "prompt_tokens": stats["total_tokens"],
+    }
+    result.update(judge(task, answer, tools_used))
+    if error:
+        result["success"] = False
+    return result
+
+
+def _summarize(results: List[Dict], wall_time: float) -> Dict:
+    llm_latencies = [latency / 1000 for r in results for latency in r["llm_latency_ms"]]
+    tool_latencies = [latency / 1000 for r in results for latency in r["tool_latency_ms"]]
+    task_times = [r["wall_time_ms"] / 1000 for r in results]
+    total = len(results)
+    return {
+        "runs": total,
+        "success_rate": sum(r["success"] for r in results) / total if total else 0.0,
+        "errors": sum(1 for r in results if r["error"]),
+        "wall_time_s": wall_time,
+        "throughput_tasks_per_s": total / wall_time if wall_time else 0.0,
+        "avg_iterations": sum(r["iterations"] for r in results) / total if total else 0.0,
+        "llm_calls": sum(r["llm_calls"] for r in results),
+        "prompt_tokens": sum(r["prompt_tokens"] for r in results),
+        "avg_prompt_tokens_per_task": sum(r["prompt_tokens"] for r in results) / total if total else 0.0,
+        "task_latency": summarize_latencies(task_times),
+        "llm_latency": summarize_latencies(llm_latencies),
+        "tool_latency": summarize_latencies(tool_latencies),
+    }
+
+
+def _group(results: List[Dict], key: str) -> Dict[str, Dict]:
+    groups: Dict[str, List[Dict]] = {}
+    for result in results:
+        groups.setdefault(result[key], []).append(result)
+    return {
+        name: {
+            "runs": len(items),
+            "success_rate": sum(r["success"] for r in items) / len(items),
+            "avg_iterations": sum(r["iterations"] for r in items) / len(items),
+            "avg_llm_calls": sum(r["llm_calls"] for r in items) / len(items),
+            "avg_prompt_tokens": sum(r["prompt_tokens"] for r in items) / len(items),
+            "p95_task_ms": percentile([r["wall_time_ms"] for r in items], 95),
+        }
+        for name, items in groups.items()
+    }
+
+
+def git_revision() -> Optional[str]:
+    """計測したコードのリビジョン（git がなければ None）"""
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=str(project_root),
+            capture_output=True, text=True, timeout=5
+        ).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def run_benchmark(agent: ReActAgent, tasks: Optional[List[Dict]] = None, repeat: int = 1,
+                  concurrency: int = 8, responder: Optional[ScriptedResponder] = None,
+                  config: Optional[Dict] = None, output: Optional[str] = None) -> Dict:
+    """タスクスイートを repeat 回ずつ、最大 concurrency セッション同時に実行して結果をJSONに保存
+
+    responder を渡すと、各実行のセッションに対応するタスクの台本を割り当てる（スタブLLM用）。
+    """
+    tasks = tasks or DEFAULT_TASKS
+    records = instrument(agent)
+
+    async def run_all() -> List[Dict]:
+        semaphore = asyncio.Semaphore(concurrency)
+        runs = [
+            _run_task(agent, task, f"bench-{task['id']}-{i}", semaphore, records, responder)
+            for i in range(repeat) for task in tasks
+        ]
+        return await asyncio.gather(*runs)
+
+    start_time = time.perf_counter()
+    results = asyncio.run(run_all())
+    wall_time = time.perf_counter() - start_time
+
+    report = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "revision": git_revision(),
+        "config": dict(config or {}, repeat=repeat, concurrency=concurrency, tasks=[t["id"] for t in tasks]),
+        "summary": _summarize(results, wall_time),
+        "llm_metrics": {key: value for key, value in agent.llm.get_metrics().items()
+                        if key in ("requests", "output_tokens", "streams_cancelled", "replay_hits")},
+        "by_task": _group(results, "task_id"),
+        "by_category": _group(results, "category"),
+        "runs": results,
+    }
+
+    if output:
+        with open(output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"\n結果を保存しました: {output}")
+    return report
+
+
+def print_report(report: Dict):
+    """結果の要約を表示"""
+    summary = report["summary"]
+    print(f"\n📈 ベンチマーク結果（{summary['runs']}件, リビジョン {report.get('revision') or '不明'}）")
+    print(f"成功率: {summary['success_rate']:.1%}  エラー: {summary['errors']}件")
+    print(f"全体時間: {summary['wall_time_s']:.2f}秒  スループット: {summary['throughput_tasks_per_s']:.2f}タスク/秒")
+    print(f"タスク p50/p95: {summary['task_latency']['p50_ms']:.0f} / {summary['task_latency']['p95_ms']:.0f} ms")
+    print(f"LLM   {summary['llm_latency']['count']}回 p50/p95: "
+          f"{summary['llm_latency']['p50_ms']:.0f} / {summary['llm_latency']['p95_ms']:.0f} ms")
+    print(f"ツール {summary['tool_latency']['count']}回 p50/p95: "
+          f"{summary['tool_latency']['p50_ms']:.1f} / {summary['tool_latency']['p95_ms']:.1f} ms")
+    print(f"送信トークン（概算）: 合計 {summary['prompt_tokens']}, 1タスク平均 {summary['avg_prompt_tokens_per_task']:.0f}")
+    llm_metrics = report.get("llm_metrics", {})
+    if llm_metrics:
+        print(f"出力トークン（概算）: {llm_metrics.get('output_tokens', 0)}, "
+              f"打ち切ったストリーム: {llm_metrics.get('streams_cancelled', 0)}件")
+
+    print(f"\n{'タスク':<18} {'件数':>5} {'成功率':>7} {'反復':>5} {'LLM回数':>8} {'トークン':>8} {'p95(ms)':>9}")
+    for task_id, stats in report["by_task"].items():
+        print(f"{task_id:<18} {stats['runs']:>5} {stats['success_rate']:>7.0%} {stats['avg_iterations']:>5.1f} "
+              f"{stats['avg_llm_calls']:>8.1f} {stats['avg_prompt_tokens']:>8.0f} {stats['p95_task_ms']:>9.0f}")
+
+
+def compare_reports(before: Dict, after: Dict):
+    """2つの結果の主要な指標を比較して表示"""
+    metrics = [
+        ("成功率", lambda s: s["success_rate"] * 100, "%"),
+        ("スループット", lambda s: s["throughput_tasks_per_s"], "タスク/秒"),
+        ("タスク p95", lambda s: s["task_latency"]["p95_ms"], "ms"),
+        ("LLM p95", lambda s: s["llm_latency"]["p95_ms"], "ms"),
+        ("ツール p95", lambda s: s["tool_latency"]["p95_ms"], "ms"),
+        ("平均反復回数", lambda s: s["avg_iterations"], "回"),
+        ("1タスク平均トークン", lambda s: s["avg_prompt_tokens_per_task"], ""),
+    ]
+    def name_of(report: Dict) -> str:
+        return report["config"].get("label") or report.get("revision") or report["timestamp"]
+
+    print(f"📊 {name_of(before)} → {name_of(after)}")
+    for name, metric, unit in metrics:
+        old, new = metric(before["summary"]), metric(after["summary"])
+        change = f"{(new - old) / old:+.1%}" if old else "-"
+        print(f"  {name:<14} {old:>10.2f} → {new:>10.2f} {unit} ({change})")
+
+
+def main():
+    """ベンチマークのコマンドライン"""
+    parser = argparse.ArgumentParser(description="ReActAgent のベンチマーク")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = subparsers.add_parser("run", help="ベンチマークを実行")
+    run_parser.add_argument("--tasks", help="タスクスイートのJSON（DEFAULT_TASKS と同じ形式）")
+    run_parser.add_argument("--repeat", type=int, default=10, help="各タスクの実行回数")
+    run_parser.add_argument("--concurrency", type=int, default=8, help="同時に実行するセッション数")
+    run_parser.add_argument("--llm-latency", type=float, default=0.1, help="スタブLLMの最初の出力までの秒数")
+    run_parser.add_argument("--llm-token-latency", type=float, default=0.0, help="スタブLLMの出力1トークンごとの秒数")
+    run_parser.add_argument("--no-stream", action="store_true", help="応答のストリーミング（Action 行での打ち切り）を使わない")
+    run_parser.add_argument("--real-llm", action="store_true", help="スタブではなく設定済みのLLMを使う")
+    run_parser.add_argument("--label", help="結果に残すラベル（比較用）")
+    run_parser.add_argument("--output", default="agent_benchmark_results.json")
+
+    compare_parser = subparsers.add_parser("compare", help="2つの結果を比較")
+    compare_parser.add_argument("before")
+    compare_parser.add_argument("after")
+
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        with open(args.before, 'r', encoding='utf-8') as f:
+            before = json.load(f)
+        with open(args.after, 'r', encoding='utf-8') as f:
+            after = json.load(f)
+        compare_reports(before, after)
+        return
+
+    tasks = None
+    if args.tasks:
+        with open(args.tasks, 'r', encoding='utf-8') as f:
+            tasks = json.load(f)
+
+    # スタブの場合はエージェントの作成前にクライアントを渡す（Gemini などの設定や依存パッケージは不要）
+    responder = None
+    llm = None
+    if not args.real_llm:
+        responder = ScriptedResponder()
+        llm = LLMClient(
+            # stream では停止シーケンスを無視し、幻覚の Observation をエージェント側の打ち切りで止める
+            StubBackend(responder=responder, latency=args.llm_latency, token_latency=args.llm_token_latency,
+                        stream_stop_sequences=False),
+            requests_per_minute=0,
+            max_concurrency=args.concurrency,
+            max_retries=0
+        )
+    agent = ReActAgent(max_concurrent_llm_calls=args.concurrency, on_background_complete=lambda task: None,
+                       stream_actions=not args.no_stream, llm=llm)
+
+    config = {
+        "label": args.label,
+        "llm": "real" if args.real_llm else f"scripted-stub({args.llm_latency}s, {args.llm_token_latency}s/token)",
+        "stream_actions": not args.no_stream,
+    }
+    report = run_benchmark(agent, tasks, args.repeat, args.concurrency, responder, config, args.output)
+    print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,39 @@
+"""
+エージェントのセッション（ユーザーごとの状態）
+会話履歴・直近のトランスクリプトをセッションに持たせ、モデルとツールは1つのエージェントで共有する
+（メモは memory_store にセッションIDごとの名前空間で保存する）
+（実行中のセッションは contextvars で受け渡すため、スレッドや asyncio のタスクをまたいでも混ざらない）
+"""
+
+import contextvars
+import uuid
+from datetime import datetime
+from typing import Dict, List, Optional
+
+
+class AgentSession:
+    """1ユーザー分のエージェントの状態
+
+    session_id はメモの名前空間になる。省略時は uuid4 で生成する
+    （永続化したメモを再起動後も使う場合は、ユーザーごとに固定のIDを渡す）。
+    """
+
+    def __init__(self, session_id: Optional[str] = None):
+        self.session_id = session_id or f"session-{uuid.uuid4().hex}"
+        self.conversation_history: List[Dict] = []
+        self.transcript = None
+        self.last_run_stats: Optional[Dict] = None
+
+    def record(self, task: str, answer: str):
+        """完了したタスクと回答を履歴に追加"""
+        self.conversation_history.append({
+            "task": task,
+            "answer": answer,
+            "timestamp": datetime.now().isoformat()
+        })
+
+
+# 実行中のセッション（ツールはここから自分のセッションのメモなどを参照する）
+current_session: "contextvars.ContextVar[Optional[AgentSession]]" = contextvars.ContextVar(
+    "current_session", default=None
+)
@@ -3,78 +3,330 @@ Option B: AIエージェントの開発
 Function Callingと外部APIとの連携
 """
 
+import asyncio
+import contextvars
 import os
 import sys
 from pathlib import Path
 import json
 import time
 import requests
-from datetime import datetime
-from typing import Dict, List, Any, Callable
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from types import MappingProxyType
+from typing import Dict, List, Any, Callable, Mapping, Optional, Tuple
 
 # プロジェクトルートをPythonパスに追加
-project_root = Path(__file__).parent.parent
+project_root = Path(__file__).parent.parent.parent
 sys.path.append(str(project_root))
 
-import google.generativeai as genai
 from dotenv import load_dotenv
 
+from common.llm_client import LLMClient, estimate_tokens, get_backend_name, get_llm_client
+from action_stream import STOP_SEQUENCES, StreamingActionParser
+from agent_session import AgentSession, current_session
+from arithmetic import ExpressionError, get_default_engine
+from memory_store import MemoryStore, create_memory_store
+from task_scheduler import BackgroundTask, TaskScheduler
+from tool_cache import CACHE_NEVER, CACHE_POLICIES, CACHE_PURE, CACHE_TTL, ToolResultCache, canonical_parameters
+from tool_runner import (RUN_INLINE, RUN_MODES, RUN_PROCESS, RUN_THREAD, ProcessToolPool, ThreadToolPool,
+                         TimeoutWatchdog, ToolTimeoutError, accepts_cancel_event, check_picklable)
+from tracing import Tracer, create_tracer
+from transcript import Transcript
+
 # 環境変数読み込み
 load_dotenv()
 
 class ToolRegistry:
     """ツール（関数）の登録・管理クラス"""
     
-    def __init__(self):
+    def __init__(self, max_workers: int = 4, cache_size: int = 256, tracer: Optional[Tracer] = None,
+                 default_timeout: float = 30.0, process_workers: int = 2):
         self.tools = {}
+        self._descriptions = None
+        # ツール実行ごとのスパン（トレーサー未指定なら記録しない）
+        self.tracer = tracer or Tracer()
+        # 複数アクションの同時実行用（初回の並列実行時に作成）
+        self.max_workers = max_workers
+        self.executor = None
+        # run='thread' のツール用（呼び出し元とは別のスレッドで実行し、期限は watchdog がまとめて監視する）
+        self.default_timeout = default_timeout
+        self.io_pool = None
+        self.io_pool_lock = threading.Lock()
+        self.watchdog = TimeoutWatchdog()
+        # run='process' のツール用（最初に登録されたときにワーカーを起動しておく）
+        self.process_workers = process_workers
+        self.process_pool = None
+        # 実行結果のキャッシュ（ツールごとの方針は register で指定）
+        self.cache = ToolResultCache(cache_size)
     
-    def register(self, name: str, func: Callable, description: str, parameters: Dict):
-        """ツールを登録"""
+    def register(self, name: str, func: Callable, description: str, parameters: Dict,
+                 cache: str = CACHE_NEVER, ttl: Optional[float] = None,
+                 run: str = RUN_THREAD, timeout: Optional[float] = None):
+        """ツールを登録
+
+        cache: "pure"（同じパラメータなら結果を再利用）、"ttl"（ttl 秒間再利用）、"never"（毎回実行）
+        run: "inline"（そのまま実行）、"thread"（I/O待ちのツール）、"process"（CPUを使う重いツール）
+        timeout: thread / process の制限時間（秒、省略時は default_timeout）。超えた場合は中断して
+                 タイムアウトを Observation として返す
+        """
+        if cache not in CACHE_POLICIES:
+            raise ValueError(f"未対応のキャッシュ方針です: {cache}（{', '.join(CACHE_POLICIES)} のいずれか）")
+        if cache == CACHE_TTL and not ttl:
+            raise ValueError("cache='ttl' の場合は ttl（秒）を指定してください")
+        if run not in RUN_MODES:
+            raise ValueError(f"未対応の実行方式です: {run}（{', '.join(RUN_MODES)} のいずれか）")
+        if run == RUN_PROCESS:
+            check_picklable(func)
+            if self.process_pool is None:
+                self.process_pool = ProcessToolPool(self.process_workers)
+        
         self.tools[name] = {
             "function": func,
             "description": description,
-            "parameters": parameters
+            "parameters": parameters,
+            "cache": cache,
+            "ttl": ttl if cache == CACHE_TTL else None,
+            "run": run,
+            "timeout": timeout if timeout is not None else self.default_timeout,
+            "cancel_event": run == RUN_THREAD and accepts_cancel_event(func)
         }
+        self.cache.invalidate(name)
+        self._descriptions = None
     
     def get_tool_descriptions(self) -> str:
-        """ツールの説明をテキスト形式で取得"""
+        """ツールの説明をテキスト形式で取得（ツールが変わるまで再利用）"""
+        if self._descriptions is not None:
+            return self._descriptions
         descriptions = []
         for name, tool in self.tools.items():
             desc = f"**{name}**\n"
             desc += f"説明: {tool['description']}\n"
             desc += f"パラメータ: {json.dumps(tool['parameters'], ensure_ascii=False, indent=2)}\n"
             descriptions.append(desc)
-        return "\n".join(descriptions)
+        self._descriptions = "\n".join(descriptions)
+        return self._descriptions
     
     def execute(self, tool_name: str, parameters: Dict) -> Any:
         """ツールを実行"""
-        if tool_name not in self.tools:
-            return f"エラー: ツール '{tool_name}' が見つかりません"
+        if self._runs_on_thread(tool_name):
+            return self._start(tool_name, parameters).result()
+        return self._execute(tool_name, parameters)
+    
+    def _runs_on_thread(self, tool_name: str) -> bool:
+        return tool_name in self.tools and self.tools[tool_name]["run"] == RUN_THREAD
+    
+    def _execute(self, tool_name: str, parameters: Dict, cancel_event: Optional[threading.Event] = None) -> Any:
+        """ツールを実行（run='thread' のツールは I/O 用スレッド上で呼ばれ、cancel_event で中断を依頼される）"""
+        with self.tracer.span("tool.execute", tool=tool_name) as span:
+            if tool_name not in self.tools:
+                span.set_error("unknown tool")
+                return f"エラー: ツール '{tool_name}' が見つかりません"
+            
+            tool = self.tools[tool_name]
+            func = tool["function"]
+            
+            # キャッシュ対象のツールは、正規化したパラメータが同じなら前回の結果を返す
+            key = None
+            if tool["cache"] != CACHE_NEVER:
+                key = canonical_parameters(func, parameters)
+                hit, result = self.cache.get(tool_name, key)
+                span.set_attribute("cache_hit", hit)
+                if hit:
+                    return result
+            
+            try:
+                result = self._invoke(tool, parameters, cancel_event)
+            except ToolTimeoutError as e:
+                # タイムアウトもモデルが判断できるよう Observation として返す（キャッシュしない）
+                span.set_error(f"timeout: {e}")
+                return f"ツール実行タイムアウト: '{tool_name}' を中断しました（{e}）"
+            except Exception as e:
+                # 失敗した結果はキャッシュしない
+                span.set_error(f"{type(e).__name__}: {e}")
+                return f"ツール実行エラー: {e}"
+            
+            if cancel_event is not None and cancel_event.is_set():
+                # 期限後に戻った結果は呼び出し元に返らないため、キャッシュもしない
+                span.set_error(f"timeout: {tool['timeout']}秒 以内に完了しませんでした")
+                return None
+            
+            span.set_attribute("result_chars", len(str(result)))
+            if key is not None:
+                self.cache.put(tool_name, key, result, tool["ttl"])
+            return result
+    
+    def _invoke(self, tool: Dict, parameters: Dict, cancel_event: Optional[threading.Event] = None) -> Any:
+        """ツールの実行方式に従って関数を呼び出す"""
+        func = tool["function"]
+        if tool["run"] == RUN_PROCESS:
+            return self.process_pool.run(func, parameters, tool["timeout"])
+        if tool["cancel_event"] and cancel_event is not None:
+            parameters = dict(parameters, cancel_event=cancel_event)
+        return func(**parameters)
+    
+    def _start(self, tool_name: str, parameters: Dict) -> Future:
+        """run='thread' のツールを I/O 用スレッドで実行開始（結果は Observation として Future に入る）
         
-        try:
-            func = self.tools[tool_name]["function"]
-            return func(**parameters)
-        except Exception as e:
-            return f"ツール実行エラー: {e}"
+        制限時間を過ぎたら、開始前なら「実行待ちのまま期限切れ」、実行中なら「中断」として結果を確定する。
+        """
+        with self.io_pool_lock:
+            if self.io_pool is None:
+                self.io_pool = ThreadToolPool(max(8, self.max_workers * 2))
+        
+        timeout = self.tools[tool_name]["timeout"]
+        context = contextvars.copy_context()
+        cancel_event = threading.Event()
+        outer = Future()
+        outer_lock = threading.Lock()
+        
+        def resolve(result=None, error=None):
+            with outer_lock:
+                if outer.done():
+                    return
+                if error is not None:
+                    outer.set_exception(error)
+                else:
+                    outer.set_result(result)
+        
+        def finished(future: Future):
+            if not future.cancelled():
+                resolve(future.result() if future.exception() is None else None, future.exception())
+        
+        def expire():
+            if outer.done() or inner.done():
+                return
+            if inner.cancel():
+                # スレッドが空かず開始できなかった（ツール自体は動いていない）
+                context.run(self._record_queue_timeout, tool_name, timeout)
+                resolve(f"ツール実行タイムアウト: '{tool_name}' は実行待ちのまま {timeout}秒 経過しました"
+                        f"（ツール実行スレッドが不足しています）")
+                return
+            # 実行中のツールに中断を依頼する（スレッドは強制終了できない）
+            cancel_event.set()
+            self.io_pool.abandon(inner)
+            resolve(f"ツール実行タイムアウト: '{tool_name}' を中断しました（{timeout}秒 以内に完了しませんでした）")
+        
+        inner = self.io_pool.submit(context.run, self._execute, tool_name, parameters, cancel_event)
+        inner.add_done_callback(finished)
+        self.watchdog.call_later(timeout, expire)
+        return outer
+    
+    def _record_queue_timeout(self, tool_name: str, timeout: float):
+        with self.tracer.span("tool.execute", tool=tool_name) as span:
+            span.set_error(f"queue timeout: 実行待ちのまま {timeout}秒 経過しました")
+    
+    def shutdown(self):
+        """ツール実行用のスレッドとワーカープロセスを停止"""
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+        if self.io_pool is not None:
+            self.io_pool.shutdown()
+        if self.process_pool is not None:
+            self.process_pool.shutdown()
+    
+    def cache_stats(self) -> Dict:
+        """ツールごとのキャッシュのヒット数・ヒット率"""
+        return self.cache.snapshot()
+    
+    def submit(self, tool_name: str, parameters: Dict) -> Future:
+        """ツールをスレッドプールで実行開始（呼び出し元のコンテキスト＝実行中のセッションを引き継ぐ）"""
+        if self._runs_on_thread(tool_name):
+            # I/O 用スレッドで直接実行する（待つだけのスレッドを別に使わない）
+            return self._start(tool_name, parameters)
+        with self.io_pool_lock:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="tool")
+        return self.executor.submit(contextvars.copy_context().run, self.execute, tool_name, parameters)
+    
+    def execute_many(self, calls: List[Tuple[str, Dict]]) -> List[Any]:
+        """複数のツールをスレッドプールで同時に実行（結果は呼び出しと同じ順番）"""
+        if len(calls) <= 1:
+            return [self.execute(tool_name, parameters) for tool_name, parameters in calls]
+        
+        futures = [self.submit(tool_name, parameters) for tool_name, parameters in calls]
+        return [future.result() for future in futures]
 
 class ReActAgent:
-    """ReAct（Reasoning and Acting）パターンのエージェント"""
+    """ReAct（Reasoning and Acting）パターンのエージェント
+
+    モデル・ツールは全セッションで共有し、メモや会話履歴はセッション（AgentSession）ごとに持つ。
+    run / arun に session を渡すと、1つのエージェントで複数ユーザーを同時に処理できる
+    （省略時は既定のセッション）。arun での同時LLM呼び出しは max_concurrent_llm_calls 件まで。
+    """
     
-    def __init__(self, model_name="gemini-pro"):
-        # Google Gemini API設定
-        genai.configure(api_key=os.getenv('GOOGLE_API_KEY'))
-        self.llm = genai.GenerativeModel(model_name)
+    def __init__(self, model_name="gemini-pro", max_parallel_tools: int = 4,
+                 on_background_complete: Optional[Callable[[BackgroundTask], None]] = None,
+                 max_prompt_tokens: int = 4000, keep_recent_steps: int = 3,
+                 max_observation_tokens: int = 500, max_concurrent_llm_calls: int = 16,
+                 memory_store: Optional[MemoryStore] = None, tracer: Optional[Tracer] = None,
+                 stream_actions: bool = True, session_id: Optional[str] = None,
+                 llm: Optional[LLMClient] = None):
+        # LLMクライアント（レート制限・リトライ付きの共有クライアント。llm を渡すとそれを使う）
+        self.llm = llm or get_llm_client(model_name)
+        
+        # 応答をストリーミングし、Action 行が揃った時点で生成を打ち切ってツールを実行する
+        # （モデルが自分で書く Observation 以降は停止シーケンスでも止める）
+        self.stream_actions = stream_actions
+        self.generation_config = {"stop_sequences": list(STOP_SEQUENCES)}
+        
+        # run・反復・LLM呼び出し・ツール実行のスパン（AGENT_TRACE_FILE を設定するとファイルに出力）
+        self.tracer = tracer or create_tracer()
         
-        # ツールレジストリ
-        self.tool_registry = ToolRegistry()
+        # ツールレジストリ（1ステップ内の複数アクションは最大 max_parallel_tools 個を同時実行）
+        self.tool_registry = ToolRegistry(max_workers=max_parallel_tools, tracer=self.tracer)
         
-        # メモリ
-        self.conversation_history = []
-        self.working_memory = {}
+        # セッション（メモ・会話履歴）。session を指定しない呼び出しは既定のセッションを使う
+        # （既定のセッションのID＝メモの名前空間は session_id か環境変数 AGENT_SESSION_ID。どちらもなければ毎回新しいID）
+        self.default_session = AgentSession(session_id or os.getenv('AGENT_SESSION_ID'))
+        
+        # メモの保存先（セッションIDごとの名前空間に保存。AGENT_MEMORY_DB を設定すると SQLite に永続化）
+        self.memory_store = memory_store or create_memory_store()
+        
+        # arun 用（LLM呼び出しとツール実行はスレッドで行い、同時LLM呼び出し数を制限）
+        self.max_concurrent_llm_calls = max_concurrent_llm_calls
+        self._llm_semaphore = None
+        self._llm_semaphore_loop = None
+        self._async_executor = None
+        
+        # 毎回送るプロンプトの上限（古いステップは要約し、長いObservationは切り詰める）
+        self.max_prompt_tokens = max_prompt_tokens
+        self.keep_recent_steps = keep_recent_steps
+        self.max_observation_tokens = max_observation_tokens
+        
+        # タイマーや時間のかかるツールはバックグラウンドで実行し、結果は次の反復で Observation として渡す
+        self.scheduler = TaskScheduler(max_workers=max_parallel_tools)
+        self.on_background_complete = on_background_complete or self._print_background_result
         
         # デフォルトツールの登録
         self._register_default_tools()
     
+    @property
+    def session(self) -> AgentSession:
+        """実行中のセッション（run / arun の外では既定のセッション）"""
+        return current_session.get() or self.default_session
+    
+    @property
+    def working_memory(self) -> Mapping[str, Dict]:
+        """実行中のセッションのメモ（キー → メモ）の読み取り専用のスナップショット
+
+        書き込みは反映されないため変更できない。メモの保存・削除は memory_store で行う。
+        """
+        memos = {memo["key"]: memo for memo in self.memory_store.list(self.session.session_id)}
+        return MappingProxyType(memos)
+    
+    @property
+    def conversation_history(self) -> List[Dict]:
+        return self.session.conversation_history
+    
+    @property
+    def last_run_stats(self) -> Optional[Dict]:
+        return self.session.last_run_stats
+    
+    def create_session(self, session_id: Optional[str] = None) -> AgentSession:
+        """新しいセッションを作成"""
+        return AgentSession(session_id)
+    
     def _register_default_tools(self):
         """デフォルトツールの登録"""
         
@@ -82,14 +334,10 @@ class ReActAgent:
         def calculate(expression: str) -> str:
             """数式を計算"""
             try:
-                # 安全な計算のため、eval は使わずに基本的な演算のみ
-                allowed_chars = set('0123456789+-*/.() ')
-                if not all(c in allowed_chars for c in expression):
-                    return "エラー: 無効な文字が含まれています"
-                
-                result = eval(expression)
+                # eval は使わず、式の長さ・指数・数値の大きさを制限したエンジンで計算
+                result = get_default_engine().evaluate(expression)
                 return f"計算結果: {result}"
-            except Exception as e:
+            except ExpressionError as e:
                 return f"計算エラー: {e}"
         
         self.tool_registry.register(
@@ -101,7 +349,9 @@ class ReActAgent:
                     "type": "string",
                     "description": "計算する数式（例: 2+3*4）"
                 }
-            }
+            },
+            cache=CACHE_PURE,
+            run=RUN_INLINE
         )
         
         # 天気情報ツール（モック）
@@ -131,16 +381,19 @@ class ReActAgent:
                     "type": "string", 
                     "description": "天気を調べたい場所（例: 東京）"
                 }
-            }
+            },
+            cache=CACHE_TTL,
+            ttl=600,
+            timeout=10
         )
         
         # メモ保存ツール
         def save_memo(key: str, content: str) -> str:
             """メモを保存"""
-            self.working_memory[key] = {
-                "content": content,
-                "timestamp": datetime.now().isoformat()
-            }
+            try:
+                self.memory_store.save(self.session.session_id, key, content)
+            except ValueError as e:
+                return f"メモを保存できませんでした: {e}"
             return f"メモ '{key}' を保存しました"
         
         self.tool_registry.register(
@@ -155,10 +408,14 @@ class ReActAgent:
         
         # メモ取得ツール
         def get_memo(key: str) -> str:
-            """メモを取得"""
-            if key in self.working_memory:
-                memo = self.working_memory[key]
+            """メモを取得（見つからない場合は前方一致するキーを候補として返す）"""
+            memo = self.memory_store.get(self.session.session_id, key)
+            if memo is not None:
                 return f"メモ '{key}': {memo['content']} (保存日時: {memo['timestamp']})"
+            candidates = self.memory_store.search_prefix(self.session.session_id, key, limit=5)
+            if candidates:
+                keys = ", ".join(candidate["key"] for candidate in candidates)
+                return f"メモ '{key}' は見つかりませんでした（候補: {keys}）"
             return f"メモ '{key}' は見つかりませんでした"
         
         self.tool_registry.register(
@@ -170,7 +427,29 @@ class ReActAgent:
             }
         )
         
-        # タイマーツール
+        # メモ検索ツール（キーが分からないときに内容から探す）
+        def search_memo(query: str, limit: int = 5) -> str:
+            """メモを検索"""
+            try:
+                limit = max(1, min(int(limit), 20))
+            except (TypeError, ValueError):
+                limit = 5
+            memos = self.memory_store.recall(self.session.session_id, query, limit)
+            if not memos:
+                return f"'{query}' に関するメモは見つかりませんでした"
+            return "\n".join(f"- {memo['key']}: {memo['content']}" for memo in memos)
+        
+        self.tool_registry.register(
+            "search_memo",
+            search_memo,
+            "保存されたメモを内容から検索します",
+            {
+                "query": {"type": "string", "description": "検索語"},
+                "limit": {"type": "integer", "description": "最大件数（省略時5）"}
+            }
+        )
+        
+        # タイマーツール（エージェントを止めずにバックグラウンドで待つ）
         def set_timer(seconds: int, message: str = "時間です！") -> str:
             """タイマーを設定"""
             try:
@@ -180,72 +459,224 @@ class ReActAgent:
                 if seconds > 3600:  # 1時間以上は制限
                     return "エラー: 1時間以内で設定してください"
                 
-                print(f"⏰ {seconds}秒のタイマーを開始...")
-                time.sleep(seconds)
-                return f"🔔 {message}"
+                task = self.scheduler.schedule(
+                    "set_timer",
+                    lambda: f"🔔 {message}",
+                    delay=seconds,
+                    callback=self.on_background_complete,
+                    owner=self.session.session_id
+                )
+                return f"⏰ {seconds}秒のタイマーを開始しました（タスクID: {task.task_id}）。終了すると通知されます"
             except ValueError:
                 return "エラー: 有効な数値を指定してください"
         
         self.tool_registry.register(
             "set_timer",
             set_timer,
-            "指定された秒数のタイマーを設定します",
+            "指定された秒数のタイマーを設定します（すぐに戻り、終了は後で通知されます）",
             {
                 "seconds": {"type": "integer", "description": "タイマーの秒数"},
                 "message": {"type": "string", "description": "タイマー終了時のメッセージ（オプション）"}
-            }
+            },
+            run=RUN_INLINE
+        )
+        
+        # バックグラウンドタスクの確認ツール
+        def check_tasks(task_id: str = "") -> str:
+            """バックグラウンドタスクの状態を取得"""
+            tasks = self.scheduler.list_tasks(owner=self.session.session_id)
+            if task_id:
+                tasks = [task for task in tasks if task.task_id == task_id]
+                if not tasks:
+                    return f"タスク '{task_id}' は見つかりませんでした"
+            else:
+                if not tasks:
+                    return "バックグラウンドタスクはありません"
+            # ここで結果を返した完了タスクは、次の反復では通知しない
+            self.scheduler.mark_delivered(tasks)
+            return "\n".join(task.describe() for task in tasks)
+        
+        self.tool_registry.register(
+            "check_tasks",
+            check_tasks,
+            "バックグラウンドタスク（タイマーなど）の状態を確認します",
+            {
+                "task_id": {"type": "string", "description": "確認するタスクID（省略時はすべて）"}
+            },
+            run=RUN_INLINE
+        )
+        
+        # バックグラウンドタスクの完了待ちツール
+        def wait_task(task_id: str, timeout: int = 30) -> str:
+            """バックグラウンドタスクの完了を待つ（最大60秒）"""
+            try:
+                timeout = min(max(int(timeout), 0), 60)
+            except ValueError:
+                return "エラー: 有効な数値を指定してください"
+            task = self.scheduler.get(task_id)
+            if task is None or task.owner != self.session.session_id:
+                return f"タスク '{task_id}' は見つかりませんでした"
+            self.scheduler.wait(task_id, timeout)
+            self.scheduler.mark_delivered([task])
+            return task.describe()
+        
+        self.tool_registry.register(
+            "wait_task",
+            wait_task,
+            "バックグラウンドタスクの完了を待ちます（結果が次の手順に必要な場合のみ使用）",
+            {
+                "task_id": {"type": "string", "description": "待つタスクID"},
+                "timeout": {"type": "integer", "description": "最大待ち時間（秒、最大60）"}
+            },
+            # 待ち時間はツール自身が制限する
+            run=RUN_INLINE
         )
     
+    def _print_background_result(self, task: BackgroundTask):
+        """バックグラウンドタスク完了時の既定の通知"""
+        print(f"\n📬 バックグラウンドタスク完了: {task.describe()}")
+    
+    def _background_observations(self) -> List[str]:
+        """前の反復以降に完了したバックグラウンドタスクの結果を Observation に変換"""
+        finished = self.scheduler.collect_finished(owner=self.session.session_id)
+        return [f"Observation (バックグラウンド {task.describe()})" for task in finished]
+    
     def parse_action(self, text: str) -> tuple:
-        """テキストからアクション情報を抽出"""
+        """テキストから最初のアクション情報を抽出"""
+        actions = self.parse_actions(text)
+        return actions[0] if actions else (None, None)
+    
+    def parse_actions(self, text: str) -> List[Tuple[str, Dict]]:
+        """テキストからすべてのアクション情報を抽出（1ステップに複数の Action 行を書ける）"""
+        actions = []
         lines = text.strip().split('\n')
         
         for line in lines:
+            # モデルが自分で書いた Observation 以降は実行しない
+            if line.startswith('Observation'):
+                break
             if line.startswith('Action:'):
-                action_part = line[7:].strip()
-                
-                # JSON形式のパラメータを探す
-                if '{' in action_part and '}' in action_part:
-                    # JSON部分を抽出
-                    start = action_part.find('{')
-                    json_part = action_part[start:]
-                    tool_name = action_part[:start].strip()
-                    
-                    try:
-                        parameters = json.loads(json_part)
-                        return tool_name, parameters
-                    except json.JSONDecodeError:
-                        pass
-                
-                # 関数呼び出し形式を解析 tool_name(param1=value1, param2=value2)
-                if '(' in action_part and ')' in action_part:
-                    tool_name = action_part.split('(')[0].strip()
-                    param_part = action_part.split('(')[1].split(')')[0]
-                    
-                    parameters = {}
-                    if param_part.strip():
-                        # パラメータを解析（簡易版）
-                        for param in param_part.split(','):
-                            if '=' in param:
-                                key, value = param.split('=', 1)
-                                key = key.strip()
-                                value = value.strip().strip('"\'')
-                                parameters[key] = value
-                    
-                    return tool_name, parameters
+                tool_name, parameters = self._parse_action_line(line[7:].strip())
+                if tool_name:
+                    actions.append((tool_name, parameters))
+        
+        return actions
+    
+    def _parse_action_line(self, action_part: str) -> tuple:
+        """Action 行の本体を (ツール名, パラメータ) に変換"""
+        # JSON形式のパラメータを探す
+        if '{' in action_part and '}' in action_part:
+            # JSON部分を抽出
+            start = action_part.find('{')
+            json_part = action_part[start:]
+            tool_name = action_part[:start].strip()
+            
+            try:
+                parameters = json.loads(json_part)
+                return tool_name, parameters
+            except json.JSONDecodeError:
+                pass
+        
+        # 関数呼び出し形式を解析 tool_name(param1=value1, param2=value2)
+        if '(' in action_part and ')' in action_part:
+            tool_name = action_part.split('(')[0].strip()
+            param_part = action_part.split('(')[1].split(')')[0]
+            
+            parameters = {}
+            if param_part.strip():
+                # パラメータを解析（簡易版）
+                for param in param_part.split(','):
+                    if '=' in param:
+                        key, value = param.split('=', 1)
+                        key = key.strip()
+                        value = value.strip().strip('"\'')
+                        parameters[key] = value
+            
+            return tool_name, parameters
         
         return None, None
     
     def generate_response(self, prompt: str) -> str:
         """LLMで応答を生成"""
-        try:
-            response = self.llm.generate_content(prompt)
+        with self.tracer.span("llm.generate", prompt_chars=len(prompt), prompt_tokens=estimate_tokens(prompt)) as span:
+            try:
+                response = self.llm.generate(prompt, generation_config=self.generation_config)
+            except Exception as e:
+                span.set_error(f"{type(e).__name__}: {e}")
+                return f"LLM応答生成エラー: {e}"
+            span.set_attribute("response_chars", len(response.text))
             return response.text
-        except Exception as e:
-            return f"LLM応答生成エラー: {e}"
     
-    def run(self, task: str, max_iterations: int = 10, verbose: bool = True) -> str:
-        """ReActループを実行"""
+    def generate_step(self, prompt: str) -> Tuple[str, List[Tuple[Tuple[str, Dict], Future]]]:
+        """1反復分の応答を生成（応答と、生成中に実行を開始したツールの (アクション, Future) のリスト）"""
+        if not self.stream_actions:
+            return self.generate_response(prompt), []
+        
+        with self.tracer.span("llm.generate", prompt_chars=len(prompt), prompt_tokens=estimate_tokens(prompt),
+                              streaming=True) as span:
+            parser = StreamingActionParser(self._parse_action_line)
+            dispatched = []
+            stream = self.llm.stream(prompt, generation_config=self.generation_config)
+            try:
+                for chunk in stream:
+                    # Action 行が揃ったら生成の終了を待たずに実行を開始
+                    for tool_name, parameters in parser.feed(chunk):
+                        dispatched.append(((tool_name, parameters), self.tool_registry.submit(tool_name, parameters)))
+                    if parser.done:
+                        span.set_attribute("stopped_early", True)
+                        break
+                for tool_name, parameters in parser.finish():
+                    dispatched.append(((tool_name, parameters), self.tool_registry.submit(tool_name, parameters)))
+            except Exception as e:
+                span.set_error(f"{type(e).__name__}: {e}")
+                # 実行を開始したツールがあれば、そこまでの応答で続ける
+                if not dispatched:
+                    return f"LLM応答生成エラー: {e}", []
+            finally:
+                stream.close()
+            
+            text = parser.text()
+            span.set_attribute("response_chars", len(text))
+            span.set_attribute("dispatched_actions", len(dispatched))
+            return text, dispatched
+    
+    def _execute_actions(self, actions: List[Tuple[str, Dict]],
+                         dispatched: List[Tuple[Tuple[str, Dict], Future]]) -> List[Any]:
+        """アクションを実行（生成中に実行を開始したものは、その結果を待つ）
+
+        実行開始済みのアクションは1件ずつ対応させ、二重に実行しない（副作用のあるツールがあるため）。
+        ストリームが途中で失敗した場合の最後の行など、開始していないアクションだけを新たに実行する。
+        """
+        if not dispatched:
+            return self.tool_registry.execute_many(actions)
+        
+        remaining = list(dispatched)
+        futures = []
+        for action in actions:
+            match = next((i for i, (started, _) in enumerate(remaining) if started == action), None)
+            if match is not None:
+                futures.append(remaining.pop(match)[1])
+            else:
+                futures.append(self.tool_registry.submit(*action))
+        return [future.result() for future in futures]
+    
+    def _react_loop(self, task: str, session: AgentSession, max_iterations: int, verbose: bool):
+        """ReActループ本体（run と arun で共有）
+
+        LLM呼び出しとツール実行は ("llm", prompt) / ("tools", actions) として yield し、
+        呼び出し側が実行した結果を send で受け取る。戻り値は最終回答。
+        """
+        with self.tracer.span("agent.run", session_id=session.session_id, task_chars=len(task),
+                              max_iterations=max_iterations) as span:
+            final_answer, completed = yield from self._react_iterations(task, session, max_iterations, verbose)
+            stats = session.last_run_stats or {}
+            span.set_attribute("iterations", stats.get("iterations", 0))
+            span.set_attribute("prompt_tokens", stats.get("total_tokens", 0))
+            span.set_attribute("completed", completed)
+            return final_answer
+    
+    def _react_iterations(self, task: str, session: AgentSession, max_iterations: int, verbose: bool):
+        """ReActの反復（(最終回答, 完了したか) を返す）"""
         
         if verbose:
             print(f"🎯 タスク: {task}")
@@ -268,67 +699,195 @@ Thought: 現在の状況を分析し、次に何をすべきかを考える
 Action: tool_name(parameter1=value1, parameter2=value2)
 Observation: [ツールの実行結果がここに表示されます]
 
+互いに結果を必要としない複数のアクションは、Action 行を続けて書くと同時に実行されます：
+Action: get_weather(location=東京)
+Action: get_weather(location=大阪)
+
 最終的な答えが得られたら、以下の形式で回答してください：
 Final Answer: [最終的な回答]
 
 それでは始めてください：
 """
         
-        conversation = [prompt]
+        transcript = Transcript(
+            prompt,
+            max_tokens=self.max_prompt_tokens,
+            keep_recent_steps=self.keep_recent_steps,
+            max_observation_tokens=self.max_observation_tokens
+        )
+        
+        session.transcript = transcript
         
         for iteration in range(max_iterations):
-            if verbose:
-                print(f"\n--- 反復 {iteration + 1} ---")
-            
-            # LLMで次のステップを生成
-            current_prompt = "\n".join(conversation)
-            response = self.generate_response(current_prompt)
-            
-            if verbose:
-                print(f"🤖 エージェント:\n{response}")
-            
-            conversation.append(response)
-            
-            # Final Answerがある場合は終了
-            if "Final Answer:" in response:
-                final_answer = response.split("Final Answer:")[1].strip()
+            with self.tracer.span("agent.iteration", iteration=iteration + 1) as iteration_span:
                 if verbose:
-                    print(f"\n✅ 最終回答: {final_answer}")
-                return final_answer
-            
-            # アクションを解析・実行
-            tool_name, parameters = self.parse_action(response)
-            
-            if tool_name and parameters is not None:
-                if verbose:
-                    print(f"🔧 ツール実行: {tool_name}({parameters})")
+                    print(f"\n--- 反復 {iteration + 1} ---")
+                
+                # 完了したバックグラウンドタスクの結果を渡す
+                for observation in self._background_observations():
+                    transcript.add_observation(observation)
+                    if verbose:
+                        print(f"📬 {observation}")
                 
-                # ツール実行
-                result = self.tool_registry.execute(tool_name, parameters)
-                observation = f"Observation: {result}"
+                # LLMで次のステップを生成（トークン予算内に収めたプロンプト）
+                current_prompt = transcript.render()
+                session.last_run_stats = transcript.stats()
+                response = yield ("llm", current_prompt)
+                iteration_span.set_attribute("prompt_tokens", transcript.sent_tokens[-1])
+                iteration_span.set_attribute("response_chars", len(response))
                 
                 if verbose:
-                    print(f"👁️ 観察結果: {result}")
+                    print(f"📨 送信トークン（概算）: {transcript.sent_tokens[-1]}")
+                    print(f"🤖 エージェント:\n{response}")
                 
-                conversation.append(observation)
-            
-            else:
-                # アクションが解析できない場合
-                if "Action:" in response:
-                    error_msg = "Observation: アクションの形式が正しくありません。tool_name(parameter=value)の形式で指定してください。"
-                    conversation.append(error_msg)
+                transcript.add_response(response)
+                
+                # Final Answerがある場合は終了
+                if "Final Answer:" in response:
+                    final_answer = response.split("Final Answer:")[1].strip()
+                    if verbose:
+                        print(f"\n✅ 最終回答: {final_answer}")
+                    iteration_span.set_attribute("final", True)
+                    return final_answer, True
+                
+                # アクションを解析・実行（複数ある場合は同時に実行）
+                actions = self.parse_actions(response)
+                iteration_span.set_attribute("actions", len(actions))
+                
+                if actions:
                     if verbose:
-                        print(f"⚠️ {error_msg}")
+                        for tool_name, parameters in actions:
+                            print(f"🔧 ツール実行: {tool_name}({parameters})")
+                    
+                    # ツール実行
+                    results = yield ("tools", actions)
+                    if len(actions) == 1:
+                        transcript.add_observation(f"Observation: {results[0]}")
+                    else:
+                        for i, ((tool_name, _), result) in enumerate(zip(actions, results), 1):
+                            transcript.add_observation(f"Observation {i} ({tool_name}): {result}")
+                    
+                    if verbose:
+                        for result in results:
+                            print(f"👁️ 観察結果: {result}")
+                
+                else:
+                    # アクションが解析できない場合
+                    if "Action:" in response:
+                        error_msg = "Observation: アクションの形式が正しくありません。tool_name(parameter=value)の形式で指定してください。"
+                        transcript.add_observation(error_msg)
+                        if verbose:
+                            print(f"⚠️ {error_msg}")
         
         # 最大反復数に達した場合
         final_msg = "最大反復数に達しました。タスクを完了できませんでした。"
         if verbose:
             print(f"\n❌ {final_msg}")
-        return final_msg
+        return final_msg, False
+    
+    def _start_session(self, session: Optional[AgentSession]) -> Tuple[AgentSession, contextvars.Token]:
+        session = session or self.default_session
+        return session, current_session.set(session)
+    
+    def run(self, task: str, max_iterations: int = 10, verbose: bool = True,
+            session: Optional[AgentSession] = None) -> str:
+        """ReActループを実行（session 省略時は既定のセッション）"""
+        session, token = self._start_session(session)
+        loop = self._react_loop(task, session, max_iterations, verbose)
+        try:
+            result = None
+            dispatched = []
+            while True:
+                try:
+                    kind, payload = loop.send(result)
+                except StopIteration as stop:
+                    answer = stop.value
+                    break
+                if kind == "llm":
+                    result, dispatched = self.generate_step(payload)
+                else:
+                    result = self._execute_actions(payload, dispatched)
+            session.record(task, answer)
+            return answer
+        finally:
+            # 途中で例外が発生した場合も、開いているスパンをこのコンテキストで閉じる
+            loop.close()
+            current_session.reset(token)
+    
+    async def arun(self, task: str, max_iterations: int = 10, verbose: bool = False,
+                   session: Optional[AgentSession] = None) -> str:
+        """ReActループを非同期に実行
+
+        LLM呼び出しとツール実行はスレッドで行うため、イベントループを止めずに
+        多数のセッションを asyncio.gather などで同時に処理できる。
+        """
+        session, token = self._start_session(session)
+        loop = self._react_loop(task, session, max_iterations, verbose)
+        try:
+            result = None
+            dispatched = []
+            while True:
+                try:
+                    kind, payload = loop.send(result)
+                except StopIteration as stop:
+                    answer = stop.value
+                    break
+                if kind == "llm":
+                    async with self._get_llm_semaphore():
+                        result, dispatched = await self._run_in_thread(self.generate_step, payload)
+                else:
+                    result = await self._run_in_thread(self._execute_actions, payload, dispatched)
+            session.record(task, answer)
+            return answer
+        finally:
+            # 途中で例外が発生した場合も、開いているスパンをこのコンテキストで閉じる
+            loop.close()
+            current_session.reset(token)
     
-    def add_tool(self, name: str, func: Callable, description: str, parameters: Dict):
-        """カスタムツールを追加"""
-        self.tool_registry.register(name, func, description, parameters)
+    def _get_llm_semaphore(self) -> asyncio.Semaphore:
+        """同時LLM呼び出し数を制限するセマフォ（イベントループごとに作成）"""
+        loop = asyncio.get_running_loop()
+        if self._llm_semaphore is None or self._llm_semaphore_loop is not loop:
+            self._llm_semaphore = asyncio.Semaphore(self.max_concurrent_llm_calls)
+            self._llm_semaphore_loop = loop
+        return self._llm_semaphore
+    
+    async def _run_in_thread(self, func: Callable, *args):
+        """現在のコンテキスト（セッション）を引き継いでスレッドで実行"""
+        if self._async_executor is None:
+            self._async_executor = ThreadPoolExecutor(
+                max_workers=self.max_concurrent_llm_calls + self.tool_registry.max_workers,
+                thread_name_prefix="agent"
+            )
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(self._async_executor, context.run, func, *args)
+    
+    def add_tool(self, name: str, func: Callable, description: str, parameters: Dict,
+                 background: bool = False, cache: str = CACHE_NEVER, ttl: Optional[float] = None,
+                 run: str = RUN_THREAD, timeout: Optional[float] = None):
+        """カスタムツールを追加
+
+        cache / ttl でキャッシュ方針を指定できる（ToolRegistry.register を参照。ツール側の変更は不要）。
+        run / timeout で実行方式と制限時間を指定できる（I/O待ちは "thread"、CPUを使う重い処理は "process"）。
+        background=True の場合、ツールはタスクIDをすぐに返してバックグラウンドで実行され、
+        結果は次の反復で Observation として渡される（時間のかかるツール向け）。
+        """
+        if background:
+            def run_in_background(**parameters) -> str:
+                task = self.scheduler.submit(
+                    name,
+                    lambda: func(**parameters),
+                    callback=self.on_background_complete,
+                    owner=self.session.session_id
+                )
+                return f"バックグラウンドで実行を開始しました（タスクID: {task.task_id}）"
+            
+            # バックグラウンドツールはタスクIDを返すため、結果はキャッシュしない
+            self.tool_registry.register(name, run_in_background, f"{description}（バックグラウンド実行）", parameters,
+                                        run=RUN_INLINE)
+        else:
+            self.tool_registry.register(name, func, description, parameters, cache=cache, ttl=ttl,
+                                        run=run, timeout=timeout)
     
     def list_tools(self):
         """利用可能なツールをリスト表示"""
@@ -363,6 +922,18 @@ def demo_basic_agent():
         if i < len(tasks):
             input("\n次のタスクに進むには Enter を押してください...")
 
+def text_analysis(text: str) -> str:
+    """テキスト分析（ワーカープロセスに渡せるようトップレベルで定義）"""
+    word_count = len(text.split())
+    char_count = len(text)
+    char_count_no_spaces = len(text.replace(' ', ''))
+    
+    return f"""テキスト分析結果:
+- 文字数: {char_count}
+- 文字数（空白除く）: {char_count_no_spaces}
+- 単語数: {word_count}
+- 平均単語長: {char_count_no_spaces/max(word_count, 1):.1f}文字"""
+
 def demo_custom_tools():
     """カスタムツールデモ"""
     print("🛠️ カスタムツールデモ")
@@ -393,25 +964,16 @@ def demo_custom_tools():
         }
     )
     
-    def text_analysis(text: str) -> str:
-        """テキスト分析"""
-        word_count = len(text.split())
-        char_count = len(text)
-        char_count_no_spaces = len(text.replace(' ', ''))
-        
-        return f"""テキスト分析結果:
-- 文字数: {char_count}
-- 文字数（空白除く）: {char_count_no_spaces}
-- 単語数: {word_count}
-- 平均単語長: {char_count_no_spaces/word_count:.1f}文字"""
-    
+    # 長いテキストではCPUを使うため、ワーカープロセスで制限時間付きで実行
     agent.add_tool(
         "text_analysis",
         text_analysis,
         "テキストの統計情報を分析します",
         {
             "text": {"type": "string", "description": "分析するテキスト"}
-        }
+        },
+        run=RUN_PROCESS,
+        timeout=10
     )
     
     # カスタムツールのテスト
@@ -469,82 +1031,38 @@ def interactive_demo():
         print(f"\n📋 最終結果: {result}")
 
 def benchmark_agent():
-    """エージェントのベンチマーク"""
+    """エージェントのベンチマーク（agent_benchmark.py のタスクスイートを設定済みのLLMで1回ずつ実行）
+
+    スタブLLMでの同時実行や結果の比較は agent_benchmark.py のコマンドラインを使う。
+    """
+    from agent_benchmark import print_report, run_benchmark
+    
     print("📊 エージェントベンチマーク")
     print("=" * 40)
     
-    agent = ReActAgent()
+    agent = ReActAgent(on_background_complete=lambda task: None)
+    report = run_benchmark(agent, repeat=1, concurrency=1, config={"llm": "real"})
+    print_report(report)
     
-    benchmark_tasks = [
-        {
-            "task": "2+2を計算してください",
-            "expected_keyword": "4",
-            "category": "計算"
-        },
-        {
-            "task": "東京の天気を教えてください",
-            "expected_keyword": "天気",
-            "category": "情報取得"
-        },
-        {
-            "task": "テストメモを保存して確認してください",
-            "expected_keyword": "テストメモ",
-            "category": "メモリ操作"
-        }
-    ]
+    # ツール結果キャッシュ
+    cache_stats = agent.tool_registry.cache_stats()
+    if cache_stats["tools"]:
+        print("\nツールキャッシュ:")
+        for tool_name, stats in cache_stats["tools"].items():
+            print(f"  {tool_name}: ヒット {stats['hits']}/{stats['hits'] + stats['misses']} ({stats['hit_rate']:.0%})")
     
-    results = []
-    
-    for i, test in enumerate(benchmark_tasks, 1):
-        print(f"\n📝 テスト {i}: {test['category']}")
-        print(f"タスク: {test['task']}")
-        
-        start_time = time.time()
-        result = agent.run(test['task'], verbose=False)
-        execution_time = time.time() - start_time
-        
-        # 成功判定（簡易版）
-        success = test['expected_keyword'].lower() in result.lower()
-        
-        results.append({
-            "task": test['task'],
-            "category": test['category'],
-            "success": success,
-            "execution_time": execution_time,
-            "result": result
-        })
-        
-        print(f"結果: {'✅ 成功' if success else '❌ 失敗'}")
-        print(f"実行時間: {execution_time:.2f}秒")
-    
-    # 統計レポート
-    print("\n" + "="*50)
-    print("📈 ベンチマーク結果")
-    print("="*50)
-    
-    success_rate = sum(r['success'] for r in results) / len(results) * 100
-    avg_time = sum(r['execution_time'] for r in results) / len(results)
-    
-    print(f"成功率: {success_rate:.1f}%")
-    print(f"平均実行時間: {avg_time:.2f}秒")
-    
-    # カテゴリ別結果
-    categories = {}
-    for result in results:
-        cat = result['category']
-        if cat not in categories:
-            categories[cat] = []
-        categories[cat].append(result)
-    
-    print("\nカテゴリ別結果:")
-    for category, cat_results in categories.items():
-        cat_success_rate = sum(r['success'] for r in cat_results) / len(cat_results) * 100
-        print(f"  {category}: {cat_success_rate:.1f}% 成功")
+    # LLM応答の記録・再生（LLM_REPLAY_MODE=record で記録、replay でオフライン再実行）
+    llm_stats = agent.llm.get_metrics()
+    if llm_stats["replay_mode"] != "passthrough":
+        print(f"\nLLM応答の再生 ({llm_stats['replay_mode']}): "
+              f"再生 {llm_stats['replay_hits']}件, 記録 {llm_stats['recorded']}件, 未記録 {llm_stats['replay_misses']}件")
 
 def main():
     """メイン実行関数"""
     
-    if not os.getenv('GOOGLE_API_KEY'):
+    # 記録済みの応答だけを再生する場合はAPIキーは不要
+    replay_only = os.getenv('LLM_REPLAY_MODE', '').lower() == "replay"
+    if get_backend_name() == "gemini" and not os.getenv('GOOGLE_API_KEY') and not replay_only:
         print("ERROR: GOOGLE_API_KEYが設定されていません")
         print(".envファイルでAPIキーを設定してください")
         return
@@ -0,0 +1,266 @@
+"""
+calculate ツール用の四則演算エンジン
+eval を使わずに式をASTに変換して評価し、式の長さ・ノード数・指数・数値の大きさを制限する
+（"9**9**9" のような式でワーカーのCPUを占有させないため）
+
+使い方:
+    python arithmetic.py --benchmark   # eval との速度比較
+    python arithmetic.py --fuzz 10000  # ランダムな式で制限と結果の一致を確認
+"""
+
+import argparse
+import ast
+import math
+import operator
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, Dict, Optional, Union
+
+Number = Union[int, float]
+
+
+class ExpressionError(ValueError):
+    """計算できない式（構文エラー・未対応の演算・制限超過・ゼロ除算など）"""
+
+
+BINARY_OPERATORS: Dict[type, Callable[[Number, Number], Number]] = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+}
+
+UNARY_OPERATORS: Dict[type, Callable[[Number], Number]] = {
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+
+
+class ArithmeticEngine:
+    """制限付きの数式評価エンジン
+
+    max_length: 式の最大文字数
+    max_nodes: ASTの最大ノード数（評価ステップ数の上限。ループがないためノード数で決まる）
+    max_exponent: べき乗の指数の絶対値の上限
+    max_magnitude: 途中結果を含む数値の絶対値の上限
+    cache_size: 評価結果をキャッシュする式の数（同じ式は再評価しない）
+    """
+
+    def __init__(self, max_length: int = 200, max_nodes: int = 200, max_exponent: int = 100,
+                 max_magnitude: float = 1e30, cache_size: int = 1024):
+        self.max_length = max_length
+        self.max_nodes = max_nodes
+        self.max_exponent = max_exponent
+        self.max_magnitude = max_magnitude
+        self.log_max_magnitude = math.log10(max_magnitude)
+        self.cache_size = cache_size
+        self.cache: "OrderedDict[str, Union[Number, ExpressionError]]" = OrderedDict()
+        self.lock = threading.Lock()
+
+    def evaluate(self, expression: str) -> Number:
+        """式を評価（計算できない場合は ExpressionError）"""
+        expression = expression.strip()
+        with self.lock:
+            cached = self.cache.get(expression)
+            if cached is not None:
+                self.cache.move_to_end(expression)
+        if cached is None:
+            try:
+                cached = self._evaluate(expression)
+            except ExpressionError as e:
+                cached = e
+            with self.lock:
+                self.cache[expression] = cached
+                if len(self.cache) > self.cache_size:
+                    self.cache.popitem(last=False)
+
+        if isinstance(cached, ExpressionError):
+            raise cached
+        return cached
+
+    def _evaluate(self, expression: str) -> Number:
+        if not expression:
+            raise ExpressionError("式が空です")
+        if len(expression) > self.max_length:
+            raise ExpressionError(f"式が長すぎます（{self.max_length}文字以内）")
+
+        try:
+            tree = ast.parse(expression, mode="eval")
+        except SyntaxError:
+            raise ExpressionError("式の構文が正しくありません")
+
+        node_count = sum(1 for _ in ast.walk(tree))
+        if node_count > self.max_nodes:
+            raise ExpressionError(f"式が複雑すぎます（ノード数 {node_count} > {self.max_nodes}）")
+
+        return self._eval_node(tree.body)
+
+    def _check(self, value) -> Number:
+        if isinstance(value, complex):
+            raise ExpressionError("結果が複素数になります")
+        if isinstance(value, float) and not math.isfinite(value):
+            raise ExpressionError("結果が大きすぎます")
+        if abs(value) > self.max_magnitude:
+            raise ExpressionError(f"数値が大きすぎます（絶対値 {self.max_magnitude:g} まで）")
+        return value
+
+    def _eval_node(self, node: ast.AST) -> Number:
+        if isinstance(node, ast.Constant):
+            if isinstance(node.value, bool) or not isinstance(node.value, (int, float)):
+                raise ExpressionError(f"数値以外は使用できません: {node.value!r}")
+            return self._check(node.value)
+
+        if isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPERATORS:
+            return UNARY_OPERATORS[type(node.op)](self._eval_node(node.operand))
+
+        if isinstance(node, ast.BinOp):
+            left = self._eval_node(node.left)
+            right = self._eval_node(node.right)
+
+            if isinstance(node.op, ast.Pow):
+                return self._power(left, right)
+            if type(node.op) not in BINARY_OPERATORS:
+                raise ExpressionError(f"未対応の演算子です: {type(node.op).__name__}")
+            try:
+                return self._check(BINARY_OPERATORS[type(node.op)](left, right))
+            except ZeroDivisionError:
+                raise ExpressionError("0で割ることはできません")
+            except OverflowError:
+                raise ExpressionError("結果が大きすぎます")
+
+        raise ExpressionError(f"未対応の式です: {type(node).__name__}")
+
+    def _power(self, base: Number, exponent: Number) -> Number:
+        """べき乗（計算する前に指数と結果の桁数を確認）"""
+        if abs(exponent) > self.max_exponent:
+            raise ExpressionError(f"指数が大きすぎます（絶対値 {self.max_exponent} まで）")
+        if base != 0 and exponent * math.log10(abs(base)) > self.log_max_magnitude:
+            raise ExpressionError(f"数値が大きすぎます（絶対値 {self.max_magnitude:g} まで）")
+        try:
+            return self._check(base ** exponent)
+        except ZeroDivisionError:
+            raise ExpressionError("0で割ることはできません")
+        except OverflowError:
+            raise ExpressionError("結果が大きすぎます")
+
+
+_default_engine: Optional[ArithmeticEngine] = None
+
+
+def get_default_engine() -> ArithmeticEngine:
+    """プロセス共通のエンジン（キャッシュを共有）"""
+    global _default_engine
+    if _default_engine is None:
+        _default_engine = ArithmeticEngine()
+    return _default_engine
+
+
+def random_expression(rng: random.Random, depth: int = 4) -> str:
+    """ファジング用のランダムな式（不正な記号や巨大なべき乗も混ぜる）"""
+    if depth == 0 or rng.random() < 0.3:
+        choice = rng.random()
+        if choice < 0.6:
+            return str(rng.randint(0, 1000))
+        if choice < 0.8:
+            return f"{rng.uniform(0, 100):.3f}"
+        return rng.choice(["0", "9**9**9", "10**400", "(-8)**0.5", "1e308*10", "", "abc", "__import__"])
+    op = rng.choice(["+", "-", "*", "/", "//", "%", "**", "+-", "<<", ""])
+    left = random_expression(rng, depth - 1)
+    right = random_expression(rng, depth - 1)
+    if rng.random() < 0.3:
+        return f"({left}{op}{right})"
+    return f"{left} {op} {right}"
+
+
+def fuzz(iterations: int = 10000, seed: int = 0, max_seconds_per_case: float = 0.05,
+         engine: Optional[ArithmeticEngine] = None) -> Dict:
+    """ランダムな式で、時間制限内に終わること・安全な式では eval と同じ結果になることを確認"""
+    engine = engine or ArithmeticEngine(cache_size=0)
+    rng = random.Random(seed)
+    stats = {"cases": 0, "ok": 0, "rejected": 0, "mismatches": [], "slow": [], "unexpected_errors": []}
+
+    for _ in range(iterations):
+        expression = random_expression(rng)
+        stats["cases"] += 1
+        start_time = time.perf_counter()
+        try:
+            value = engine.evaluate(expression)
+            stats["ok"] += 1
+        except ExpressionError:
+            value = None
+            stats["rejected"] += 1
+        except Exception as e:  # エンジンの不具合
+            stats["unexpected_errors"].append((expression, repr(e)))
+            continue
+        elapsed = time.perf_counter() - start_time
+        if elapsed > max_seconds_per_case:
+            stats["slow"].append((expression, elapsed))
+
+        # べき乗を含まない式は eval でも安全に計算できるので結果を比較
+        if value is not None and "**" not in expression:
+            expected = eval(expression, {"__builtins__": {}}, {})
+            if not math.isclose(value, expected, rel_tol=1e-9, abs_tol=1e-9):
+                stats["mismatches"].append((expression, value, expected))
+
+    return stats
+
+
+def benchmark(iterations: int = 20000, engine: Optional[ArithmeticEngine] = None) -> Dict:
+    """代表的な式で eval と比較（キャッシュなしの評価と、キャッシュありの繰り返し評価）"""
+    expressions = ["25 * 4 + 100", "2+2", "(1.5 + 2.5) * 3 / 4", "2**10 - 1", "((7 % 3) + 8 // 3) * -2"]
+    uncached = ArithmeticEngine(cache_size=0)
+    cached = engine or ArithmeticEngine()
+
+    def measure(func: Callable[[str], Number]) -> float:
+        start_time = time.perf_counter()
+        for i in range(iterations):
+            func(expressions[i % len(expressions)])
+        return (time.perf_counter() - start_time) / iterations * 1e6
+
+    results = {
+        "eval_us": measure(lambda e: eval(e, {"__builtins__": {}}, {})),
+        "engine_uncached_us": measure(uncached.evaluate),
+        "engine_cached_us": measure(cached.evaluate),
+    }
+
+    # 危険な式がすぐに拒否されること
+    start_time = time.perf_counter()
+    try:
+        uncached.evaluate("9**9**9")
+    except ExpressionError:
+        pass
+    results["reject_9_9_9_us"] = (time.perf_counter() - start_time) * 1e6
+    return results
+
+
+def main():
+    """ベンチマークとファジングのコマンドライン"""
+    parser = argparse.ArgumentParser(description="calculate ツール用の数式エンジン")
+    parser.add_argument("--benchmark", action="store_true")
+    parser.add_argument("--fuzz", type=int, default=0, help="ファジングするケース数")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.benchmark:
+        results = benchmark()
+        print("📊 1回あたりの評価時間（マイクロ秒）")
+        print(f"  eval:                 {results['eval_us']:.2f}")
+        print(f"  エンジン（キャッシュなし）: {results['engine_uncached_us']:.2f}")
+        print(f"  エンジン（キャッシュあり）: {results['engine_cached_us']:.2f}")
+        print(f"  9**9**9 の拒否:        {results['reject_9_9_9_us']:.2f}")
+
+    if args.fuzz:
+        stats = fuzz(args.fuzz, args.seed)
+        print(f"🧪 ファジング: {stats['cases']}件 (計算 {stats['ok']}, 拒否 {stats['rejected']})")
+        print(f"  結果の不一致: {len(stats['mismatches'])}件, 遅いケース: {len(stats['slow'])}件, "
+              f"想定外の例外: {len(stats['unexpected_errors'])}件")
+        for case in (stats['mismatches'] + stats['slow'] + stats['unexpected_errors'])[:10]:
+            print(f"  - {case}")
+
+
+if __name__ == "__main__":
+    main()
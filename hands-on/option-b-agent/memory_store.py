@@ -0,0 +1,408 @@
+"""
+エージェントのメモ（save_memo / get_memo）の保存先
+プロセス内の辞書（InMemoryStore）と、再起動後も残り複数プロセスで共有できる SQLite（SQLiteMemoryStore）を
+同じインターフェースで切り替えられるようにする。メモはセッションIDごとの名前空間に保存する。
+
+SQLite版:
+    - WALモード（読み込みと書き込みを別プロセスから同時に行える）
+    - キー・更新日時・参照日時にインデックス（前方一致検索・古いメモの削除を全件走査しない）
+    - FTS5（trigram）による全文検索（FTS5が使えない環境や2文字以下の検索語は LIKE 検索）
+    - 名前空間ごとの件数上限（超えたら最も長く参照されていないメモから削除）
+    - embedding_function を渡すと、埋め込みベクトルによる意味検索（recall）
+"""
+
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from datetime import datetime
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+# テキストのリストを埋め込みベクトルのリストに変換する関数
+EmbeddingFunction = Callable[[List[str]], Sequence[Sequence[float]]]
+
+# 前方一致検索の上限（この文字より大きいキーは範囲に含まれない）
+_MAX_CHAR = "\U0010ffff"
+
+
+def _memo(key: str, content: str, timestamp: str, score: Optional[float] = None) -> Dict:
+    memo = {"key": key, "content": content, "timestamp": timestamp}
+    if score is not None:
+        memo["score"] = score
+    return memo
+
+
+class MemoryStore(ABC):
+    """メモの保存先のインターフェース（namespace はセッションID）"""
+
+    @abstractmethod
+    def save(self, namespace: str, key: str, content: str) -> Dict:
+        """メモを保存（同じキーは上書き）"""
+
+    @abstractmethod
+    def get(self, namespace: str, key: str) -> Optional[Dict]:
+        """キーが完全に一致するメモ"""
+
+    @abstractmethod
+    def delete(self, namespace: str, key: str) -> bool:
+        """メモを削除（存在しなければ False）"""
+
+    @abstractmethod
+    def search_prefix(self, namespace: str, prefix: str, limit: int = 10) -> List[Dict]:
+        """キーが prefix で始まるメモ（キー順）"""
+
+    @abstractmethod
+    def search_text(self, namespace: str, query: str, limit: int = 10) -> List[Dict]:
+        """キーか内容に検索語をすべて含むメモ"""
+
+    def recall(self, namespace: str, query: str, limit: int = 5) -> List[Dict]:
+        """query に意味の近いメモ（意味検索に対応しない保存先では全文検索）"""
+        return self.search_text(namespace, query, limit)
+
+    @abstractmethod
+    def list(self, namespace: str) -> List[Dict]:
+        """名前空間のすべてのメモ（キー順）"""
+
+    @abstractmethod
+    def count(self, namespace: Optional[str] = None) -> int:
+        """メモの件数（namespace を省略するとすべての名前空間の合計）"""
+
+    def close(self):
+        pass
+
+
+class InMemoryStore(MemoryStore):
+    """プロセス内の辞書に保存（再起動で消える。テストや単発の実行向け）"""
+
+    def __init__(self, max_entries: int = 1000, max_content_chars: int = 10000):
+        self.max_entries = max_entries
+        self.max_content_chars = max_content_chars
+        self.namespaces: Dict[str, "OrderedDict[str, Dict]"] = {}
+        self.lock = threading.Lock()
+
+    def save(self, namespace: str, key: str, content: str) -> Dict:
+        if len(content) > self.max_content_chars:
+            raise ValueError(f"メモが長すぎます（{self.max_content_chars}文字以内）")
+        memo = _memo(key, content, datetime.now().isoformat())
+        with self.lock:
+            memos = self.namespaces.setdefault(namespace, OrderedDict())
+            memos[key] = memo
+            memos.move_to_end(key)
+            while len(memos) > self.max_entries:
+                memos.popitem(last=False)
+        return memo
+
+    def get(self, namespace: str, key: str) -> Optional[Dict]:
+        with self.lock:
+            memos = self.namespaces.get(namespace, {})
+            memo = memos.get(key)
+            if memo is not None:
+                memos.move_to_end(key)
+            return memo
+
+    def delete(self, namespace: str, key: str) -> bool:
+        with self.lock:
+            return self.namespaces.get(namespace, {}).pop(key, None) is not None
+
+    def search_prefix(self, namespace: str, prefix: str, limit: int = 10) -> List[Dict]:
+        return [memo for memo in self.list(namespace) if memo["key"].startswith(prefix)][:limit]
+
+    def search_text(self, namespace: str, query: str, limit: int = 10) -> List[Dict]:
+        terms = query.lower().split()
+        matches = [memo for memo in self.list(namespace)
+                   if all(term in f"{memo['key']} {memo['content']}".lower() for term in terms)]
+        return matches[:limit]
+
+    def list(self, namespace: str) -> List[Dict]:
+        with self.lock:
+            return sorted(self.namespaces.get(namespace, {}).values(), key=lambda memo: memo["key"])
+
+    def count(self, namespace: Optional[str] = None) -> int:
+        with self.lock:
+            if namespace is not None:
+                return len(self.namespaces.get(namespace, {}))
+            return sum(len(memos) for memos in self.namespaces.values())
+
+
+class SQLiteMemoryStore(MemoryStore):
+    """SQLiteに保存するメモ
+
+    path: データベースファイル（複数のプロセスから同じファイルを開ける）
+    max_entries: 名前空間ごとの最大件数（超えたら最も長く参照されていないメモから削除）
+    max_content_chars: 1件のメモの最大文字数
+    embedding_function: 指定すると保存時に埋め込みを計算し、recall で意味検索する
+    touch_interval: 参照日時（accessed_at）を更新する最短間隔（秒）。読み込みのたびに書き込みロックを
+                    取らないよう、前回の更新からこの秒数が経っていなければ更新しない
+    """
+
+    def __init__(self, path: str, max_entries: int = 1000, max_content_chars: int = 10000,
+                 embedding_function: Optional[EmbeddingFunction] = None, touch_interval: float = 60.0):
+        if path == ":memory:":
+            raise ValueError("SQLiteMemoryStore にはファイルのパスを指定してください（メモリ上なら InMemoryStore）")
+        self.path = path
+        self.max_entries = max_entries
+        self.max_content_chars = max_content_chars
+        self.embedding_function = embedding_function
+        self.touch_interval = touch_interval
+
+        # 接続はスレッドごとに作る（WALなので読み込みは書き込みを待たない）
+        self.local = threading.local()
+        self.connections: List[sqlite3.Connection] = []
+        self.connections_lock = threading.Lock()
+
+        # 意味検索用の埋め込み行列（名前空間ごと。件数か更新日時が変わったら読み直す）
+        self.embedding_cache: Dict[str, Tuple[Tuple, List[str], np.ndarray]] = {}
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self.fts_enabled = self._create_schema()
+
+    def _connection(self) -> sqlite3.Connection:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            self.local.connection = connection
+            with self.connections_lock:
+                self.connections.append(connection)
+        return connection
+
+    def _create_schema(self) -> bool:
+        """テーブルとインデックスを作成（FTS5が使えるかどうかを返す）"""
+        connection = self._connection()
+        with connection:
+            connection.execute("""
+                CREATE TABLE IF NOT EXISTS memos (
+                    namespace TEXT NOT NULL,
+                    key TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    timestamp TEXT NOT NULL,
+                    updated_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL,
+                    embedding BLOB,
+                    PRIMARY KEY (namespace, key)
+                )
+            """)
+            connection.execute("CREATE INDEX IF NOT EXISTS memos_accessed ON memos (namespace, accessed_at)")
+            connection.execute("CREATE INDEX IF NOT EXISTS memos_updated ON memos (namespace, updated_at)")
+
+        try:
+            with connection:
+                # trigram は日本語のように空白で区切らない文でも部分一致で検索できる
+                connection.execute("""
+                    CREATE VIRTUAL TABLE IF NOT EXISTS memos_fts
+                    USING fts5(key, content, content='memos', tokenize='trigram')
+                """)
+                connection.execute("""
+                    CREATE TRIGGER IF NOT EXISTS memos_ai AFTER INSERT ON memos BEGIN
+                        INSERT INTO memos_fts(rowid, key, content) VALUES (new.rowid, new.key, new.content);
+                    END
+                """)
+                connection.execute("""
+                    CREATE TRIGGER IF NOT EXISTS memos_ad AFTER DELETE ON memos BEGIN
+                        INSERT INTO memos_fts(memos_fts, rowid, key, content)
+                        VALUES ('delete', old.rowid, old.key, old.content);
+                    END
+                """)
+                connection.execute("""
+                    CREATE TRIGGER IF NOT EXISTS memos_au AFTER UPDATE OF key, content ON memos BEGIN
+                        INSERT INTO memos_fts(memos_fts, rowid, key, content)
+                        VALUES ('delete', old.rowid, old.key, old.content);
+                        INSERT INTO memos_fts(rowid, key, content) VALUES (new.rowid, new.key, new.content);
+                    END
+                """)
+            return True
+        except sqlite3.OperationalError:
+            # FTS5（または trigram）に対応していない SQLite
+            return False
+
+    def save(self, namespace: str, key: str, content: str) -> Dict:
+        if len(content) > self.max_content_chars:
+            raise ValueError(f"メモが長すぎます（{self.max_content_chars}文字以内）")
+        timestamp = datetime.now().isoformat()
+        now = time.time()
+        embedding = None
+        if self.embedding_function is not None:
+            vector = np.asarray(self.embedding_function([f"{key}: {content}"])[0], dtype=np.float32)
+            embedding = vector.tobytes()
+
+        connection = self._connection()
+        with connection:
+            connection.execute("""
+                INSERT INTO memos (namespace, key, content, timestamp, updated_at, accessed_at, embedding)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (namespace, key) DO UPDATE SET
+                    content = excluded.content, timestamp = excluded.timestamp,
+                    updated_at = excluded.updated_at, accessed_at = excluded.accessed_at,
+                    embedding = excluded.embedding
+            """, (namespace, key, content, timestamp, now, now, embedding))
+            self._evict(connection, namespace)
+        return _memo(key, content, timestamp)
+
+    def _evict(self, connection: sqlite3.Connection, namespace: str):
+        """件数上限を超えた分を、参照日時の古い順に削除"""
+        (count,) = connection.execute("SELECT COUNT(*) FROM memos WHERE namespace = ?", (namespace,)).fetchone()
+        if count > self.max_entries:
+            connection.execute("""
+                DELETE FROM memos WHERE rowid IN (
+                    SELECT rowid FROM memos WHERE namespace = ? ORDER BY accessed_at LIMIT ?
+                )
+            """, (namespace, count - self.max_entries))
+
+    def get(self, namespace: str, key: str) -> Optional[Dict]:
+        connection = self._connection()
+        row = connection.execute(
+            "SELECT key, content, timestamp, accessed_at FROM memos WHERE namespace = ? AND key = ?", (namespace, key)
+        ).fetchone()
+        if row is None:
+            return None
+
+        # 参照日時は touch_interval ごとにだけ更新する（ほとんどの読み込みは書き込みロックを取らない）
+        now = time.time()
+        if now - row[3] >= self.touch_interval:
+            with connection:
+                connection.execute(
+                    "UPDATE memos SET accessed_at = ? WHERE namespace = ? AND key = ? AND accessed_at < ?",
+                    (now, namespace, key, now - self.touch_interval)
+                )
+        return _memo(*row[:3])
+
+    def delete(self, namespace: str, key: str) -> bool:
+        connection = self._connection()
+        with connection:
+            cursor = connection.execute("DELETE FROM memos WHERE namespace = ? AND key = ?", (namespace, key))
+        return cursor.rowcount > 0
+
+    def search_prefix(self, namespace: str, prefix: str, limit: int = 10) -> List[Dict]:
+        # LIKE はインデックスを使えないため、主キーの範囲検索にする
+        rows = self._connection().execute("""
+            SELECT key, content, timestamp FROM memos
+            WHERE namespace = ? AND key >= ? AND key < ? ORDER BY key LIMIT ?
+        """, (namespace, prefix, prefix + _MAX_CHAR, limit)).fetchall()
+        return [_memo(*row) for row in rows]
+
+    def search_text(self, namespace: str, query: str, limit: int = 10) -> List[Dict]:
+        terms = query.split()
+        if not terms:
+            return []
+
+        if self.fts_enabled and all(len(term) >= 3 for term in terms):
+            # 各語をフレーズとして AND 検索し、関連度（bm25）順に並べる
+            match = " AND ".join('"' + term.replace('"', '""') + '"' for term in terms)
+            rows = self._connection().execute("""
+                SELECT m.key, m.content, m.timestamp FROM memos_fts f JOIN memos m ON m.rowid = f.rowid
+                WHERE memos_fts MATCH ? AND m.namespace = ? ORDER BY bm25(memos_fts) LIMIT ?
+            """, (match, namespace, limit)).fetchall()
+        else:
+            # trigram は2文字以下の語を検索できないため LIKE で走査
+            conditions = " AND ".join(["(key LIKE ? ESCAPE '\\' OR content LIKE ? ESCAPE '\\')"] * len(terms))
+            parameters: List = [namespace]
+            for term in terms:
+                pattern = "%" + term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "%"
+                parameters.extend([pattern, pattern])
+            rows = self._connection().execute(
+                f"SELECT key, content, timestamp FROM memos WHERE namespace = ? AND {conditions} "
+                f"ORDER BY updated_at DESC LIMIT ?",
+                parameters + [limit]
+            ).fetchall()
+        return [_memo(*row) for row in rows]
+
+    def recall(self, namespace: str, query: str, limit: int = 5) -> List[Dict]:
+        """埋め込みのコサイン類似度が高いメモ（embedding_function がなければ全文検索）"""
+        if self.embedding_function is None:
+            return self.search_text(namespace, query, limit)
+
+        keys, matrix = self._embedding_matrix(namespace)
+        if not keys:
+            return []
+        vector = np.asarray(self.embedding_function([query])[0], dtype=np.float32)
+        vector /= np.linalg.norm(vector) or 1.0
+        scores = matrix @ vector
+
+        # 上位 limit 件だけを部分ソート（メモが多くても全件ソートしない）
+        top = min(limit, len(keys))
+        indices = np.argpartition(-scores, top - 1)[:top]
+        indices = indices[np.argsort(-scores[indices])]
+
+        memos = []
+        for index in indices:
+            memo = self.get(namespace, keys[index])
+            if memo is not None:
+                memo["score"] = float(scores[index])
+                memos.append(memo)
+        return memos
+
+    def _embedding_matrix(self, namespace: str) -> Tuple[List[str], np.ndarray]:
+        """名前空間の正規化済み埋め込み行列（変更がなければキャッシュを使う）"""
+        connection = self._connection()
+        version = connection.execute(
+            "SELECT COUNT(*), MAX(updated_at) FROM memos WHERE namespace = ?", (namespace,)
+        ).fetchone()
+        cached = self.embedding_cache.get(namespace)
+        if cached is not None and cached[0] == version:
+            return cached[1], cached[2]
+
+        rows = connection.execute(
+            "SELECT key, embedding FROM memos WHERE namespace = ? AND embedding IS NOT NULL", (namespace,)
+        ).fetchall()
+        keys = [key for key, _ in rows]
+        if rows:
+            matrix = np.vstack([np.frombuffer(blob, dtype=np.float32) for _, blob in rows])
+            norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+            matrix = matrix / np.where(norms == 0, 1.0, norms)
+        else:
+            matrix = np.zeros((0, 0), dtype=np.float32)
+        self.embedding_cache[namespace] = (version, keys, matrix)
+        return keys, matrix
+
+    def list(self, namespace: str) -> List[Dict]:
+        rows = self._connection().execute(
+            "SELECT key, content, timestamp FROM memos WHERE namespace = ? ORDER BY key", (namespace,)
+        ).fetchall()
+        return [_memo(*row) for row in rows]
+
+    def count(self, namespace: Optional[str] = None) -> int:
+        if namespace is None:
+            (count,) = self._connection().execute("SELECT COUNT(*) FROM memos").fetchone()
+        else:
+            (count,) = self._connection().execute(
+                "SELECT COUNT(*) FROM memos WHERE namespace = ?", (namespace,)
+            ).fetchone()
+        return count
+
+    def close(self):
+        with self.connections_lock:
+            for connection in self.connections:
+                connection.close()
+            self.connections.clear()
+        self.local = threading.local()
+
+
+def sentence_transformer_embedder(model_name: str = 'all-MiniLM-L6-v2') -> EmbeddingFunction:
+    """sentence-transformers のモデルで埋め込む関数（意味検索用。初回呼び出し時にモデルを読み込む）"""
+    model = None
+    lock = threading.Lock()
+
+    def embed(texts: List[str]) -> Sequence[Sequence[float]]:
+        nonlocal model
+        with lock:
+            if model is None:
+                from sentence_transformers import SentenceTransformer
+                model = SentenceTransformer(model_name)
+        return model.encode(texts)
+
+    return embed
+
+
+def create_memory_store(path: Optional[str] = None, max_entries: int = 1000, max_content_chars: int = 10000,
+                        embedding_function: Optional[EmbeddingFunction] = None) -> MemoryStore:
+    """path（省略時は環境変数 AGENT_MEMORY_DB）があれば SQLite、なければプロセス内の辞書に保存"""
+    path = path or os.getenv('AGENT_MEMORY_DB')
+    if path:
+        return SQLiteMemoryStore(path, max_entries, max_content_chars, embedding_function)
+    return InMemoryStore(max_entries, max_content_chars)
@@ -0,0 +1,200 @@
+"""
+バックグラウンドタスクのスケジューラー
+タイマーや時間のかかるツールをエージェントのループから切り離し、タスクIDをすぐに返して
+完了後に結果を（次の反復の Observation やコールバックで）届ける
+"""
+
+import contextvars
+import heapq
+import itertools
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+class BackgroundTask:
+    """スケジューラーに登録された1つのタスク（due・created_at・finished_at は time.monotonic() の値）"""
+
+    def __init__(self, task_id: str, name: str, func: Callable[[], Any], due: float,
+                 callback: Optional[Callable[["BackgroundTask"], None]] = None, owner: Optional[str] = None):
+        self.task_id = task_id
+        self.name = name
+        self.func = func
+        self.due = due
+        self.callback = callback
+        self.owner = owner
+        # 登録時のコンテキスト（実行中のセッションなど）で実行する
+        self.context = contextvars.copy_context()
+        self.status = PENDING
+        self.result = None
+        self.error = None
+        self.created_at = time.monotonic()
+        self.finished_at = None
+        self.delivered = False
+        self.done_event = threading.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in (DONE, FAILED, CANCELLED)
+
+    def describe(self) -> str:
+        """タスクの状態を1行で表現"""
+        if self.status == DONE:
+            return f"[{self.task_id}] {self.name}: 完了 - {self.result}"
+        if self.status == FAILED:
+            return f"[{self.task_id}] {self.name}: 失敗 - {self.error}"
+        if self.status == PENDING:
+            remaining = max(0.0, self.due - time.monotonic())
+            return f"[{self.task_id}] {self.name}: 待機中（残り {remaining:.0f}秒）"
+        if self.status == RUNNING:
+            return f"[{self.task_id}] {self.name}: 実行中"
+        return f"[{self.task_id}] {self.name}: キャンセル済み"
+
+
+class TaskScheduler:
+    """遅延実行・バックグラウンド実行のスケジューラー
+
+    期限待ちは1本のスケジューラースレッドが担当し（タスクごとにスレッドを眠らせない）、
+    期限が来たタスクだけをワーカースレッドで実行する。
+    完了したタスクは結果を受け取った時点（collect_finished / mark_delivered）で一覧から削除し、
+    受け取られないまま finished_ttl 秒たったタスクも削除する（長時間動くエージェントでも増え続けない）。
+    """
+
+    def __init__(self, max_workers: int = 4, finished_ttl: float = 600.0):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="background")
+        self.condition = threading.Condition()
+        self.queue = []
+        self.tasks: Dict[str, BackgroundTask] = {}
+        self.counter = itertools.count(1)
+        self.finished_ttl = finished_ttl
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def schedule(self, name: str, func: Callable[[], Any], delay: float = 0.0,
+                 callback: Optional[Callable[[BackgroundTask], None]] = None,
+                 owner: Optional[str] = None) -> BackgroundTask:
+        """delay 秒後に func を実行するタスクを登録し、すぐに返す（owner はタスクを受け取るセッション）"""
+        with self.condition:
+            if self.closed:
+                raise RuntimeError("スケジューラーは停止しています")
+            self._prune()
+            number = next(self.counter)
+            task = BackgroundTask(f"task-{number}", name, func, time.monotonic() + delay, callback, owner)
+            self.tasks[task.task_id] = task
+            heapq.heappush(self.queue, (task.due, number, task))
+            self.condition.notify_all()
+        return task
+
+    def submit(self, name: str, func: Callable[[], Any],
+               callback: Optional[Callable[[BackgroundTask], None]] = None,
+               owner: Optional[str] = None) -> BackgroundTask:
+        """func をすぐにバックグラウンドで実行"""
+        return self.schedule(name, func, 0.0, callback, owner)
+
+    def cancel(self, task_id: str) -> bool:
+        """実行前のタスクをキャンセル"""
+        with self.condition:
+            task = self.tasks.get(task_id)
+            if task is None or task.status != PENDING:
+                return False
+            task.status = CANCELLED
+            task.finished_at = time.monotonic()
+            del self.tasks[task_id]
+            self.condition.notify_all()
+        task.done_event.set()
+        return True
+
+    def get(self, task_id: str) -> Optional[BackgroundTask]:
+        return self.tasks.get(task_id)
+
+    def list_tasks(self, owner: Optional[str] = None) -> List[BackgroundTask]:
+        """タスクの一覧（owner を指定するとそのセッションのタスクのみ）"""
+        with self.condition:
+            self._prune()
+            return [task for task in self.tasks.values() if owner is None or task.owner == owner]
+
+    def pending(self, owner: Optional[str] = None) -> List[BackgroundTask]:
+        """未完了のタスク"""
+        return [task for task in self.list_tasks(owner) if not task.finished]
+
+    def collect_finished(self, owner: Optional[str] = None) -> List[BackgroundTask]:
+        """完了したがまだ受け取っていないタスクを返す（1つのタスクは1回だけ返す）"""
+        with self.condition:
+            finished = [task for task in self.tasks.values() if task.finished and not task.delivered
+                        and task.status != CANCELLED and (owner is None or task.owner == owner)]
+            self._deliver(finished)
+            return finished
+
+    def mark_delivered(self, tasks: List[BackgroundTask]):
+        """完了したタスクの結果を（ツールの応答などで）渡したことを記録し、一覧から削除"""
+        with self.condition:
+            self._deliver([task for task in tasks if task.finished])
+
+    def _deliver(self, tasks: List[BackgroundTask]):
+        for task in tasks:
+            task.delivered = True
+            self.tasks.pop(task.task_id, None)
+
+    def _prune(self):
+        """受け取られないまま finished_ttl 秒たった完了タスクを削除（condition を取得した状態で呼ぶ）"""
+        expired = time.monotonic() - self.finished_ttl
+        for task_id in [task_id for task_id, task in self.tasks.items()
+                        if task.finished and task.finished_at is not None and task.finished_at < expired]:
+            del self.tasks[task_id]
+
+    def wait(self, task_id: str, timeout: Optional[float] = None) -> Optional[BackgroundTask]:
+        """タスクの完了を最大 timeout 秒待つ"""
+        task = self.tasks.get(task_id)
+        if task is not None:
+            task.done_event.wait(timeout)
+        return task
+
+    def shutdown(self, wait: bool = False):
+        """スケジューラーを停止（未実行のタスクはキャンセル）"""
+        with self.condition:
+            self.closed = True
+            for task in self.tasks.values():
+                if task.status == PENDING:
+                    task.status = CANCELLED
+                    task.done_event.set()
+            self.condition.notify_all()
+        self.executor.shutdown(wait=wait)
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.closed and (not self.queue or self.queue[0][0] > time.monotonic()):
+                    timeout = self.queue[0][0] - time.monotonic() if self.queue else None
+                    self.condition.wait(timeout)
+                if self.closed:
+                    return
+                _, _, task = heapq.heappop(self.queue)
+                if task.status != PENDING:
+                    continue
+                task.status = RUNNING
+            self.executor.submit(self._execute, task)
+
+    def _execute(self, task: BackgroundTask):
+        try:
+            result, error, status = task.context.run(task.func), None, DONE
+        except Exception as e:
+            result, error, status = None, str(e), FAILED
+
+        with self.condition:
+            task.result, task.error, task.status = result, error, status
+            task.finished_at = time.monotonic()
+        task.done_event.set()
+
+        if task.callback:
+            try:
+                task.callback(task)
+            except Exception as e:
+                print(f"⚠️ コールバックでエラーが発生しました ({task.task_id}): {e}")
@@ -0,0 +1,101 @@
+"""
+ツール実行結果のキャッシュ（メモ化）
+ツールごとのキャッシュ方針（pure / ttl / never）に従い、正規化したパラメータをキーに結果を保存する
+（LRUで件数を制限し、ツールごとのヒット率を集計する）
+"""
+
+import inspect
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Optional, Tuple
+
+CACHE_PURE = "pure"    # 同じパラメータなら常に同じ結果（期限なし）
+CACHE_TTL = "ttl"      # ttl 秒間は同じ結果を返す（天気など、ゆっくり変わる情報）
+CACHE_NEVER = "never"  # キャッシュしない（副作用のあるツール）
+CACHE_POLICIES = (CACHE_PURE, CACHE_TTL, CACHE_NEVER)
+
+
+def canonical_parameters(func: Callable, parameters: Dict) -> str:
+    """パラメータを正規化したキャッシュキー
+
+    関数のシグネチャに当てはめてデフォルト値を補い、数値や前後の空白の違いは文字列に揃える
+    （LLMが "5" と 5、"東京 " と "東京" のように書き分けても同じキーになる）
+    """
+    try:
+        bound = inspect.signature(func).bind(**parameters)
+        bound.apply_defaults()
+        values = dict(bound.arguments)
+    except (TypeError, ValueError):
+        values = dict(parameters)
+
+    normalized = {
+        key: value.strip() if isinstance(value, str) else str(value) if isinstance(value, (int, float)) else value
+        for key, value in values.items()
+    }
+    return json.dumps(normalized, sort_keys=True, ensure_ascii=False, default=str)
+
+
+class ToolResultCache:
+    """全ツール共通のLRUキャッシュ（スレッドセーフ）"""
+
+    def __init__(self, max_entries: int = 256):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[Tuple[str, str], Tuple[Any, Optional[float]]]" = OrderedDict()
+        self.lock = threading.Lock()
+        self.stats: Dict[str, Dict[str, int]] = {}
+
+    def _tool_stats(self, tool_name: str) -> Dict[str, int]:
+        return self.stats.setdefault(tool_name, {"hits": 0, "misses": 0, "evictions": 0, "expired": 0})
+
+    def get(self, tool_name: str, key: str) -> Tuple[bool, Any]:
+        """キャッシュを参照（ヒットしたかどうかと結果を返す）"""
+        with self.lock:
+            stats = self._tool_stats(tool_name)
+            entry = self.entries.get((tool_name, key))
+            if entry is not None:
+                result, expires_at = entry
+                if expires_at is None or expires_at > time.monotonic():
+                    self.entries.move_to_end((tool_name, key))
+                    stats["hits"] += 1
+                    return True, result
+                del self.entries[(tool_name, key)]
+                stats["expired"] += 1
+            stats["misses"] += 1
+            return False, None
+
+    def put(self, tool_name: str, key: str, result: Any, ttl: Optional[float] = None):
+        """結果を保存（上限を超えたら最も長く使われていないものから削除）"""
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self.lock:
+            self.entries[(tool_name, key)] = (result, expires_at)
+            self.entries.move_to_end((tool_name, key))
+            while len(self.entries) > self.max_entries:
+                (evicted_tool, _), _ = self.entries.popitem(last=False)
+                self._tool_stats(evicted_tool)["evictions"] += 1
+
+    def invalidate(self, tool_name: Optional[str] = None):
+        """キャッシュを削除（tool_name 省略時はすべて）"""
+        with self.lock:
+            if tool_name is None:
+                self.entries.clear()
+                return
+            for entry_key in [k for k in self.entries if k[0] == tool_name]:
+                del self.entries[entry_key]
+
+    def snapshot(self) -> Dict:
+        """ツールごとのヒット数・ヒット率と現在の件数"""
+        with self.lock:
+            sizes: Dict[str, int] = {}
+            for tool_name, _ in self.entries:
+                sizes[tool_name] = sizes.get(tool_name, 0) + 1
+            tools = {}
+            for tool_name, stats in self.stats.items():
+                lookups = stats["hits"] + stats["misses"]
+                tools[tool_name] = dict(
+                    stats,
+                    entries=sizes.get(tool_name, 0),
+                    hit_rate=stats["hits"] / lookups if lookups else 0.0
+                )
+            return {"entries": len(self.entries), "max_entries": self.max_entries, "tools": tools}
@@ -0,0 +1,242 @@
+"""
+ツールの実行方式とタイムアウト
+ツールは登録時に実行方式を指定する:
+    inline   エージェントのスレッドでそのまま実行（すぐ終わる軽いツール。タイムアウトなし）
+    thread   スレッドプールで実行（HTTPなどI/O待ちのツール）。タイムアウト時は cancel_event で中断を依頼する。
+             中断に応じずスレッドを占有し続けるツールが増えたら、プールを新しいものに入れ替える
+    process  事前に起動したワーカープロセスで実行（CPUを使う重いツール。GILを占有しない）。
+             タイムアウト時はワーカープロセスを終了して新しいものに入れ替える（確実に中断できる）
+
+process のツールはワーカーに pickle で渡すため、モジュールのトップレベルで定義した関数に限る。
+"""
+
+import heapq
+import inspect
+import itertools
+import multiprocessing
+import pickle
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+RUN_INLINE = "inline"
+RUN_THREAD = "thread"
+RUN_PROCESS = "process"
+RUN_MODES = (RUN_INLINE, RUN_THREAD, RUN_PROCESS)
+
+
+class ToolTimeoutError(TimeoutError):
+    """ツールが制限時間内に終わらなかった"""
+
+
+def accepts_cancel_event(func: Callable) -> bool:
+    """ツールが cancel_event 引数（threading.Event）を受け取るか（長い処理の途中で中断を確認できる）"""
+    try:
+        return "cancel_event" in inspect.signature(func).parameters
+    except (TypeError, ValueError):
+        return False
+
+
+def check_picklable(func: Callable):
+    """プロセスに渡せる関数か確認（ローカル関数やラムダは不可）"""
+    try:
+        pickle.dumps(func)
+    except Exception as e:
+        raise ValueError(
+            f"run='process' のツールはモジュールのトップレベルで定義した関数にしてください（{e}）"
+        )
+
+
+class TimeoutWatchdog:
+    """期限が来たら関数を呼ぶ（1本のスレッドですべての期限を待つ。呼び出しごとにタイマースレッドを作らない）"""
+
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.deadlines: List[Tuple[float, int, Callable[[], None]]] = []
+        self.counter = itertools.count()
+        self.thread = None
+
+    def call_later(self, delay: float, callback: Callable[[], None]):
+        with self.condition:
+            heapq.heappush(self.deadlines, (time.monotonic() + delay, next(self.counter), callback))
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._run, name="tool-watchdog", daemon=True)
+                self.thread.start()
+            self.condition.notify()
+
+    def _run(self):
+        while True:
+            with self.condition:
+                while not self.deadlines or self.deadlines[0][0] > time.monotonic():
+                    timeout = self.deadlines[0][0] - time.monotonic() if self.deadlines else None
+                    self.condition.wait(timeout)
+                _, _, callback = heapq.heappop(self.deadlines)
+            try:
+                callback()
+            except Exception as e:
+                print(f"⚠️ タイムアウト処理でエラーが発生しました: {e}")
+
+
+class ThreadToolPool:
+    """I/O待ちのツール用のスレッドプール
+
+    タイムアウト後も cancel_event に応じず動き続けるツールはスレッドを占有したままになる。
+    そうしたスレッドがプールの半分に達したら新しいプールに入れ替え、以降のツールはそちらで実行する
+    （古いプールのスレッドはツールが戻った時点で終了する）。
+    """
+
+    def __init__(self, max_workers: int):
+        self.max_workers = max_workers
+        self.lock = threading.Lock()
+        self.executor = self._new_executor()
+        self.hung = 0
+        self.replaced = 0
+
+    def _new_executor(self) -> ThreadPoolExecutor:
+        return ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="tool-io")
+
+    def submit(self, func: Callable, *args) -> Future:
+        with self.lock:
+            future = self.executor.submit(func, *args)
+            # どのプールで実行したかを記録（入れ替え後に戻ったスレッドを数えないため）
+            future.executor = self.executor
+        return future
+
+    def abandon(self, future: Future):
+        """実行中のままタイムアウトしたツールを記録（戻るまでスレッドを占有している）"""
+        with self.lock:
+            if future.executor is not self.executor:
+                return
+            self.hung += 1
+            if self.hung * 2 >= self.max_workers:
+                print(f"⚠️ 終了しないツールが {self.hung}件 あるため、ツール実行スレッドのプールを入れ替えます")
+                self.executor.shutdown(wait=False)
+                self.executor = self._new_executor()
+                self.hung = 0
+                self.replaced += 1
+                return
+        future.add_done_callback(self._released)
+
+    def _released(self, future: Future):
+        with self.lock:
+            if future.executor is self.executor and self.hung > 0:
+                self.hung -= 1
+
+    def shutdown(self):
+        with self.lock:
+            self.executor.shutdown(wait=False)
+
+
+def _worker_main(connection):
+    """ワーカープロセスの処理ループ（関数とパラメータを受け取り、結果を返す）"""
+    while True:
+        try:
+            message = connection.recv()
+        except (EOFError, KeyboardInterrupt):
+            return
+        if message is None:
+            return
+        func, parameters = message
+        try:
+            reply = ("ok", func(**parameters))
+        except Exception as e:
+            reply = ("error", f"{type(e).__name__}: {e}")
+        try:
+            connection.send(reply)
+        except Exception as e:
+            # 結果を pickle できない場合など
+            connection.send(("error", f"結果を返せませんでした: {e}"))
+
+
+class _Worker:
+    def __init__(self, context):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_connection,), daemon=True)
+        self.process.start()
+        child_connection.close()
+
+    def stop(self, force: bool = False):
+        if not force:
+            try:
+                self.connection.send(None)
+            except (OSError, ValueError):
+                pass
+            self.process.join(1)
+        if self.process.is_alive():
+            self.process.terminate()
+            self.process.join(1)
+        self.connection.close()
+
+
+class ProcessToolPool:
+    """CPUを使うツール用のワーカープロセスのプール
+
+    ワーカーは作成時に起動しておき（初回呼び出しでプロセス起動を待たない）、
+    タイムアウトしたワーカーは終了させて新しいものを起動する。
+    起動方式は spawn（スレッドを持つ親プロセスを fork しない）。
+    """
+
+    def __init__(self, size: int = 2):
+        self.size = size
+        self.context = multiprocessing.get_context("spawn")
+        self.idle: "queue.Queue[_Worker]" = queue.Queue()
+        self.workers: List[_Worker] = []
+        self.lock = threading.Lock()
+        self.closed = False
+        for _ in range(size):
+            self._add_worker()
+
+    def _add_worker(self):
+        worker = _Worker(self.context)
+        with self.lock:
+            self.workers.append(worker)
+        self.idle.put(worker)
+
+    def _replace(self, worker: _Worker):
+        worker.stop(force=True)
+        with self.lock:
+            if worker in self.workers:
+                self.workers.remove(worker)
+            closed = self.closed
+        if not closed:
+            self._add_worker()
+
+    def run(self, func: Callable, parameters: Dict, timeout: Optional[float] = None) -> Any:
+        """ワーカーで func(**parameters) を実行（timeout 秒を超えたら ToolTimeoutError）"""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        try:
+            worker = self.idle.get(timeout=timeout)
+        except queue.Empty:
+            raise ToolTimeoutError(f"空きワーカーを {timeout}秒 待ちましたが見つかりませんでした")
+
+        try:
+            worker.connection.send((func, parameters))
+            remaining = max(0.0, deadline - time.monotonic()) if deadline is not None else None
+            if not worker.connection.poll(remaining):
+                self._replace(worker)
+                raise ToolTimeoutError(f"{timeout}秒 以内に完了しませんでした")
+            status, value = worker.connection.recv()
+        except ToolTimeoutError:
+            raise
+        except (EOFError, OSError) as e:
+            # ワーカーが異常終了した
+            self._replace(worker)
+            raise RuntimeError(f"ワーカープロセスが終了しました: {e}")
+        except Exception:
+            self._replace(worker)
+            raise
+
+        self.idle.put(worker)
+        if status == "error":
+            raise RuntimeError(value)
+        return value
+
+    def shutdown(self):
+        with self.lock:
+            self.closed = True
+            workers = list(self.workers)
+            self.workers.clear()
+        for worker in workers:
+            worker.stop()
@@ -0,0 +1,322 @@
+"""
+エージェントのトレーシング（スパン）
+run 全体・反復・LLM呼び出し・ツール実行をスパンとして記録し、所要時間と属性（プロンプトや応答のサイズ、
+ツール名、エラー）をエクスポーターに渡す。親子関係は contextvars で受け渡すため、
+スレッドプールや asyncio のタスクで実行したツールも呼び出し元の反復の子になる。
+
+エクスポーター:
+    JsonLinesExporter  1スパン1行のJSON
+    OTLPJsonExporter   OpenTelemetry の OTLP/JSON 形式（1トレース1行。Collector などで読み込める）
+    InMemoryExporter   メモリ上に保持（ベンチマークや確認用）
+
+使い方:
+    AGENT_TRACE_FILE=traces.jsonl python agent_system.py
+    python tracing.py summarize traces.jsonl   # スパン名ごとの所要時間の内訳
+"""
+
+import argparse
+import contextvars
+import json
+import os
+import threading
+import time
+from abc import ABC, abstractmethod
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+
+class Span:
+    """1つの処理区間"""
+
+    def __init__(self, name: str, trace_id: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.name = name
+        self.trace_id = trace_id
+        self.span_id = os.urandom(8).hex()
+        self.parent_id = parent_id
+        self.attributes = attributes
+        self.start_ns = time.time_ns()
+        self.end_ns: Optional[int] = None
+        self.error: Optional[str] = None
+
+    @property
+    def duration_ms(self) -> float:
+        end_ns = self.end_ns if self.end_ns is not None else time.time_ns()
+        return (end_ns - self.start_ns) / 1e6
+
+    def set_attribute(self, key: str, value: Any):
+        self.attributes[key] = value
+
+    def set_error(self, error: str):
+        self.error = error
+
+    def to_dict(self) -> Dict:
+        return {
+            "name": self.name,
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "start_ns": self.start_ns,
+            "end_ns": self.end_ns,
+            "duration_ms": self.duration_ms,
+            "status": "error" if self.error else "ok",
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class _NoopSpan:
+    """トレーシング無効時のスパン（何も記録しない）"""
+
+    def set_attribute(self, key: str, value: Any):
+        pass
+
+    def set_error(self, error: str):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+# 実行中のスパン（新しいスパンの親になる）
+_current_span: "contextvars.ContextVar[Optional[Span]]" = contextvars.ContextVar("current_span", default=None)
+
+
+class SpanExporter(ABC):
+    """終了したスパンの出力先のインターフェース"""
+
+    @abstractmethod
+    def export(self, span: Span):
+        """終了したスパンを出力"""
+
+    def shutdown(self):
+        pass
+
+
+class InMemoryExporter(SpanExporter):
+    """スパンをメモリ上に保持"""
+
+    def __init__(self):
+        self.spans: List[Span] = []
+        self.lock = threading.Lock()
+
+    def export(self, span: Span):
+        with self.lock:
+            self.spans.append(span)
+
+
+class JsonLinesExporter(SpanExporter):
+    """1スパン1行のJSONでファイルに追記（ルートスパンの終了時にフラッシュ）"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.lock = threading.Lock()
+        self.file = open(path, "a", encoding="utf-8")
+
+    def export(self, span: Span):
+        line = json.dumps(span.to_dict(), ensure_ascii=False, default=str)
+        with self.lock:
+            self.file.write(line + "\n")
+            if span.parent_id is None:
+                self.file.flush()
+
+    def shutdown(self):
+        with self.lock:
+            self.file.close()
+
+
+def _otlp_value(value: Any) -> Dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    return {"stringValue": str(value)}
+
+
+class OTLPJsonExporter(SpanExporter):
+    """OpenTelemetry の OTLP/JSON 形式でファイルに追記
+
+    スパンはトレースごとにまとめ、ルートスパンが終了した時点で1行（1つの resourceSpans）として書き出す。
+    """
+
+    def __init__(self, path: str, service_name: str = "react-agent"):
+        self.path = path
+        self.service_name = service_name
+        self.lock = threading.Lock()
+        self.pending: Dict[str, List[Span]] = {}
+        self.file = open(path, "a", encoding="utf-8")
+
+    def export(self, span: Span):
+        with self.lock:
+            spans = self.pending.setdefault(span.trace_id, [])
+            spans.append(span)
+            if span.parent_id is None:
+                del self.pending[span.trace_id]
+                self._write(spans)
+
+    def _write(self, spans: List[Span]):
+        payload = {
+            "resourceSpans": [{
+                "resource": {"attributes": [{"key": "service.name", "value": _otlp_value(self.service_name)}]},
+                "scopeSpans": [{
+                    "scope": {"name": "react-agent"},
+                    "spans": [self._span(span) for span in spans],
+                }],
+            }]
+        }
+        self.file.write(json.dumps(payload, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+    @staticmethod
+    def _span(span: Span) -> Dict:
+        otlp_span = {
+            "traceId": span.trace_id,
+            "spanId": span.span_id,
+            "name": span.name,
+            "kind": 1,  # SPAN_KIND_INTERNAL
+            "startTimeUnixNano": str(span.start_ns),
+            "endTimeUnixNano": str(span.end_ns),
+            "attributes": [{"key": k, "value": _otlp_value(v)} for k, v in span.attributes.items()],
+            # STATUS_CODE_OK = 1, STATUS_CODE_ERROR = 2
+            "status": {"code": 2, "message": span.error} if span.error else {"code": 1},
+        }
+        if span.parent_id:
+            otlp_span["parentSpanId"] = span.parent_id
+        return otlp_span
+
+    def shutdown(self):
+        with self.lock:
+            # ルートスパンが終わらなかったトレースも書き出す
+            for spans in self.pending.values():
+                self._write(spans)
+            self.pending.clear()
+            self.file.close()
+
+
+class Tracer:
+    """スパンを作成してエクスポーターに渡す（exporter が None なら何もしない）"""
+
+    def __init__(self, exporter: Optional[SpanExporter] = None):
+        self.exporter = exporter
+
+    @property
+    def enabled(self) -> bool:
+        return self.exporter is not None
+
+    @contextmanager
+    def span(self, name: str, **attributes) -> Iterator[Any]:
+        """処理区間をスパンとして記録（例外が発生した場合はエラーとして記録して再送出）"""
+        if self.exporter is None:
+            yield _NOOP_SPAN
+            return
+
+        parent = _current_span.get()
+        trace_id = parent.trace_id if parent else os.urandom(16).hex()
+        span = Span(name, trace_id, parent.span_id if parent else None, attributes)
+        token = _current_span.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.set_error(f"{type(e).__name__}: {e}")
+            raise
+        finally:
+            _current_span.reset(token)
+            span.end_ns = time.time_ns()
+            try:
+                self.exporter.export(span)
+            except Exception as e:
+                print(f"⚠️ スパンの出力に失敗しました: {e}")
+
+    def shutdown(self):
+        if self.exporter is not None:
+            self.exporter.shutdown()
+
+
+def create_tracer(path: Optional[str] = None, format: Optional[str] = None) -> Tracer:
+    """path（省略時は環境変数 AGENT_TRACE_FILE）に出力するトレーサー
+
+    format は "jsonl"（既定）か "otlp"（省略時は環境変数 AGENT_TRACE_FORMAT）。path がなければ無効なトレーサー。
+    """
+    path = path or os.getenv('AGENT_TRACE_FILE')
+    if not path:
+        return Tracer()
+    format = (format or os.getenv('AGENT_TRACE_FORMAT', 'jsonl')).lower()
+    if format == "otlp":
+        return Tracer(OTLPJsonExporter(path))
+    if format == "jsonl":
+        return Tracer(JsonLinesExporter(path))
+    raise ValueError(f"未対応のトレース形式です: {format}（jsonl / otlp）")
+
+
+def load_spans(path: str) -> List[Dict]:
+    """JSON Lines / OTLP/JSON のどちらの形式のファイルからもスパンを読み込む"""
+    spans = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "resourceSpans" not in record:
+                spans.append(record)
+                continue
+            for resource_spans in record["resourceSpans"]:
+                for scope_spans in resource_spans.get("scopeSpans", []):
+                    for otlp_span in scope_spans.get("spans", []):
+                        start_ns, end_ns = int(otlp_span["startTimeUnixNano"]), int(otlp_span["endTimeUnixNano"])
+                        spans.append({
+                            "name": otlp_span["name"],
+                            "trace_id": otlp_span["traceId"],
+                            "span_id": otlp_span["spanId"],
+                            "parent_id": otlp_span.get("parentSpanId"),
+                            "duration_ms": (end_ns - start_ns) / 1e6,
+                            "status": "error" if otlp_span.get("status", {}).get("code") == 2 else "ok",
+                            "attributes": {a["key"]: next(iter(a["value"].values())) for a in otlp_span["attributes"]},
+                        })
+    return spans
+
+
+def summarize_spans(spans: List[Dict]) -> Dict[str, Dict]:
+    """スパン名（ツールはツール名ごと）の件数・合計・平均・p95・エラー数と、ルートスパン合計に対する割合"""
+    durations: Dict[str, List[float]] = {}
+    errors: Dict[str, int] = {}
+    root_total = sum(span["duration_ms"] for span in spans if not span.get("parent_id")) or 1.0
+    for span in spans:
+        name = span["name"]
+        tool = span.get("attributes", {}).get("tool")
+        if tool:
+            name = f"{name}:{tool}"
+        durations.setdefault(name, []).append(span["duration_ms"])
+        if span.get("status") == "error":
+            errors[name] = errors.get(name, 0) + 1
+
+    summary = {}
+    for name, values in durations.items():
+        ordered = sorted(values)
+        summary[name] = {
+            "count": len(values),
+            "total_ms": sum(values),
+            "avg_ms": sum(values) / len(values),
+            "p95_ms": ordered[min(len(ordered) - 1, int(round(0.95 * (len(ordered) - 1))))],
+            "errors": errors.get(name, 0),
+            "share_of_runs": sum(values) / root_total,
+        }
+    return dict(sorted(summary.items(), key=lambda item: -item[1]["total_ms"]))
+
+
+def main():
+    """トレースファイルの集計"""
+    parser = argparse.ArgumentParser(description="エージェントのトレースの集計")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    summarize_parser = subparsers.add_parser("summarize", help="スパン名ごとの所要時間の内訳")
+    summarize_parser.add_argument("path")
+    args = parser.parse_args()
+
+    summary = summarize_spans(load_spans(args.path))
+    print(f"{'スパン':<28} {'件数':>6} {'合計(ms)':>10} {'平均(ms)':>9} {'p95(ms)':>9} {'エラー':>6} {'割合':>6}")
+    for name, stats in summary.items():
+        print(f"{name:<28} {stats['count']:>6} {stats['total_ms']:>10.1f} {stats['avg_ms']:>9.1f} "
+              f"{stats['p95_ms']:>9.1f} {stats['errors']:>6} {stats['share_of_runs']:>6.0%}")
+
+
+if __name__ == "__main__":
+    main()
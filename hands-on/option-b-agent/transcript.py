@@ -0,0 +1,145 @@
+"""
+ReActループの会話履歴（トランスクリプト）管理
+システムプロンプトと直近のステップはそのまま残し、古いステップは短い要約に置き換えて
+毎回LLMに送るプロンプトをトークン予算内に収める（反復回数に対してプロンプトが二乗で増えないように）
+"""
+
+import sys
+from pathlib import Path
+from typing import Dict, List, Optional
+
+# プロジェクトルートをPythonパスに追加
+project_root = Path(__file__).parent.parent.parent
+sys.path.append(str(project_root))
+
+from common.llm_client import estimate_tokens
+
+
+def truncate_text(text: str, max_tokens: int) -> str:
+    """テキストを最大トークン数に切り詰め（省略した文字数を末尾に記載）"""
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    # 推定トークン数が max_tokens 以内に収まる最長の先頭部分（文字の種類で1文字あたりのトークン数が違うため二分探索）
+    low, high = 0, len(text)
+    while low < high:
+        middle = (low + high + 1) // 2
+        if estimate_tokens(text[:middle]) <= max_tokens:
+            low = middle
+        else:
+            high = middle - 1
+    return f"{text[:low]}…（{len(text) - low}文字省略）"
+
+
+def _first_line(text: str, prefix: str, max_chars: int) -> Optional[str]:
+    for line in text.splitlines():
+        if line.startswith(prefix):
+            line = line[len(prefix):].strip()
+            return line if len(line) <= max_chars else line[:max_chars] + "…"
+    return None
+
+
+class TranscriptStep:
+    """1反復分のエージェントの応答とObservation"""
+
+    def __init__(self, response: str):
+        self.response = response
+        self.observations: List[str] = []
+        self.summary = None
+
+    def text(self) -> str:
+        return "\n".join([self.response] + self.observations)
+
+    def summarize(self, number: int, max_chars: int = 40) -> str:
+        """ステップの要約（Thought・Action と各Observationの冒頭だけを残す）。一度作った要約は再利用する"""
+        if self.summary is None:
+            parts = [f"[ステップ{number}の要約]"]
+            thought = _first_line(self.response, "Thought:", max_chars)
+            if thought:
+                parts.append(f"Thought: {thought}")
+            actions = [line.strip() for line in self.response.splitlines() if line.startswith("Action:")]
+            parts.extend(actions)
+            for observation in self.observations:
+                first = observation.splitlines()[0] if observation else ""
+                parts.append(first if len(first) <= max_chars else first[:max_chars] + "…")
+            self.summary = "\n".join(parts)
+        return self.summary
+
+
+class Transcript:
+    """トークン予算付きのReActトランスクリプト
+
+    max_tokens を超える場合は、古いステップから順に要約に置き換え、それでも超える場合は
+    最も古い要約から省略する。システムプロンプトと直近 keep_recent_steps 件のステップは常にそのまま残す。
+    長いObservationは追加時に max_observation_tokens に切り詰める。
+    """
+
+    def __init__(self, system_prompt: str, max_tokens: int = 4000, keep_recent_steps: int = 3,
+                 max_observation_tokens: int = 500):
+        self.system_prompt = system_prompt
+        self.max_tokens = max_tokens
+        self.keep_recent_steps = keep_recent_steps
+        self.max_observation_tokens = max_observation_tokens
+        self.steps: List[TranscriptStep] = []
+        self.pending_observations: List[str] = []
+
+        # 反復ごとの送信トークン数
+        self.sent_tokens: List[int] = []
+
+    def add_response(self, response: str):
+        """エージェントの応答を新しいステップとして追加"""
+        step = TranscriptStep(response)
+        self.steps.append(step)
+
+    def add_observation(self, observation: str):
+        """直前のステップにObservationを追加（ステップがなければ次の応答の前に置く）"""
+        observation = truncate_text(observation, self.max_observation_tokens)
+        if self.steps:
+            self.steps[-1].observations.append(observation)
+        else:
+            self.pending_observations.append(observation)
+
+    def render(self) -> str:
+        """LLMに送るプロンプトを組み立て、送信トークン数を記録"""
+        head = [self.system_prompt] + self.pending_observations
+        recent_count = min(self.keep_recent_steps, len(self.steps))
+        older = self.steps[:len(self.steps) - recent_count]
+        recent = [step.text() for step in self.steps[len(self.steps) - recent_count:]]
+
+        budget = self.max_tokens - sum(estimate_tokens(text) for text in head + recent)
+
+        # 古いステップは新しいものから順に、予算内ならそのまま、超えるなら要約を使う
+        parts = []
+        omitted = 0
+        compacting = False
+        for number in range(len(older), 0, -1):
+            step = older[number - 1]
+            if not compacting:
+                text = step.text()
+                if estimate_tokens(text) <= budget:
+                    parts.append(text)
+                    budget -= estimate_tokens(text)
+                    continue
+                # 1つでも予算を超えたら、それより古いステップはすべて要約にする
+                compacting = True
+            summary = step.summarize(number)
+            if estimate_tokens(summary) <= budget:
+                parts.append(summary)
+                budget -= estimate_tokens(summary)
+            else:
+                omitted = number
+                break
+
+        if omitted:
+            parts.append(f"（古いステップ {omitted}件は省略されました）")
+        prompt = "\n".join(head + parts[::-1] + recent)
+        self.sent_tokens.append(estimate_tokens(prompt))
+        return prompt
+
+    def stats(self) -> Dict:
+        """送信トークン数の統計"""
+        return {
+            "iterations": len(self.sent_tokens),
+            "tokens_per_iteration": list(self.sent_tokens),
+            "total_tokens": sum(self.sent_tokens),
+            "max_tokens": max(self.sent_tokens) if self.sent_tokens else 0,
+        }
@@ -0,0 +1,15 @@
+"""
+オフラインテストの共通設定
+LLMはスタブを使い、APIキーやネットワークなしで実行できるようにする
+"""
+
+import os
+import sys
+from pathlib import Path
+
+project_root = Path(__file__).parent.parent
+sys.path.insert(0, str(project_root))
+sys.path.insert(0, str(project_root / "hands-on" / "option-b-agent"))
+
+os.environ["LLM_BACKEND"] = "stub"
+os.environ.pop("LLM_REPLAY_MODE", None)
@@ -0,0 +1,105 @@
+"""
+スタブLLM・応答の記録と再生・レート制限・calculate ツールのオフラインテスト
+
+実行方法:
+    pip install pytest
+    python -m pytest -q tests
+"""
+
+import time
+
+import pytest
+
+from common.llm_client import (REPLAY_ONLY, REPLAY_RECORD, LLMClient, LLMError, ResponseRecorder, StubBackend,
+                               TokenBucket)
+from arithmetic import ArithmeticEngine, ExpressionError, fuzz
+
+
+def stub_client(backend: StubBackend, recorder=None) -> LLMClient:
+    return LLMClient(backend, requests_per_minute=0, max_retries=0, recorder=recorder)
+
+
+# --- スタブと記録・再生 ---
+
+def test_stub_applies_stop_sequences():
+    backend = StubBackend(responses=["Action: calculate\nObservation: 4"])
+    response = stub_client(backend).generate("質問", generation_config={"stop_sequences": ["\nObservation"]})
+    assert response.text == "Action: calculate"
+
+
+def test_stub_stream_can_ignore_stop_sequences():
+    backend = StubBackend(responses=["Action: calculate\nObservation: 4"], stream_stop_sequences=False)
+    chunks = list(stub_client(backend).stream("質問", generation_config={"stop_sequences": ["\nObservation"]}))
+    assert "".join(chunks) == "Action: calculate\nObservation: 4"
+
+
+def test_record_then_replay_without_backend(tmp_path):
+    recording = stub_client(StubBackend(responses=["記録した応答"]),
+                            ResponseRecorder(str(tmp_path), REPLAY_RECORD))
+    assert recording.generate("質問").text == "記録した応答"
+    assert recording.metrics.snapshot()["recorded"] == 1
+
+    # 再生のみのモードでは、記録済みの応答をバックエンドを呼ばずに返す
+    backend = StubBackend(responses=["呼ばれてはいけない"])
+    replaying = stub_client(backend, ResponseRecorder(str(tmp_path), REPLAY_ONLY))
+    assert replaying.generate("質問").text == "記録した応答"
+    assert backend.call_count == 0
+
+    with pytest.raises(LLMError):
+        replaying.generate("記録していない質問")
+
+
+def test_stream_replay_uses_separate_key(tmp_path):
+    recorder = ResponseRecorder(str(tmp_path), REPLAY_RECORD)
+    client = stub_client(StubBackend(responses=["ストリームの応答"]), recorder)
+    assert "".join(client.stream("質問")) == "ストリームの応答"
+
+    replaying = stub_client(StubBackend(), ResponseRecorder(str(tmp_path), REPLAY_ONLY))
+    assert "".join(replaying.stream("質問")) == "ストリームの応答"
+    with pytest.raises(LLMError):
+        replaying.generate("質問")
+
+
+# --- レート制限 ---
+
+def test_token_bucket_allows_burst_then_waits():
+    bucket = TokenBucket(rate_per_second=20, capacity=3)
+    for _ in range(3):
+        assert bucket.acquire(timeout=0)
+    assert not bucket.acquire(timeout=0)
+
+    start_time = time.monotonic()
+    assert bucket.acquire(timeout=1.0)
+    assert time.monotonic() - start_time >= 0.03
+
+
+# --- calculate ツールの数式エンジン ---
+
+@pytest.mark.parametrize("expression, expected", [
+    ("2+2", 4),
+    ("25 * 4 + 100", 200),
+    ("(1.5 + 2.5) * 3 / 4", 3.0),
+    ("2**10 - 1", 1023),
+    ("((7 % 3) + 8 // 3) * -2", -6),
+])
+def test_engine_matches_python(expression, expected):
+    assert ArithmeticEngine().evaluate(expression) == expected
+
+
+@pytest.mark.parametrize("expression", [
+    "9**9**9",
+    "1/0",
+    "__import__('os')",
+    "2 +",
+    "1" * 300,
+])
+def test_engine_rejects_unsafe_or_invalid(expression):
+    with pytest.raises(ExpressionError):
+        ArithmeticEngine().evaluate(expression)
+
+
+def test_engine_fuzz():
+    stats = fuzz(iterations=500, seed=1, max_seconds_per_case=0.5)
+    assert stats["mismatches"] == []
+    assert stats["unexpected_errors"] == []
+    assert stats["slow"] == []